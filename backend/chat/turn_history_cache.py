@@ -0,0 +1,112 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable
+
+import lib.utils.constants as constants
+import backend.utils.constants as backend_constants
+
+# load_messages() -> the user's last messages from firestore, in chronological order
+LoadMessages = Callable[[], Awaitable[list[dict]]]
+
+
+class TurnHistoryCache:
+    """
+        Per user ring buffer of the last messages, so most turns don't query firestore.
+
+        A user's buffer is loaded from firestore on first use and kept up to date by append,
+        which must be called after every message is saved. A buffer keeps one message more than the turn history,
+        so a full turn history is left when the message being answered is in it. Buffers are dropped after ttl_seconds
+        (in case another process wrote messages) and the least recently used users are evicted.
+        Used from the event loop only.
+    """
+
+    def __init__(self,
+                 limit: int = constants.TURN_HISTORY_LIMIT + 1,
+                 max_users: int = backend_constants.TURN_HISTORY_CACHE_MAX_USERS,
+                 ttl_seconds: float = backend_constants.TURN_HISTORY_CACHE_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.limit = limit
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+
+        # uid -> (messages, loaded_at). Most recently used users are at the end.
+        self._buffers: OrderedDict[str, tuple[deque, float]] = OrderedDict()
+        # uid -> running load. Concurrent misses for a user share one firestore query.
+        self._loads: dict[str, asyncio.Task] = {}
+        # uid -> messages saved while the user's load was running
+        self._pending: dict[str, list[dict]] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, uid: str, load_messages: LoadMessages) -> list[dict]:
+        """
+            Return the user's last messages in chronological order.
+        """
+        entry = self._buffers.get(uid)
+        if entry is not None:
+            messages, loaded_at = entry
+            if self.clock() - loaded_at < self.ttl_seconds:
+                self._buffers.move_to_end(uid)
+                self.hits += 1
+                return list(messages)
+            del self._buffers[uid]
+
+        self.misses += 1
+        task = self._loads.get(uid)
+        if task is None:
+            self._pending[uid] = []
+            task = asyncio.ensure_future(self._load(uid, load_messages))
+            self._loads[uid] = task
+        # A cancelled request must not cancel the load other requests are waiting on
+        return list(await asyncio.shield(task))
+
+    def append(self, uid: str, message: dict):
+        """
+            Add a message that was saved to firestore. message needs speaker, content and timestamp.
+        """
+        entry = self._buffers.get(uid)
+        if entry is not None:
+            messages = entry[0]
+            if messages and messages[-1]["timestamp"] > message["timestamp"]:
+                # Concurrent requests of the same user can finish out of order
+                ordered = sorted([*messages, message], key=lambda item: item["timestamp"])
+                messages.clear()
+                messages.extend(ordered)
+            else:
+                messages.append(message)
+        elif uid in self._pending:
+            self._pending[uid].append(message)
+        # Otherwise the next get loads it from firestore
+
+    def invalidate(self, uid: str):
+        self._buffers.pop(uid, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._buffers),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    async def _load(self, uid: str, load_messages: LoadMessages) -> deque:
+        try:
+            loaded = await load_messages()
+        finally:
+            del self._loads[uid]
+            pending = self._pending.pop(uid)
+
+        # Messages saved during the query may or may not be in its result
+        by_timestamp = {message["timestamp"]: message for message in [*loaded, *pending]}
+        messages = deque(
+            (by_timestamp[timestamp] for timestamp in sorted(by_timestamp)), maxlen=self.limit)
+
+        self._buffers[uid] = (messages, self.clock())
+        self._buffers.move_to_end(uid)
+        while len(self._buffers) > self.max_users:
+            self._buffers.popitem(last=False)
+        return messages
@@ -1,7 +1,13 @@
 import firebase_admin
 from firebase_admin import credentials, firestore_async, firestore
 
+from backend.firebase.token_verifier import CertStore, FirebaseTokenVerifier
+
 cred = credentials.Certificate("private_keys/service_account_key.json")
 firebase_app = firebase_admin.initialize_app(cred)
 
 firestore_async = firestore_async.client(firebase_app)
+
+# Verifies ID tokens locally with cached certs instead of auth.verify_id_token
+token_verifier = FirebaseTokenVerifier(
+    project_id=firebase_app.project_id, cert_store=CertStore())
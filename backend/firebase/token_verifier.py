@@ -0,0 +1,231 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import google.auth.exceptions
+from google.auth import jwt
+from google.auth.transport import requests as google_requests
+from firebase_admin import auth
+
+import backend.utils.constants as backend_constants
+
+# Public certs of the keys that sign Firebase ID tokens
+ID_TOKEN_CERT_URI = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+ID_TOKEN_ISSUER_PREFIX = "https://securetoken.google.com/"
+
+_MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+# fetch_certs() -> ({kid: pem cert or public key}, max_age_seconds)
+FetchCerts = Callable[[], tuple[dict[str, str], float]]
+
+
+def fetch_google_certs(url: str = ID_TOKEN_CERT_URI) -> tuple[dict[str, str], float]:
+    """
+        Download the token signing certs. The max age comes from the Cache-Control header.
+    """
+    try:
+        response = google_requests.Request()(url=url, method="GET")
+    except google.auth.exceptions.TransportError as e:
+        raise auth.CertificateFetchError(str(e), cause=e) from e
+
+    if response.status != 200:
+        raise auth.CertificateFetchError(
+            f"Could not fetch certificates at {url}. Status {response.status}", cause=None)
+
+    match = _MAX_AGE_PATTERN.search(response.headers.get("cache-control", ""))
+    max_age = float(match.group(1)) if match else backend_constants.CERT_DEFAULT_MAX_AGE_SECONDS
+    return json.loads(response.data), max_age
+
+
+class CertStore:
+    """
+        Cached public certs by key id.
+        Certs are refreshed when they expire or a token names an unknown key (the keys were rotated).
+        Only one thread refreshes at a time. The others wait and then use its result.
+        Refreshes for unknown keys are rate limited, so forged key ids can't make us hammer Google.
+    """
+
+    def __init__(self,
+                 fetch_certs: FetchCerts = fetch_google_certs,
+                 min_refresh_seconds: float = backend_constants.CERT_MIN_REFRESH_SECONDS,
+                 clock: Callable[[], float] = time.time):
+        self.fetch_certs = fetch_certs
+        self.min_refresh_seconds = min_refresh_seconds
+        self.clock = clock
+
+        self._certs: dict[str, str] = {}
+        self._expires_at = 0.0
+        self._refreshed_at = float("-inf")
+        self._refresh_lock = threading.Lock()
+        self.refreshes = 0
+
+    def prewarm(self):
+        """
+            Fetch the certs before the first request needs them.
+        """
+        self._refresh(force=True)
+
+    def get(self, kid: str) -> str | None:
+        """
+            Return the cert for the key id or None if no such key exists.
+        """
+        if self.clock() >= self._expires_at:
+            self._refresh(force=True)
+        elif kid not in self._certs:
+            self._refresh(force=False)
+        return self._certs.get(kid)
+
+    def _refresh(self, force: bool):
+        seen_refreshes = self.refreshes
+        with self._refresh_lock:
+            # Another thread refreshed while we waited for the lock
+            if self.refreshes != seen_refreshes:
+                return
+            if not force and self.clock() - self._refreshed_at < self.min_refresh_seconds:
+                return
+
+            certs, max_age = self.fetch_certs()
+            now = self.clock()
+            self._certs = certs
+            self._expires_at = now + max_age
+            self._refreshed_at = now
+            self.refreshes += 1
+
+
+class FirebaseTokenVerifier:
+    """
+        Verifies Firebase ID tokens locally with the cached certs, and caches verified tokens.
+
+        Same checks as firebase_admin.auth.verify_id_token without the revocation check (which wasn't used)
+        and raises the same firebase_admin.auth errors.
+        A verified token is cached by its sha256 until its exp, capped at max_ttl_seconds. Failures are never cached.
+    """
+
+    def __init__(self,
+                 project_id: str,
+                 cert_store: CertStore,
+                 max_entries: int = backend_constants.TOKEN_CACHE_MAX_ENTRIES,
+                 max_ttl_seconds: float = backend_constants.TOKEN_CACHE_MAX_TTL_SECONDS,
+                 clock_skew_seconds: int = 0,
+                 clock: Callable[[], float] = time.time):
+        self.project_id = project_id
+        self.cert_store = cert_store
+        self.max_entries = max_entries
+        self.max_ttl_seconds = max_ttl_seconds
+        self.clock_skew_seconds = clock_skew_seconds
+        self.clock = clock
+
+        # token hash -> (claims, expires_at). Most recently used items are at the end.
+        self._entries: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, id_token: str) -> dict:
+        """
+            Return the claims of the token with uid set. Raises the firebase_admin.auth errors.
+        """
+        claims = self.get_cached(id_token)
+        if claims is not None:
+            return claims
+
+        claims = self._verify(id_token)
+
+        # Cache until the token expires
+        expires_at = min(float(claims["exp"]), self.clock() + self.max_ttl_seconds)
+        with self._lock:
+            self._entries[_token_key(id_token)] = (claims, expires_at)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return claims
+
+    def get_cached(self, id_token: str) -> dict | None:
+        """
+            Return the claims of an already verified token, or None. Cheap enough to call on the event loop.
+        """
+        if not isinstance(id_token, str) or not id_token:
+            return None
+
+        key = _token_key(id_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= self.clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _verify(self, id_token: str) -> dict:
+        if not isinstance(id_token, str) or not id_token:
+            raise ValueError(
+                "Illegal ID token provided. ID token must be a non-empty string.")
+
+        try:
+            header = jwt.decode_header(id_token)
+            payload = jwt.decode(id_token, verify=False)
+        except ValueError as e:
+            raise auth.InvalidIdTokenError(str(e), cause=e) from e
+
+        kid = header.get("kid")
+        subject = payload.get("sub")
+        error_message = None
+        if not kid:
+            error_message = 'Firebase ID token has no "kid" claim.'
+        elif header.get("alg") != "RS256":
+            error_message = f'Firebase ID token has incorrect algorithm. Expected "RS256" but got "{header.get("alg")}".'
+        elif payload.get("aud") != self.project_id:
+            error_message = f'Firebase ID token has incorrect "aud" (audience) claim. Expected "{self.project_id}".'
+        elif payload.get("iss") != ID_TOKEN_ISSUER_PREFIX + self.project_id:
+            error_message = 'Firebase ID token has incorrect "iss" (issuer) claim.'
+        elif not isinstance(subject, str) or not subject or len(subject) > 128:
+            error_message = 'Firebase ID token has an invalid "sub" (subject) claim.'
+        if error_message:
+            raise auth.InvalidIdTokenError(error_message)
+
+        cert = self.cert_store.get(kid)
+        if cert is None:
+            raise auth.InvalidIdTokenError(
+                f'Firebase ID token has a "kid" claim which does not correspond to a known public key.')
+
+        try:
+            claims = jwt.decode(
+                id_token,
+                certs={kid: cert},
+                audience=self.project_id,
+                clock_skew_in_seconds=self.clock_skew_seconds
+            )
+        except ValueError as e:
+            if "Token expired" in str(e):
+                raise auth.ExpiredIdTokenError(str(e), cause=e) from e
+            raise auth.InvalidIdTokenError(str(e), cause=e) from e
+
+        claims["uid"] = claims["sub"]
+        return claims
+
+
+def _token_key(id_token: str) -> str:
+    # Tokens are credentials. Keep only their hash in memory.
+    return hashlib.sha256(id_token.encode("utf-8")).hexdigest()
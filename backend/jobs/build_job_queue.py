@@ -0,0 +1,179 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable
+
+from langchain_core.documents import Document
+
+import lib.utils.constants as constants
+from lib.utils.metrics_utils import STAGE_KNOWLEDGE_BASE_BUILD, measure_stage
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+# build_func(documents, uid, progress_callback) -> counts
+BuildFunc = Callable[[list[Document], str, Callable[[float, str], None]], dict]
+
+
+class BuildQueueFullError(Exception):
+    """
+        Too many builds are waiting. The client should retry later.
+    """
+
+
+class BuildJob:
+    """
+        One knowledge base build. progress goes from 0 to 1 and stage describes the current step.
+    """
+
+    def __init__(self, uid: str, documents: list[Document]):
+        self.job_id = uuid.uuid4().hex
+        self.uid = uid
+        self.documents = documents
+        self.status = JOB_QUEUED
+        self.progress = 0.0
+        self.stage = "queued"
+        self.result: dict | None = None
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        # Number of build requests merged into this job
+        self.coalesced = 1
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (JOB_SUCCEEDED, JOB_FAILED)
+
+    def set_progress(self, progress: float, stage: str):
+        # Called from the worker thread. Plain attribute writes are safe to read from the event loop.
+        self.progress = max(self.progress, min(progress, 1.0))
+        self.stage = stage
+
+
+class BuildJobQueue:
+    """
+        In-process queue for knowledge base builds.
+
+        Builds run in a pool of num_workers threads, so concurrent builds can't oversubscribe the CPU.
+        A user has at most one queued build. Submitting again while a build is queued replaces its documents
+        (the request always holds the whole knowledge base) and returns the same job.
+        Builds of the same user never run at the same time.
+    """
+
+    def __init__(self,
+                 build_func: BuildFunc,
+                 num_workers: int,
+                 max_queued: int,
+                 max_finished: int,
+                 on_success: Callable[[BuildJob], Awaitable[None]] = None):
+        self.build_func = build_func
+        self.num_workers = num_workers
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.on_success = on_success
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="build-job")
+        self._queue: asyncio.Queue[BuildJob] = asyncio.Queue()
+        self._jobs: dict[str, BuildJob] = {}
+        self._queued_by_uid: dict[str, BuildJob] = {}
+        self._uid_locks: dict[str, asyncio.Lock] = {}
+        # Finished job ids, oldest first. Old jobs are forgotten past max_finished.
+        self._finished: OrderedDict[str, None] = OrderedDict()
+        self._workers: list[asyncio.Task] = []
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker())
+                         for _ in range(self.num_workers)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, uid: str, documents: list[Document]) -> BuildJob:
+        """
+            Queue a build for the user and return its job.
+            Raises BuildQueueFullError if max_queued builds are already waiting.
+        """
+        # Coalesce with the build that is still waiting
+        queued_job = self._queued_by_uid.get(uid)
+        if queued_job is not None:
+            queued_job.documents = documents
+            queued_job.coalesced += 1
+            return queued_job
+
+        if len(self._queued_by_uid) >= self.max_queued:
+            raise BuildQueueFullError(
+                f"{len(self._queued_by_uid)} builds are already queued.")
+
+        job = BuildJob(uid=uid, documents=documents)
+        self._jobs[job.job_id] = job
+        self._queued_by_uid[uid] = job
+        self._queue.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> BuildJob | None:
+        return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        running = sum(1 for job in self._jobs.values()
+                      if job.status == JOB_RUNNING)
+        return {
+            "queued": len(self._queued_by_uid),
+            "running": running,
+            "finished": len(self._finished),
+        }
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: BuildJob):
+        lock = self._uid_locks.setdefault(job.uid, asyncio.Lock())
+        async with lock:
+            # From now on a new submit for the user starts a new job
+            if self._queued_by_uid.get(job.uid) is job:
+                del self._queued_by_uid[job.uid]
+
+            job.status = JOB_RUNNING
+            job.started_at = time.time()
+            job.set_progress(0.0, "starting")
+            documents, job.documents = job.documents, None
+
+            try:
+                loop = asyncio.get_running_loop()
+                with measure_stage(STAGE_KNOWLEDGE_BASE_BUILD, constants.EMBEDDING_BACKEND):
+                    job.result = await loop.run_in_executor(
+                        self.executor, self.build_func, documents, job.uid, job.set_progress)
+                if self.on_success:
+                    await self.on_success(job)
+                job.status = JOB_SUCCEEDED
+                job.set_progress(1.0, "done")
+            except Exception as e:
+                print(f"Build job {job.job_id} for {job.uid} failed: {e}")
+                job.status = JOB_FAILED
+                job.stage = "failed"
+                job.error = "Something went wrong building the embeddings and indices."
+            finally:
+                job.finished_at = time.time()
+                self._mark_finished(job)
+
+        if not lock.locked() and job.uid not in self._queued_by_uid:
+            self._uid_locks.pop(job.uid, None)
+
+    def _mark_finished(self, job: BuildJob):
+        self._finished[job.job_id] = None
+        while len(self._finished) > self.max_finished:
+            old_job_id, _ = self._finished.popitem(last=False)
+            self._jobs.pop(old_job_id, None)
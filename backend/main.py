@@ -1,39 +1,117 @@
-from fastapi import FastAPI, HTTPException, status, Header, Depends, Request, Security
+from fastapi import FastAPI, HTTPException, status, Header, Depends, Request, Response, Security, BackgroundTasks
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import uvicorn
 from backend.models.chat_request import ChatRequest
 from backend.models.chat_response import ChatResponse
 from backend.models.register_request import RegisterRequest
 from backend.models.user_response import UserResponse
-from backend.models.generic_response import GenericResponse
 from backend.models.build_embeddings_request import BuildEmbeddingsRequest
+from backend.models.build_embeddings_response import BuildEmbeddingsResponse
+from backend.models.build_job_response import BuildJobResponse
+from backend.jobs.build_job_queue import BuildJob, BuildJobQueue, BuildQueueFullError
+from backend.chat.turn_history_cache import TurnHistoryCache
+from backend.utils.stage_timer import StageTimer
 import backend.firebase.firebase_client as firebase_client
 
 from lib.augmented_generation.rag_external import RAGExternal
+from lib.augmented_generation.engine_registry import EngineRegistry
 import backend.utils.constants as backend_constants
 import lib.utils.constants as constants
+import lib.utils.metrics_utils as metrics_utils
+from lib.semantic_search.user_vector_store_cache import USER_VECTOR_STORE_CACHE
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from starlette.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from firebase_admin import auth
 from pydantic import BaseModel, Field
 
 import firebase_admin.exceptions as firebase_exceptions
 import asyncio
+import time
 from google.cloud.firestore import SERVER_TIMESTAMP
 
 import backend.utils.utils as utils
 from google.cloud.firestore import AsyncCollectionReference
 from google.cloud.firestore import Query
+from contextlib import asynccontextmanager
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+        Build the RAG engines once per process and warm them up before serving requests.
+    """
+    engine_registry = EngineRegistry()
+    await asyncio.to_thread(engine_registry.warmup)
+    app.state.engine_registry = engine_registry
+
+    # Fetch the token signing certs so the first request doesn't have to
+    try:
+        await asyncio.to_thread(firebase_client.token_verifier.cert_store.prewarm)
+    except Exception as e:
+        print(f"Could not prewarm the Firebase certs: {e}")
+
+    # Knowledge base builds run in the background with their own bounded pool
+    build_job_queue = BuildJobQueue(
+        build_func=lambda documents, uid, progress_callback: engine_registry.rag.build_embeddings_and_indices(
+            documents=documents, uid=uid, progress_callback=progress_callback),
+        num_workers=backend_constants.BUILD_JOB_WORKERS,
+        max_queued=backend_constants.BUILD_JOB_MAX_QUEUED,
+        max_finished=backend_constants.BUILD_JOB_MAX_FINISHED,
+        on_success=mark_knowledge_base_built
+    )
+    build_job_queue.start()
+    app.state.build_job_queue = build_job_queue
+
+    turn_history_cache = TurnHistoryCache()
+    app.state.turn_history_cache = turn_history_cache
+
+    # Cache hit rates are read from the caches when /metrics is scraped
+    cache_stats_collector = metrics_utils.register_cache_stats({
+        "id_tokens": firebase_client.token_verifier.stats,
+        "turn_history": turn_history_cache.stats,
+        "query_embeddings": lambda: engine_registry.cache_stats()["query_embeddings"],
+        "answers": lambda: engine_registry.cache_stats()["answers"],
+        "retrievers": USER_VECTOR_STORE_CACHE.stats,
+    })
+
+    yield
+    metrics_utils.unregister_cache_stats(cache_stats_collector)
+    await build_job_queue.stop()
+    engine_registry.close()
 
 
 app = FastAPI(
     title="Orcal AI",
-    description="Personal Assistant RAG App"
+    description="Personal Assistant RAG App",
+    lifespan=lifespan
 )
 # To get bearer token
 security = HTTPBearer()
 
 
+def get_rag(request: Request) -> RAGExternal:
+    """
+        Dependency that returns the process wide RAG engine.
+    """
+    return request.app.state.engine_registry.rag
+
+
+def get_build_job_queue(request: Request) -> BuildJobQueue:
+    """
+        Dependency that returns the process wide build job queue.
+    """
+    return request.app.state.build_job_queue
+
+
+def get_turn_history_cache(request: Request) -> TurnHistoryCache:
+    """
+        Dependency that returns the process wide turn history cache.
+    """
+    return request.app.state.turn_history_cache
+
+
 @app.get("/")
 def health_check():
     """
@@ -42,6 +120,14 @@ def health_check():
     return {"status": "ok", "message": "API is online"}
 
 
+@app.get("/metrics")
+def metrics():
+    """
+        Prometheus metrics. Stage latency histograms, llm token rates, prompt sizes and cache stats.
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
 async def register(request: RegisterRequest):
     db = firebase_client.firestore_async
@@ -140,16 +226,15 @@ async def register(request: RegisterRequest):
     )
 
 
-@app.post("/build-embeddings", response_model=GenericResponse, status_code=status.HTTP_200_OK)
+@app.post("/build-embeddings", response_model=BuildJobResponse, status_code=status.HTTP_202_ACCEPTED)
 async def build_embeddings(request_data: BuildEmbeddingsRequest,
-                           credentials: HTTPAuthorizationCredentials = Security(security)):
+                           credentials: HTTPAuthorizationCredentials = Security(security),
+                           build_job_queue: BuildJobQueue = Depends(get_build_job_queue)):
+    start = time.perf_counter()
 
     # Authorize firebase credentials with firebase auth
     id_token = credentials.credentials
-    user_uid = await asyncio.to_thread(
-        authenticate_user,
-        id_token=id_token
-    )
+    user_uid = await authenticate_user_async(id_token)
 
     # Initialize Firestore
     db = firebase_client.firestore_async
@@ -174,7 +259,8 @@ async def build_embeddings(request_data: BuildEmbeddingsRequest,
                 "title": knowledge_object.title,
                 "details": knowledge_object.details
             }, merge=True)
-        await batch.commit()
+        with metrics_utils.measure_stage(metrics_utils.STAGE_KNOWLEDGE_BASE_WRITE, metrics_utils.BACKEND_FIRESTORE):
+            await batch.commit()
     except Exception as e:
         print(f"Firebae bulk insert docs failed: {e}")
         raise HTTPException(
@@ -182,40 +268,74 @@ async def build_embeddings(request_data: BuildEmbeddingsRequest,
             detail="Something went wrong building the embeddings and indices."
         )
 
+    # Prepare docs from request
+    docs = utils.convert_build_embeddings_request_to_docs(
+        request=request_data, uid=user_uid)
+
+    # Queue the build. The embeddings are built in the background. Poll the job for the status.
     try:
-        # Prepare docs from request
-        docs = utils.convert_build_embeddings_request_to_docs(
-            request=request_data, uid=user_uid)
-
-        # Do the embeddings
-        rag = RAGExternal()
-        await asyncio.to_thread(
-            rag.build_embeddings_and_indices,
-            documents=docs,
-            uid=user_uid
-        )
-    except Exception as e:
-        print(f"Building indices and embeddings failed: {e}")
+        job = build_job_queue.submit(uid=user_uid, documents=docs)
+    except BuildQueueFullError as e:
+        print(f"Build queue is full: {e}")
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Something went wrong building the embeddings and indices."
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many knowledge base builds are running. Please try again later."
         )
 
-    # Update RAG Config. Set Knowledgebase built to true.
-    try:
-        rag_info = {
-            "is_knowledge_base_built": True,
-        }
-        user_rag_config_ref = db.collection("users").document(
-            user_uid).collection("config").document("rag_config")
-        await user_rag_config_ref.set(rag_info)
-    except Exception as exception:
+    metrics_utils.observe_request("/build-embeddings", time.perf_counter() - start)
+    return create_build_job_response(job)
+
+
+@app.get("/build-embeddings/{job_id}", response_model=BuildJobResponse, status_code=status.HTTP_200_OK)
+async def get_build_job(job_id: str,
+                        credentials: HTTPAuthorizationCredentials = Security(security),
+                        build_job_queue: BuildJobQueue = Depends(get_build_job_queue)):
+
+    # Authorize firebase credentials with firebase auth
+    id_token = credentials.credentials
+    user_uid = await authenticate_user_async(id_token)
+
+    # Users can only see their own jobs
+    job = build_job_queue.get(job_id)
+    if job is None or job.uid != user_uid:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"{exception}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Build job not found."
         )
 
-    return GenericResponse(message="Successfully built the embeddings.")
+    return create_build_job_response(job)
+
+
+async def mark_knowledge_base_built(job: BuildJob):
+    """
+        Update RAG Config once the build succeeded. Set Knowledgebase built to true.
+    """
+    db = firebase_client.firestore_async
+    if not db:
+        raise Exception("Could not initialize firestore client.")
+
+    rag_info = {
+        "is_knowledge_base_built": True,
+    }
+    user_rag_config_ref = db.collection("users").document(
+        job.uid).collection("config").document("rag_config")
+    await user_rag_config_ref.set(rag_info)
+
+
+def create_build_job_response(job: BuildJob) -> BuildJobResponse:
+    result = None
+    if job.result is not None:
+        result = BuildEmbeddingsResponse(
+            message="Successfully built the embeddings.", **job.result)
+
+    return BuildJobResponse(
+        job_id=job.job_id,
+        status=job.status,
+        progress=round(job.progress, 3),
+        stage=job.stage,
+        result=result,
+        error=job.error
+    )
 
 
 def authenticate_user(id_token: str):
@@ -223,7 +343,7 @@ def authenticate_user(id_token: str):
         User firebase authentication to authenticate id_token from client.
     """
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = firebase_client.token_verifier.verify(id_token)
         return decoded_token["uid"]
     except ValueError as _:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
@@ -245,17 +365,136 @@ def authenticate_user(id_token: str):
                             detail="User record has been disabled.")
 
 
+async def authenticate_user_async(id_token: str) -> str:
+    """
+        Authenticate id_token. Already verified tokens are answered from the cache without a thread hop.
+    """
+    with metrics_utils.measure_stage(metrics_utils.STAGE_TOKEN_VERIFICATION, metrics_utils.BACKEND_FIREBASE):
+        decoded_token = firebase_client.token_verifier.get_cached(id_token)
+        if decoded_token is not None:
+            return decoded_token["uid"]
+        return await asyncio.to_thread(authenticate_user, id_token=id_token)
+
+
 @app.post("/chat")
-async def chat(request: ChatRequest, credentials: HTTPAuthorizationCredentials = Security(security)):
+async def chat(request: ChatRequest,
+               response: Response,
+               background_tasks: BackgroundTasks,
+               credentials: HTTPAuthorizationCredentials = Security(security),
+               rag: RAGExternal = Depends(get_rag),
+               turn_history_cache: TurnHistoryCache = Depends(get_turn_history_cache)):
+    timer = StageTimer()
+
     # Authorize firebase credentials with firebase auth
     id_token = credentials.credentials
-    user_uid = await asyncio.to_thread(
-        authenticate_user,
-        id_token=id_token
+    user_uid = await timer.measure("auth", authenticate_user_async(id_token))
+
+    # Get Collection Ref
+    messages_collection_ref = get_messages_collection_ref(user_uid)
+
+    # Get the message from the user.
+    query = request.query
+    user_message_timestamp = utils.get_current_time_milliseconds()
+    # Taken before retrieving, so an answer from a knowledge base rebuilt in the meantime isn't cached
+    answer_generation = rag.answer_cache.generation(user_uid)
+
+    # The turn history, saving the user's message and retrieval don't depend on each other. Run them together.
+    turn_history, _, results = await asyncio.gather(
+        timer.measure("history", get_turn_history(
+            turn_history_cache, user_uid, messages_collection_ref, before_timestamp=user_message_timestamp)),
+        timer.measure("save_user_message", save_message(
+            messages_collection_ref, turn_history_cache, uid=user_uid,
+            speaker=constants.SPEAKER_USER, content=query, timestamp=user_message_timestamp)),
+        timer.measure("retrieval", rag.aretrieve(uid=user_uid, query=query))
     )
 
-    # Write the message in Firestore
-    # Get Firestore
+    # Generate the response from LLM
+    llm_response = await timer.measure("generation", rag.agenerate(
+        uid=user_uid, query=query, results=results, generation=answer_generation, turn_history=turn_history))
+
+    # Write the LLM Response to Firestore after the response is sent.
+    # It goes in the turn history right away so the next turn sees it.
+    model_message = create_model_message_dict(
+        uid=user_uid, content=llm_response, user_message_timestamp=user_message_timestamp)
+    turn_history_cache.append(user_uid, model_message)
+    background_tasks.add_task(
+        save_message_with_retry, messages_collection_ref, turn_history_cache, model_message)
+
+    # Return the LLM Response
+    response.headers["Server-Timing"] = timer.server_timing_header()
+    metrics_utils.observe_request("/chat", timer.total_ms() / 1000)
+    return ChatResponse(response=llm_response)
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest,
+                      credentials: HTTPAuthorizationCredentials = Security(security),
+                      rag: RAGExternal = Depends(get_rag),
+                      turn_history_cache: TurnHistoryCache = Depends(get_turn_history_cache)):
+    """
+        Same as /chat but streams the LLM response as Server-Sent Events.
+        Tokens are sent as they're generated. The full response is saved to Firestore once the stream ends.
+    """
+    timer = StageTimer()
+
+    # Authorize firebase credentials with firebase auth
+    id_token = credentials.credentials
+    user_uid = await timer.measure("auth", authenticate_user_async(id_token))
+
+    # Get Collection Ref
+    messages_collection_ref = get_messages_collection_ref(user_uid)
+
+    query = request.query
+    user_message_timestamp = utils.get_current_time_milliseconds()
+    # Taken before retrieving, so an answer from a knowledge base rebuilt in the meantime isn't cached
+    answer_generation = rag.answer_cache.generation(user_uid)
+
+    # Get the turn history, save the user's message and retrieve together
+    turn_history, _, results = await asyncio.gather(
+        timer.measure("history", get_turn_history(
+            turn_history_cache, user_uid, messages_collection_ref, before_timestamp=user_message_timestamp)),
+        timer.measure("save_user_message", save_message(
+            messages_collection_ref, turn_history_cache, uid=user_uid,
+            speaker=constants.SPEAKER_USER, content=query, timestamp=user_message_timestamp)),
+        timer.measure("retrieval", rag.aretrieve(uid=user_uid, query=query))
+    )
+
+    async def event_stream():
+        chunks = []
+        try:
+            async for chunk in rag.agenerate_stream(
+                    uid=user_uid, query=query, results=results, generation=answer_generation,
+                    turn_history=turn_history):
+                chunks.append(chunk)
+                yield utils.format_sse_event(data={"token": chunk})
+        except Exception as e:
+            print(f"Streaming the response failed: {e}")
+            yield utils.format_sse_event(
+                data={"message": "Something went wrong generating the response."}, event="error")
+            return
+
+        # Write the full LLM Response to Firestore.
+        llm_response = "".join(chunks)
+        model_message = create_model_message_dict(
+            uid=user_uid, content=llm_response, user_message_timestamp=user_message_timestamp)
+        turn_history_cache.append(user_uid, model_message)
+        await save_message_with_retry(messages_collection_ref, turn_history_cache, model_message)
+
+        yield utils.format_sse_event(data={"response": llm_response}, event="done")
+        metrics_utils.observe_request("/chat/stream", timer.total_ms() / 1000)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no",
+                 "Server-Timing": timer.server_timing_header()}
+    )
+
+
+def get_messages_collection_ref(user_uid: str) -> AsyncCollectionReference:
+    """
+        Return the messages collection of the user's conversation.
+    """
     db = firebase_client.firestore_async
     if not db:
         raise HTTPException(
@@ -263,53 +502,100 @@ async def chat(request: ChatRequest, credentials: HTTPAuthorizationCredentials =
             detail="Could not initialize firestore client."
         )
 
-    # Get Collection Ref
-    messages_collection_ref: AsyncCollectionReference = db.collection("users").document(user_uid).collection(
+    return db.collection("users").document(user_uid).collection(
         "chats").document(backend_constants.CONVERSATION_DOCUMENT_KEY).collection("messages")
 
-    # Get the last 5 messages from firestore and sort them
+
+async def get_turn_history(turn_history_cache: TurnHistoryCache,
+                           uid: str,
+                           messages_collection_ref: AsyncCollectionReference,
+                           before_timestamp: int = None) -> list[dict]:
+    """
+        Get the last messages in chronological order as turn history objects.
+        Messages from before_timestamp on are left out. (The current message when it's saved at the same time.)
+    """
+    messages = await turn_history_cache.get(
+        uid, lambda: load_last_messages(messages_collection_ref, limit=turn_history_cache.limit))
+
+    # Leave out the current message before taking the last turns, so it doesn't take the place of one
+    if before_timestamp is not None:
+        messages = [message for message in messages if message["timestamp"] < before_timestamp]
+
     turn_history = []
+    for message in messages[-constants.TURN_HISTORY_LIMIT:]:
+        turn_history_dict = utils.create_turn_history_object(
+            speaker=message["speaker"], text=message["content"])
+        turn_history.append(turn_history_dict)
+
+    return turn_history
+
+
+async def load_last_messages(messages_collection_ref: AsyncCollectionReference,
+                             limit: int = constants.TURN_HISTORY_LIMIT) -> list[dict]:
+    """
+        Get the last limit messages from firestore in chronological order.
+    """
     turn_history_query = messages_collection_ref.order_by(
         "timestamp",
         direction=Query.DESCENDING
-    ).limit(5)
-    turn_history_firebase = await turn_history_query.get()
-    if len(turn_history_firebase) > 0:
-        # Sort turn history in reverse. For turn history to work, it must be in chronological order.
-        turn_history_dicts = [message.to_dict()
-                              for message in turn_history_firebase]
-        turn_history_dicts.sort(key=lambda message: message["timestamp"])
-
-        # Append the messages to turn_history
-        for message in turn_history_dicts:
-            turn_history_dict = utils.create_turn_history_object(
-                speaker=message["speaker"], text=message["content"])
-            turn_history.append(turn_history_dict)
-
-    # Get the message from the user.
-    query = request.query
-    # Write User's message in Cloud Firestore.
-    user_message_timestamp = utils.get_current_time_milliseconds()
+    ).limit(limit)
+    with metrics_utils.measure_stage(metrics_utils.STAGE_HISTORY_READ, metrics_utils.BACKEND_FIRESTORE):
+        turn_history_firebase = await turn_history_query.get()
+
+    # Sort turn history in reverse. For turn history to work, it must be in chronological order.
+    turn_history_dicts = [message.to_dict()
+                          for message in turn_history_firebase]
+    turn_history_dicts.sort(key=lambda message: message["timestamp"])
+    return turn_history_dicts
+
+
+async def save_message(messages_collection_ref: AsyncCollectionReference,
+                       turn_history_cache: TurnHistoryCache,
+                       uid: str,
+                       speaker: str,
+                       content: str,
+                       timestamp: int = None):
+    """
+        Write the message in Cloud Firestore with the timestamp (the current time by default) as the key,
+        then in the turn history cache.
+    """
+    if timestamp is None:
+        timestamp = utils.get_current_time_milliseconds()
     message_dict = create_message_dict(
-        uid=user_uid, speaker=constants.SPEAKER_USER, content=query, timestamp=user_message_timestamp)
-    await messages_collection_ref.document(f"{user_message_timestamp}").set(message_dict)
+        uid=uid, speaker=speaker, content=content, timestamp=timestamp)
+    with metrics_utils.measure_stage(metrics_utils.STAGE_MESSAGE_WRITE, metrics_utils.BACKEND_FIRESTORE):
+        await messages_collection_ref.document(f"{timestamp}").set(message_dict)
+    turn_history_cache.append(uid, message_dict)
 
-    # Generate the response from LLM
-    rag = RAGExternal()
-    turn_history_str = ""
-    if len(turn_history) > 0:
-        turn_history_str = f"{turn_history}"
-    llm_response = rag.discuss(
-        uid=user_uid, query=query, turn_history=turn_history_str)
-
-    # Write the LLM Response to Firestore.
-    llm_response_timestamp = utils.get_current_time_milliseconds()
-    message_dict = create_message_dict(
-        uid=user_uid, speaker=constants.SPEAKER_MODEL, content=llm_response, timestamp=llm_response_timestamp)
-    await messages_collection_ref.document(f"{llm_response_timestamp}").set(message_dict)
 
-    # Return the LLM Response
-    return ChatResponse(response=llm_response)
+async def save_message_with_retry(messages_collection_ref: AsyncCollectionReference,
+                                  turn_history_cache: TurnHistoryCache,
+                                  message_dict: dict):
+    """
+        Write a message that's already in the turn history cache to Cloud Firestore. Runs as a background task.
+        If every attempt fails, the user's cached turn history is dropped so it matches firestore again.
+    """
+    for attempt in range(backend_constants.MESSAGE_SAVE_ATTEMPTS):
+        try:
+            with metrics_utils.measure_stage(metrics_utils.STAGE_MESSAGE_WRITE, metrics_utils.BACKEND_FIRESTORE):
+                await messages_collection_ref.document(f"{message_dict['timestamp']}").set(message_dict)
+            return
+        except Exception as e:
+            print(f"Saving the message failed (attempt {attempt + 1}): {e}")
+            if attempt + 1 < backend_constants.MESSAGE_SAVE_ATTEMPTS:
+                await asyncio.sleep(backend_constants.MESSAGE_SAVE_RETRY_DELAY_SECONDS * 2 ** attempt)
+
+    turn_history_cache.invalidate(message_dict["uid"])
+
+
+def create_model_message_dict(uid: str, content: str, user_message_timestamp: int):
+    """
+        Messages are keyed by their timestamp. A response finished in the same millisecond as the user's message
+        (e.g. an answer cache hit) would overwrite it, so the response is always saved after it.
+    """
+    return create_message_dict(
+        uid=uid, speaker=constants.SPEAKER_MODEL, content=content,
+        timestamp=max(utils.get_current_time_milliseconds(), user_message_timestamp + 1))
 
 
 def create_message_dict(uid: str, speaker: str, timestamp: int, content: str):
@@ -0,0 +1,9 @@
+from pydantic import BaseModel, Field
+
+
+class BuildEmbeddingsResponse(BaseModel):
+    message: str = Field(..., description="The response message.")
+    added: int = Field(..., description="Number of new documents embedded.")
+    updated: int = Field(..., description="Number of changed documents re-embedded.")
+    unchanged: int = Field(..., description="Number of documents left as they were.")
+    removed: int = Field(..., description="Number of documents removed from the knowledge base.")
@@ -0,0 +1,13 @@
+from pydantic import BaseModel, Field
+
+from backend.models.build_embeddings_response import BuildEmbeddingsResponse
+
+
+class BuildJobResponse(BaseModel):
+    job_id: str = Field(..., description="Id of the build job.")
+    status: str = Field(..., description="queued, running, succeeded or failed.")
+    progress: float = Field(..., description="Progress of the build from 0 to 1.")
+    stage: str = Field(..., description="Current step of the build.")
+    result: BuildEmbeddingsResponse | None = Field(
+        None, description="Document counts of the build once it succeeded.")
+    error: str | None = Field(None, description="Why the build failed.")
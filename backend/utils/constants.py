@@ -1 +1,20 @@
 CONVERSATION_DOCUMENT_KEY = "conversation"
+
+# Knowledge base build jobs
+BUILD_JOB_WORKERS = 2
+BUILD_JOB_MAX_QUEUED = 64
+BUILD_JOB_MAX_FINISHED = 1000
+
+# Firebase ID token verification
+TOKEN_CACHE_MAX_ENTRIES = 10_000
+TOKEN_CACHE_MAX_TTL_SECONDS = 600
+CERT_DEFAULT_MAX_AGE_SECONDS = 3600
+CERT_MIN_REFRESH_SECONDS = 60
+
+# Turn history cache
+TURN_HISTORY_CACHE_MAX_USERS = 10_000
+TURN_HISTORY_CACHE_TTL_SECONDS = 600
+
+# Saving the model's message after the response is sent
+MESSAGE_SAVE_ATTEMPTS = 3
+MESSAGE_SAVE_RETRY_DELAY_SECONDS = 0.5
@@ -0,0 +1,34 @@
+import time
+from typing import Awaitable, TypeVar
+
+T = TypeVar("T")
+
+
+class StageTimer:
+    """
+        Wall time of each stage of a request, reported in a Server-Timing header.
+        Stages can overlap. "total" is the critical path and "serial" is what running the stages one after another would cost.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: dict[str, float] = {}
+
+    async def measure(self, name: str, awaitable: Awaitable[T]) -> T:
+        """
+            Await awaitable and record how long it took.
+        """
+        start = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.stages[name] = (time.perf_counter() - start) * 1000
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def server_timing_header(self) -> str:
+        metrics = [f"{name};dur={elapsed_ms:.1f}" for name, elapsed_ms in self.stages.items()]
+        metrics.append(f"serial;dur={sum(self.stages.values()):.1f}")
+        metrics.append(f"total;dur={self.total_ms():.1f}")
+        return ", ".join(metrics)
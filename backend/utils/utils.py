@@ -2,6 +2,7 @@ from langchain_core.documents import Document
 from backend.models.build_embeddings_request import BuildEmbeddingsRequest
 
 import time
+import json
 
 
 def convert_build_embeddings_request_to_docs(request: BuildEmbeddingsRequest, uid: str) -> list[Document]:
@@ -43,3 +44,14 @@ def create_turn_history_object(speaker: str, text: str) -> dict:
 def get_current_time_milliseconds() -> int:
     time_in_seconds = time.time()
     return int(round(time_in_seconds * 1000))
+
+
+def format_sse_event(data: dict, event: str = None) -> str:
+    """
+        Format data as a Server-Sent Event. data is sent as json.
+    """
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,89 @@
+import json
+import socket
+import statistics
+import threading
+import time
+from typing import Callable
+
+import uvicorn
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """
+        Nearest rank percentile of the values. pct is between 0 and 100.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize_latencies(latencies_ms: list[float]) -> dict:
+    """
+        Summary stats of latencies in milliseconds.
+    """
+    return {
+        "count": len(latencies_ms),
+        "mean_ms": round(statistics.fmean(latencies_ms), 3) if latencies_ms else 0.0,
+        "p50_ms": round(percentile(latencies_ms, 50), 3),
+        "p95_ms": round(percentile(latencies_ms, 95), 3),
+        "p99_ms": round(percentile(latencies_ms, 99), 3),
+    }
+
+
+def time_call(func: Callable, *args, **kwargs) -> tuple[object, float]:
+    """
+        Call func and return its result with the elapsed milliseconds.
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def write_json(path: str, data: dict):
+    """
+        Write the benchmark results as json. Prints them instead if path is empty.
+    """
+    text = json.dumps(data, indent=2)
+    if not path:
+        print(text)
+        return
+    with open(path, "w") as f:
+        f.write(text)
+    print(f"Results written to {path}")
+
+
+class BackgroundServer:
+    """
+        Runs an ASGI app with uvicorn in a background thread. Use it as a context manager.
+    """
+
+    def __init__(self, app, port: int = 0):
+        self.app = app
+        self.port = port or free_port()
+        self.server = uvicorn.Server(uvicorn.Config(
+            self.app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            if not self.thread.is_alive():
+                raise Exception(f"Server on port {self.port} failed to start.")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
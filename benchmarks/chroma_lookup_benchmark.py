@@ -0,0 +1,86 @@
+import argparse
+import random
+import shutil
+import tempfile
+
+import chromadb
+
+from benchmarks.bench_utils import summarize_latencies, time_call, write_json
+from lib.semantic_search.chroma_client import ChromaCollectionCache
+
+
+def legacy_exists(client: chromadb.ClientAPI, name: str) -> bool:
+    """
+        Existence check used before the collection cache. Lists every collection and scans the names.
+    """
+    return any(collection.name == name for collection in client.list_collections())
+
+
+def direct_exists(client: chromadb.ClientAPI, name: str) -> bool:
+    """
+        Existence check with a direct lookup by name and no handle cache.
+    """
+    return ChromaCollectionCache(client).exists(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the per query collection lookup cost with many user collections.")
+    parser.add_argument("--collections", type=int, default=10_000,
+                        help="Number of user collections to create.")
+    parser.add_argument("--lookups", type=int, default=200,
+                        help="Number of lookups per method.")
+    parser.add_argument("--path", type=str, default="",
+                        help="Chroma directory. A temporary one is created and removed if not set.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the json results. Printed if not set.")
+    args = parser.parse_args()
+
+    path = args.path or tempfile.mkdtemp(prefix="chroma_lookup_benchmark_")
+    try:
+        client = chromadb.PersistentClient(path=path)
+        names = [f"user-{index:06d}" for index in range(args.collections)]
+        existing = {collection.name for collection in client.list_collections()}
+        print(f"Creating {args.collections - len(existing & set(names))} collections in {path}...")
+        for name in names:
+            if name not in existing:
+                client.create_collection(name=name, embedding_function=None)
+
+        rng = random.Random(args.seed)
+        lookups = [rng.choice(names) for _ in range(args.lookups)]
+
+        cache = ChromaCollectionCache(client)
+        for name in lookups:
+            cache.get(name)
+
+        methods = {
+            "list_and_scan": lambda name: legacy_exists(client, name),
+            "get_by_name": lambda name: direct_exists(client, name),
+            "cached_handle": cache.exists,
+        }
+
+        results = {}
+        for method, exists in methods.items():
+            latencies = []
+            for name in lookups:
+                found, elapsed_ms = time_call(exists, name)
+                if not found:
+                    raise Exception(f"{method} did not find {name}")
+                latencies.append(elapsed_ms)
+            results[method] = summarize_latencies(latencies)
+            print(f"{method:>14}: p50 {results[method]['p50_ms']:.3f} ms, "
+                  f"p99 {results[method]['p99_ms']:.3f} ms")
+
+        write_json(args.output, {
+            "collections": args.collections,
+            "lookups": args.lookups,
+            "methods": results,
+        })
+    finally:
+        if not args.path:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
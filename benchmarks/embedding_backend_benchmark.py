@@ -0,0 +1,121 @@
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.bench_utils import summarize_latencies, time_call, write_json
+from lib.semantic_search.embedding_backends import create_embeddings, embedding_fingerprint
+import lib.utils.constants as constants
+
+DEFAULT_TEXTS = [
+    "What are my skills?",
+    "What is my work schedule?",
+    "Which programming languages do I know?",
+    "What projects have I worked on?",
+    "How do I prefer to communicate?",
+    "I have been writing Swift and Kotlin for mobile apps for six years.",
+    "My favourite food is ramen and I cook it every weekend.",
+    "I usually work from 9am to 5pm and keep Fridays free for deep work.",
+]
+
+BACKENDS = [
+    constants.EMBEDDING_BACKEND_TORCH,
+    constants.EMBEDDING_BACKEND_ONNX,
+    constants.EMBEDDING_BACKEND_ONNX_INT8,
+]
+
+
+def cosine_similarities(expected: np.ndarray, actual: np.ndarray) -> np.ndarray:
+    """
+        Row wise cosine similarity of two (n, dim) arrays.
+    """
+    norms = np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+    return np.sum(expected * actual, axis=1) / np.maximum(norms, 1e-12)
+
+
+def run_backend(backend: str, texts: list[str], runs: int, batch_texts: list[str]) -> tuple[dict, np.ndarray]:
+    """
+        Measure query latency and document throughput of one backend.
+        Returns the results and the query vectors for the drift comparison.
+    """
+    embeddings, load_ms = time_call(create_embeddings, backend)
+
+    # Warm up the session so the first query isn't measured
+    embeddings.embed_query(texts[0])
+
+    latencies = []
+    for _ in range(runs):
+        for text in texts:
+            _, elapsed_ms = time_call(embeddings.embed_query, text)
+            latencies.append(elapsed_ms)
+
+    start = time.perf_counter()
+    embeddings.embed_documents(batch_texts)
+    elapsed = time.perf_counter() - start
+
+    vectors = np.asarray([embeddings.embed_query(text)
+                         for text in texts], dtype=np.float32)
+    return {
+        "fingerprint": embedding_fingerprint(backend),
+        "load_ms": round(load_ms, 3),
+        "query": summarize_latencies(latencies),
+        "docs_per_sec": round(len(batch_texts) / elapsed, 1),
+    }, vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare query latency, throughput and cosine drift of the embedding backends.")
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS,
+                        help="Backends to compare. Drift is measured against the first one.")
+    parser.add_argument("--texts-file", type=str,
+                        help="File with one text per line. Uses a few sample texts if not set.")
+    parser.add_argument("--runs", type=int, default=20,
+                        help="Times every text is embedded as a query.")
+    parser.add_argument("--batch-size", type=int, default=512,
+                        help="Number of texts embedded at once for the throughput measurement.")
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the json results. Printed if not set.")
+    args = parser.parse_args()
+
+    texts = DEFAULT_TEXTS
+    if args.texts_file:
+        with open(args.texts_file) as f:
+            texts = [line.strip() for line in f if line.strip()]
+    batch_texts = (texts * (args.batch_size // len(texts) + 1))[:args.batch_size]
+
+    results = {}
+    reference_vectors = None
+    for backend in args.backends:
+        try:
+            result, vectors = run_backend(
+                backend, texts, args.runs, batch_texts)
+        except Exception as e:
+            print(f"{backend:>10}: skipped. {e}")
+            results[backend] = {"error": str(e)}
+            continue
+
+        if reference_vectors is None:
+            reference_vectors = vectors
+            reference_backend = backend
+        similarities = cosine_similarities(reference_vectors, vectors)
+        result["drift"] = {
+            "reference": reference_backend,
+            "mean_cosine": round(float(similarities.mean()), 6),
+            "min_cosine": round(float(similarities.min()), 6),
+        }
+        results[backend] = result
+        print(f"{backend:>10}: query p50 {result['query']['p50_ms']:.2f} ms, "
+              f"{result['docs_per_sec']:.1f} docs/sec, min cosine vs {reference_backend} {result['drift']['min_cosine']:.4f}")
+
+    write_json(args.output, {
+        "model": constants.EMBEDDING_MODEL_NAME,
+        "texts": len(texts),
+        "runs": args.runs,
+        "batch_size": args.batch_size,
+        "backends": results,
+    })
+
+
+if __name__ == "__main__":
+    main()
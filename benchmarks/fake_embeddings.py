@@ -0,0 +1,43 @@
+import re
+import zlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbeddings(Embeddings):
+    """
+        Deterministic stand-in for the embedding model. No model download, no network.
+        Each word is hashed to one of dim buckets with a sign (feature hashing) and the vector is unit length,
+        so texts sharing words have a high cosine similarity like they would with a real model.
+        Same text, same vector, in every process.
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+        # word -> (bucket, sign). Hashing is the slow part of embedding big knowledge bases.
+        self._features: dict[str, tuple[int, float]] = {}
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text).tolist() for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text).tolist()
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in _WORD_PATTERN.findall(text.lower()):
+            bucket, sign = self._feature(word)
+            vector[bucket] += sign
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _feature(self, word: str) -> tuple[int, float]:
+        feature = self._features.get(word)
+        if feature is None:
+            hashed = zlib.crc32(word.encode("utf-8"))
+            feature = (hashed % self.dim, 1.0 if hashed & 0x80000000 else -1.0)
+            self._features[word] = feature
+        return feature
@@ -0,0 +1,139 @@
+import asyncio
+import copy
+import uuid
+
+from google.cloud.firestore import Query
+
+
+class InMemoryFirestore:
+    """
+        Stand-in for the firestore_async client that keeps the documents in memory.
+        Covers what the backend uses: collection / document references, set, get, order_by + limit queries and batches.
+        Every call waits latency_seconds, like a round trip to Firestore would. Used by load tests.
+    """
+
+    def __init__(self, latency_seconds: float = 0.0):
+        self.latency_seconds = latency_seconds
+        # collection path -> document id -> document
+        self.collections: dict[str, dict[str, dict]] = {}
+        self.reads = 0
+        self.writes = 0
+
+    def collection(self, name: str) -> "InMemoryCollectionReference":
+        return InMemoryCollectionReference(self, name)
+
+    def batch(self) -> "InMemoryWriteBatch":
+        return InMemoryWriteBatch(self)
+
+    def stats(self) -> dict:
+        return {
+            "collections": len(self.collections),
+            "documents": sum(len(documents) for documents in self.collections.values()),
+            "reads": self.reads,
+            "writes": self.writes,
+        }
+
+    async def _round_trip(self):
+        if self.latency_seconds > 0:
+            await asyncio.sleep(self.latency_seconds)
+
+    def _write(self, collection_path: str, document_id: str, data: dict, merge: bool):
+        documents = self.collections.setdefault(collection_path, {})
+        document = documents.get(document_id) if merge else None
+        documents[document_id] = {**document, **copy.deepcopy(data)} if document else copy.deepcopy(data)
+        self.writes += 1
+
+
+class InMemoryDocumentSnapshot:
+    def __init__(self, document_id: str, data: dict | None):
+        self.id = document_id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> dict | None:
+        return copy.deepcopy(self._data)
+
+
+class InMemoryDocumentReference:
+    def __init__(self, client: InMemoryFirestore, collection_path: str, document_id: str):
+        self._client = client
+        self._collection_path = collection_path
+        self.id = document_id
+
+    @property
+    def path(self) -> str:
+        return f"{self._collection_path}/{self.id}"
+
+    def collection(self, name: str) -> "InMemoryCollectionReference":
+        return InMemoryCollectionReference(self._client, f"{self.path}/{name}")
+
+    async def set(self, document_data: dict, merge: bool = False):
+        await self._client._round_trip()
+        self._client._write(self._collection_path, self.id, document_data, merge)
+
+    async def get(self) -> InMemoryDocumentSnapshot:
+        await self._client._round_trip()
+        self._client.reads += 1
+        documents = self._client.collections.get(self._collection_path, {})
+        return InMemoryDocumentSnapshot(self.id, documents.get(self.id))
+
+
+class InMemoryQuery:
+    def __init__(self, client: InMemoryFirestore, collection_path: str,
+                 orders: tuple = (), limit_count: int = None):
+        self._client = client
+        self._collection_path = collection_path
+        self._orders = orders
+        self._limit = limit_count
+
+    def order_by(self, field_path: str, direction: str = Query.ASCENDING) -> "InMemoryQuery":
+        return InMemoryQuery(self._client, self._collection_path,
+                             self._orders + ((field_path, direction),), self._limit)
+
+    def limit(self, count: int) -> "InMemoryQuery":
+        return InMemoryQuery(self._client, self._collection_path, self._orders, count)
+
+    async def get(self) -> list[InMemoryDocumentSnapshot]:
+        await self._client._round_trip()
+        documents = list(self._client.collections.get(self._collection_path, {}).items())
+
+        # Firestore leaves out documents without the ordered fields. Last order first so the first one wins.
+        for field_path, direction in reversed(self._orders):
+            documents = [(document_id, data) for document_id, data in documents if field_path in data]
+            documents.sort(key=lambda item: item[1][field_path], reverse=direction == Query.DESCENDING)
+        if self._limit is not None:
+            documents = documents[:self._limit]
+
+        self._client.reads += len(documents)
+        return [InMemoryDocumentSnapshot(document_id, data) for document_id, data in documents]
+
+
+class InMemoryCollectionReference(InMemoryQuery):
+    def __init__(self, client: InMemoryFirestore, path: str):
+        super().__init__(client, path)
+        self.path = path
+
+    def document(self, document_id: str = None) -> InMemoryDocumentReference:
+        return InMemoryDocumentReference(self._client, self.path, document_id or uuid.uuid4().hex)
+
+
+class InMemoryWriteBatch:
+    """
+        Writes are applied together on commit, in one round trip.
+    """
+
+    def __init__(self, client: InMemoryFirestore):
+        self._client = client
+        self._writes: list[tuple[InMemoryDocumentReference, dict, bool]] = []
+
+    def set(self, reference: InMemoryDocumentReference, document_data: dict, merge: bool = False):
+        self._writes.append((reference, document_data, merge))
+
+    async def commit(self):
+        await self._client._round_trip()
+        for reference, document_data, merge in self._writes:
+            self._client._write(reference._collection_path, reference.id, document_data, merge)
+        self._writes = []
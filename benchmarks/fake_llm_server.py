@@ -0,0 +1,221 @@
+import argparse
+import asyncio
+import json
+import re
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from benchmarks.bench_utils import BackgroundServer
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]|\s+")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_PATTERN.findall(text)
+
+
+def render_chat_template(messages: list[dict]) -> str:
+    """
+        Llama 3 style chat template. The server caches and compares prompts in this form.
+    """
+    parts = ["<|begin_of_text|>"]
+    for message in messages:
+        parts.append(
+            f"<|start_header_id|>{message['role']}<|end_header_id|>\n\n{message['content']}<|eot_id|>")
+    parts.append("<|start_header_id|>assistant<|end_header_id|>\n\n")
+    return "".join(parts)
+
+
+class PrefixCacheSimulator:
+    """
+        Prompt cache of a llama.cpp / Ollama style server with num_slots parallel slots.
+        A request goes to the slot sharing the longest prefix with it if that prefix is at least
+        min_similarity of the prompt, like llama.cpp's slot_prompt_similarity. Otherwise it takes the least
+        recently used slot, so a shared system prompt alone doesn't steal another conversation's slot.
+        Only the tokens after the shared prefix are prefilled. The slot then holds the prompt and the answer.
+    """
+
+    def __init__(self, num_slots: int, min_similarity: float = 0.5):
+        self.num_slots = num_slots
+        self.min_similarity = min_similarity
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.slots: list[list[str]] = [[] for _ in range(self.num_slots)]
+            self.slot_used_at = [0.0] * self.num_slots
+            self.requests = 0
+            self.prompt_tokens = 0
+            self.cached_tokens = 0
+            self.completion_tokens = 0
+
+    def prefill(self, tokens: list[str]) -> tuple[int, int]:
+        """
+            Return (slot, number of cached tokens) and claim the slot for the prompt.
+        """
+        with self.lock:
+            best_slot, best_prefix = None, 0
+            for slot, cached in enumerate(self.slots):
+                prefix = _common_prefix_length(cached, tokens)
+                if prefix > best_prefix:
+                    best_slot, best_prefix = slot, prefix
+            if best_slot is None or best_prefix < self.min_similarity * len(tokens):
+                best_slot = min(range(self.num_slots), key=lambda slot: self.slot_used_at[slot])
+                best_prefix = _common_prefix_length(self.slots[best_slot], tokens)
+
+            self.slots[best_slot] = list(tokens)
+            self.slot_used_at[best_slot] = time.monotonic()
+            self.requests += 1
+            self.prompt_tokens += len(tokens)
+            self.cached_tokens += best_prefix
+            return best_slot, best_prefix
+
+    def finish(self, slot: int, completion_tokens: list[str]):
+        with self.lock:
+            self.slots[slot].extend(completion_tokens)
+            self.completion_tokens += len(completion_tokens)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "prefilled_tokens": self.prompt_tokens - self.cached_tokens,
+                "reuse_ratio": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+                "completion_tokens": self.completion_tokens,
+            }
+
+
+def create_app(num_slots: int = 4,
+               prefill_ms_per_token: float = 0.2,
+               decode_ms_per_token: float = 5.0,
+               answer_words: int = 24) -> FastAPI:
+    """
+        OpenAI compatible /v1/chat/completions stand-in. Sleeps like a real server would:
+        prefill_ms_per_token for each uncached prompt token and decode_ms_per_token for each answer token.
+    """
+    app = FastAPI(title="Fake LLM server")
+    cache = PrefixCacheSimulator(num_slots)
+    app.state.cache = cache
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt_tokens = tokenize(render_chat_template(body["messages"]))
+        slot, cached_tokens = cache.prefill(prompt_tokens)
+        await asyncio.sleep((len(prompt_tokens) - cached_tokens) * prefill_ms_per_token / 1000)
+
+        words = [f"word{index}" for index in range(answer_words)]
+        answer_tokens = tokenize(" ".join(words) + "<|eot_id|>")
+        usage = {
+            "prompt_tokens": len(prompt_tokens),
+            "completion_tokens": len(words),
+            "total_tokens": len(prompt_tokens) + len(words),
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model", "fake")
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(words) * decode_ms_per_token / 1000)
+            cache.finish(slot, answer_tokens)
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        async def event_stream():
+            for index, word in enumerate(words):
+                await asyncio.sleep(decode_ms_per_token / 1000)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": word if index == 0 else f" {word}"},
+                        "finish_reason": None,
+                    }],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            cache.finish(slot, answer_tokens)
+            # Like OpenAI, the usage comes in a last chunk without choices when the client asks for it
+            if (body.get("stream_options") or {}).get("include_usage"):
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                         "model": model, "choices": [], "usage": usage}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    def stats():
+        return cache.stats()
+
+    @app.post("/reset")
+    def reset():
+        cache.reset()
+        return cache.stats()
+
+    return app
+
+
+class FakeLLMServer(BackgroundServer):
+    """
+        Runs the fake server in a background thread. base_url is what an OpenAI client needs.
+    """
+
+    def __init__(self, port: int = 0, **app_options):
+        super().__init__(create_app(**app_options), port)
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/v1"
+
+    @property
+    def cache(self) -> PrefixCacheSimulator:
+        return self.app.state.cache
+
+
+def _common_prefix_length(first: list[str], second: list[str]) -> int:
+    length = 0
+    for first_token, second_token in zip(first, second):
+        if first_token != second_token:
+            break
+        length += 1
+    return length
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="OpenAI compatible stand-in for the local llm server that simulates prompt prefix caching.")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--slots", type=int, default=4)
+    parser.add_argument("--prefill-ms-per-token", type=float, default=0.2)
+    parser.add_argument("--decode-ms-per-token", type=float, default=5.0)
+    args = parser.parse_args()
+
+    app = create_app(num_slots=args.slots, prefill_ms_per_token=args.prefill_ms_per_token,
+                     decode_ms_per_token=args.decode_ms_per_token)
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
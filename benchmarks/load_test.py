@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+from contextlib import asynccontextmanager
+
+import httpx
+
+import lib.utils.constants as constants
+from backend.firebase.token_verifier import CertStore, FirebaseTokenVerifier
+from benchmarks.bench_utils import BackgroundServer, summarize_latencies, write_json
+from benchmarks.fake_embeddings import HashingEmbeddings
+from benchmarks.fake_firestore import InMemoryFirestore
+from benchmarks.fake_llm_server import FakeLLMServer
+from benchmarks.local_token_signer import LocalTokenSigner
+from benchmarks.retrieval_benchmark import synthetic_knowledge_base, synthetic_queries, synthetic_vocabulary
+
+CHAT = "/chat"
+CHAT_STREAM = "/chat/stream"
+BUILD_EMBEDDINGS = "/build-embeddings"
+
+
+class EventLoopLagMonitor:
+    """
+        Sleeps interval_seconds over and over on the server's event loop. Waking up late means something blocked the loop.
+    """
+
+    def __init__(self, interval_seconds: float = 0.01):
+        self.interval_seconds = interval_seconds
+        self.samples_ms: list[float] = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def take_samples(self) -> list[float]:
+        """
+            Return the lag samples so far and start over.
+        """
+        samples, self.samples_ms = self.samples_ms, []
+        return samples
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval_seconds)
+            lag = time.perf_counter() - start - self.interval_seconds
+            self.samples_ms.append(max(lag, 0.0) * 1000)
+
+
+class RequestStats:
+    """
+        Latency and time to first byte of the requests to one endpoint.
+    """
+
+    def __init__(self):
+        self.latencies_ms: list[float] = []
+        self.ttfb_ms: list[float] = []
+        self.errors = 0
+        self.status_codes: dict[int, int] = {}
+
+    def summary(self, elapsed_seconds: float) -> dict:
+        return {
+            "requests": len(self.latencies_ms),
+            "errors": self.errors,
+            "status_codes": {str(code): count for code, count in sorted(self.status_codes.items())},
+            "rps": round(len(self.latencies_ms) / elapsed_seconds, 2) if elapsed_seconds > 0 else 0.0,
+            "latency": summarize_latencies(self.latencies_ms),
+            "ttfb": summarize_latencies(self.ttfb_ms),
+        }
+
+
+def install_local_firebase(signer: LocalTokenSigner, firestore: InMemoryFirestore) -> types.ModuleType:
+    """
+        Put a stand-in for backend.firebase.firebase_client in place, with the same attributes the backend uses.
+        Tokens signed by signer verify and firestore holds the data. Must run before backend.main is imported.
+    """
+    module = types.ModuleType("backend.firebase.firebase_client")
+    module.firestore_async = firestore
+    module.token_verifier = FirebaseTokenVerifier(
+        project_id=signer.project_id, cert_store=CertStore(fetch_certs=signer.fetch_certs))
+    sys.modules[module.__name__] = module
+
+    import backend.firebase
+    backend.firebase.firebase_client = module
+    return module
+
+
+def create_backend_app(monitor: EventLoopLagMonitor):
+    """
+        The real backend app, with the stand-in embedding model and the lag monitor running on its event loop.
+    """
+    import backend.main as main
+    from lib.augmented_generation.engine_registry import EngineRegistry
+    from lib.semantic_search.query_embedding_cache import CachedQueryEmbeddings
+
+    # No query embedding cache on disk. It would outlive the run.
+    embeddings = CachedQueryEmbeddings(HashingEmbeddings(), model_name="hashing", disk_path="")
+    main.EngineRegistry = lambda: EngineRegistry(embeddings=embeddings)
+
+    lifespan = main.app.router.lifespan_context
+
+    @asynccontextmanager
+    async def lifespan_with_monitor(app):
+        async with lifespan(app) as state:
+            monitor.start()
+            yield state
+            monitor.stop()
+
+    main.app.router.lifespan_context = lifespan_with_monitor
+    return main.app
+
+
+async def timed_request(client: httpx.AsyncClient, stats: RequestStats, method: str, url: str, **kwargs) -> bytes | None:
+    """
+        Send one request and read the whole body. Returns the body or None if the request failed.
+    """
+    start = time.perf_counter()
+    first_byte_ms = None
+    chunks = []
+    try:
+        async with client.stream(method, url, **kwargs) as response:
+            async for chunk in response.aiter_bytes():
+                if first_byte_ms is None:
+                    first_byte_ms = (time.perf_counter() - start) * 1000
+                chunks.append(chunk)
+            status_code = response.status_code
+    except httpx.HTTPError as e:
+        print(f"{method} {url} failed: {e}")
+        stats.errors += 1
+        return None
+
+    latency_ms = (time.perf_counter() - start) * 1000
+    stats.status_codes[status_code] = stats.status_codes.get(status_code, 0) + 1
+    if status_code >= 400:
+        stats.errors += 1
+        return None
+    stats.latencies_ms.append(latency_ms)
+    stats.ttfb_ms.append(first_byte_ms if first_byte_ms is not None else latency_ms)
+    return b"".join(chunks)
+
+
+async def build_knowledge_base(client: httpx.AsyncClient, headers: dict, records: list[dict],
+                               stats: dict[str, RequestStats], poll_interval: float) -> float | None:
+    """
+        Submit a build and poll the job until it's done. Returns the seconds until it succeeded or None.
+    """
+    start = time.perf_counter()
+    body = await timed_request(client, stats[BUILD_EMBEDDINGS], "POST", BUILD_EMBEDDINGS,
+                               json={"data": records}, headers=headers)
+    if body is None:
+        return None
+
+    job = json.loads(body)
+    while job["status"] not in ("succeeded", "failed"):
+        await asyncio.sleep(poll_interval)
+        body = await timed_request(client, stats["/build-embeddings/{job_id}"], "GET",
+                                   f"{BUILD_EMBEDDINGS}/{job['job_id']}", headers=headers)
+        if body is None:
+            return None
+        job = json.loads(body)
+    return time.perf_counter() - start if job["status"] == "succeeded" else None
+
+
+async def chat_until(client: httpx.AsyncClient, headers: dict, queries: list[str], deadline: float,
+                     stats: dict[str, RequestStats], stream_ratio: float, think_seconds: float, rng: random.Random):
+    """
+        One virtual user chatting until deadline. Each message goes to /chat/stream with probability stream_ratio.
+    """
+    while time.perf_counter() < deadline:
+        endpoint = CHAT_STREAM if rng.random() < stream_ratio else CHAT
+        await timed_request(client, stats[endpoint], "POST", endpoint,
+                            json={"query": rng.choice(queries)}, headers=headers)
+        if think_seconds > 0:
+            await asyncio.sleep(think_seconds)
+
+
+async def run_load(base_url: str, signer: LocalTokenSigner, monitor: EventLoopLagMonitor, args) -> dict:
+    """
+        Every virtual user builds a knowledge base, then all of them chat for args.duration seconds.
+    """
+    rng = random.Random(args.seed)
+    vocabulary = synthetic_vocabulary(2_000, rng)
+    users = []
+    for index in range(args.users):
+        uid = f"load-user-{index:04d}"
+        records = [record.model_dump() for record in synthetic_knowledge_base(args.knowledge_base_size, vocabulary, rng)]
+        users.append({
+            "headers": {"Authorization": f"Bearer {signer.sign(uid)}"},
+            "records": records,
+            "queries": synthetic_queries(20, vocabulary, rng),
+            "rng": random.Random(args.seed + index),
+        })
+
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        # Build phase
+        build_stats = {BUILD_EMBEDDINGS: RequestStats(), "/build-embeddings/{job_id}": RequestStats()}
+        monitor.take_samples()
+        start = time.perf_counter()
+        build_seconds = await asyncio.gather(*[
+            build_knowledge_base(client, user["headers"], user["records"], build_stats, args.poll_interval)
+            for user in users])
+        build_elapsed = time.perf_counter() - start
+        build_lag = monitor.take_samples()
+
+        succeeded = [seconds * 1000 for seconds in build_seconds if seconds is not None]
+        print(f"Built {len(succeeded)}/{len(users)} knowledge bases in {build_elapsed:.1f} s")
+
+        # Chat phase
+        chat_stats = {CHAT: RequestStats(), CHAT_STREAM: RequestStats()}
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            chat_until(client, user["headers"], user["queries"], start + args.duration, chat_stats,
+                       args.stream_ratio, args.think_ms / 1000, user["rng"])
+            for user in users])
+        chat_elapsed = time.perf_counter() - start
+        chat_lag = monitor.take_samples()
+
+    completed = sum(len(stats.latencies_ms) for stats in chat_stats.values())
+    return {
+        "build": {
+            "seconds": round(build_elapsed, 3),
+            "knowledge_bases_built": len(succeeded),
+            "time_to_built": summarize_latencies(succeeded),
+            "endpoints": {endpoint: stats.summary(build_elapsed) for endpoint, stats in build_stats.items()},
+            "event_loop_lag": summarize_lag(build_lag),
+        },
+        "chat": {
+            "seconds": round(chat_elapsed, 3),
+            "rps": round(completed / chat_elapsed, 2) if chat_elapsed > 0 else 0.0,
+            "endpoints": {endpoint: stats.summary(chat_elapsed) for endpoint, stats in chat_stats.items()},
+            "event_loop_lag": summarize_lag(chat_lag),
+        },
+    }
+
+
+def summarize_lag(samples_ms: list[float]) -> dict:
+    return {**summarize_latencies(samples_ms), "max_ms": round(max(samples_ms, default=0.0), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test /build-embeddings, /chat and /chat/stream of the real backend app with local stand-ins "
+                    "for Firebase (in-memory Firestore, locally signed ID tokens), the llm server and the embedding model.")
+    parser.add_argument("--users", type=int, default=20, help="Concurrent virtual users.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of the chat phase.")
+    parser.add_argument("--stream-ratio", type=float, default=0.5,
+                        help="Share of the messages sent to /chat/stream instead of /chat.")
+    parser.add_argument("--think-ms", type=float, default=0, help="Pause of a user between two messages.")
+    parser.add_argument("--knowledge-base-size", type=int, default=200,
+                        help="Knowledge base objects each user builds.")
+    parser.add_argument("--firestore-latency-ms", type=float, default=20,
+                        help="Round trip time of every Firestore call.")
+    parser.add_argument("--llm-prefill-ms-per-token", type=float, default=0.2)
+    parser.add_argument("--llm-decode-ms-per-token", type=float, default=20,
+                        help="Time per generated token. 20 ms is 50 tokens/sec.")
+    parser.add_argument("--llm-answer-words", type=int, default=60)
+    parser.add_argument("--poll-interval", type=float, default=0.2,
+                        help="Seconds between two build job status polls.")
+    parser.add_argument("--timeout", type=float, default=120, help="Request timeout in seconds.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the json results. Printed if not set.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="load_test_")
+    # Indices and vectors of the virtual users go in a temporary directory
+    constants.INDEX_DIR = directory
+    constants.CHROMA_PATH = f"{directory}/chroma"
+    # The token stats log a line per prompt
+    constants.PROMPT_TOKEN_STATS_ENABLED = False
+
+    signer = LocalTokenSigner()
+    firestore = InMemoryFirestore(latency_seconds=args.firestore_latency_ms / 1000)
+    install_local_firebase(signer, firestore)
+    monitor = EventLoopLagMonitor()
+
+    llm_server = FakeLLMServer(
+        prefill_ms_per_token=args.llm_prefill_ms_per_token, decode_ms_per_token=args.llm_decode_ms_per_token,
+        answer_words=args.llm_answer_words)
+    # The llm clients are created on import from the base url
+    constants.LLM_BACKEND = constants.LLM_BACKEND_OLLAMA
+    constants.LOCAL_LLM_BASE_URL = llm_server.base_url
+
+    try:
+        with llm_server, BackgroundServer(create_backend_app(monitor)) as backend_server:
+            results = asyncio.run(run_load(backend_server.url, signer, monitor, args))
+            llm_stats = llm_server.cache.stats()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    chat = results["chat"]
+    for endpoint, summary in chat["endpoints"].items():
+        print(f"{endpoint:>12}: {summary['requests']} requests, {summary['errors']} errors, "
+              f"p50 {summary['latency']['p50_ms']:.1f} ms, p99 {summary['latency']['p99_ms']:.1f} ms, "
+              f"ttfb p50 {summary['ttfb']['p50_ms']:.1f} ms")
+    print(f"Chat: {chat['rps']} requests/sec. Event loop lag p99 {chat['event_loop_lag']['p99_ms']:.1f} ms, "
+          f"max {chat['event_loop_lag']['max_ms']:.1f} ms")
+
+    write_json(args.output, {
+        "config": vars(args),
+        **results,
+        "firestore": firestore.stats(),
+        "llm": llm_stats,
+    })
+
+
+if __name__ == "__main__":
+    main()
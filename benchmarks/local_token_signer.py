@@ -0,0 +1,62 @@
+import time
+import uuid
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.auth import crypt, jwt
+
+from backend.firebase.token_verifier import ID_TOKEN_ISSUER_PREFIX
+
+
+class LocalTokenSigner:
+    """
+        Stand-in for Firebase Auth that signs ID tokens with a local RSA key.
+        Pass fetch_certs to CertStore to verify its tokens without Firebase. Used by tests, benchmarks and load tests.
+    """
+
+    def __init__(self, project_id: str = "orcal-ai-local", cert_max_age: float = 3600):
+        self.project_id = project_id
+        self.cert_max_age = cert_max_age
+        self.fetch_count = 0
+        self.rotate()
+
+    def rotate(self):
+        """
+            Switch to a new signing key, like Google does periodically. Old tokens stop verifying.
+        """
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.kid = uuid.uuid4().hex
+        self.public_key_pem = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode("utf-8")
+        private_key_pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        self.signer = crypt.RSASigner.from_string(private_key_pem, key_id=self.kid)
+
+    def fetch_certs(self) -> tuple[dict[str, str], float]:
+        """
+            Same shape as fetch_google_certs.
+        """
+        self.fetch_count += 1
+        return {self.kid: self.public_key_pem}, self.cert_max_age
+
+    def sign(self, uid: str, expires_in: float = 3600, **claims) -> str:
+        """
+            Return an ID token for uid. Extra claims override the defaults.
+        """
+        now = int(time.time())
+        payload = {
+            "iss": ID_TOKEN_ISSUER_PREFIX + self.project_id,
+            "aud": self.project_id,
+            "auth_time": now,
+            "iat": now,
+            "exp": now + int(expires_in),
+            "sub": uid,
+            "user_id": uid,
+        }
+        payload.update(claims)
+        return jwt.encode(self.signer, payload).decode("utf-8")
@@ -0,0 +1,115 @@
+import argparse
+import random
+from collections import deque
+
+from langchain_core.documents import Document
+
+import lib.utils.constants as constants
+import lib.utils.prompt_utils as prompt_utils
+from benchmarks.bench_utils import summarize_latencies, time_call, write_json
+from benchmarks.fake_llm_server import FakeLLMServer
+
+TOPICS = ["python", "flutter", "kotlin", "fastapi", "firebase", "docker", "schedule", "gym", "reading", "travel"]
+QUERIES = [
+    "What are my skills?", "What should I learn next?", "What is my work schedule?",
+    "Which projects did I work on?", "How should I plan my weekend?", "What are my hobbies?",
+    "Can you summarize my experience?", "What should I focus on this week?",
+]
+
+
+def synthetic_knowledge_base(size: int, rng: random.Random) -> list[Document]:
+    documents = []
+    for index in range(size):
+        topic = rng.choice(TOPICS)
+        details = " ".join(rng.choice(TOPICS + ["worked", "on", "with", "and", "every", "day"])
+                           for _ in range(rng.randint(40, 120)))
+        documents.append(Document(page_content=details, metadata={
+            "id": index, "title": f"{topic.title()} note {index}", "uid": "benchmark"}))
+    return documents
+
+
+def retrieve(knowledge_base: list[Document], rng: random.Random) -> list[Document]:
+    """
+        Stand-in for the rrf search. The results carry the same metadata the real search adds.
+    """
+    results = []
+    for rank, document in enumerate(rng.sample(knowledge_base, constants.DEFAULT_ITEM_LIMIT), start=1):
+        metadata = {**document.metadata, "bm25_rank": rank, "semantic_rank": rank + 1,
+                    "rrf_score": round(2 / (constants.K_VALUE + rank), 5)}
+        results.append(Document(page_content=document.page_content, metadata=metadata))
+    return results
+
+
+def run_conversations(generate, create_prompt, users: int, turns: int, history_limit: int,
+                      knowledge_base: list[Document], seed: int) -> list[float]:
+    """
+        Every user sends turns messages. Users take turns like concurrent conversations would.
+        Returns the latency of each request in milliseconds.
+    """
+    rng = random.Random(seed)
+    histories = [deque(maxlen=history_limit) for _ in range(users)]
+    latencies = []
+    for _ in range(turns):
+        for history in histories:
+            query = rng.choice(QUERIES)
+            prompt = create_prompt(query, retrieve(knowledge_base, rng), list(history))
+            answer, elapsed_ms = time_call(generate, prompt)
+            latencies.append(elapsed_ms)
+
+            history.append({"role": constants.SPEAKER_USER, "parts": [{"text": query}]})
+            history.append({"role": constants.SPEAKER_MODEL, "parts": [{"text": answer}]})
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure how much of each prompt the llm server can reuse from its prompt cache, "
+                    "for the single string prompt and the structured chat messages.")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--history-limit", type=int, default=constants.TURN_HISTORY_LIMIT,
+                        help="Messages of turn history sent with each request.")
+    parser.add_argument("--slots", type=int, default=4,
+                        help="Parallel slots of the fake server. Each keeps one cached prompt.")
+    parser.add_argument("--prefill-ms-per-token", type=float, default=0.2)
+    parser.add_argument("--decode-ms-per-token", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the json results. Printed if not set.")
+    args = parser.parse_args()
+
+    constants.PROMPT_TOKEN_STATS_ENABLED = False
+    knowledge_base = synthetic_knowledge_base(200, random.Random(args.seed))
+
+    with FakeLLMServer(num_slots=args.slots, prefill_ms_per_token=args.prefill_ms_per_token,
+                       decode_ms_per_token=args.decode_ms_per_token) as server:
+        # The clients are created on import from the base url
+        constants.LOCAL_LLM_BASE_URL = server.base_url
+        from lib.utils.local_ai_utils import generate_local_llm_response
+
+        modes = {
+            "single_prompt": prompt_utils.get_personal_assistant_rag_prompt,
+            "chat_messages": prompt_utils.get_personal_assistant_rag_messages,
+        }
+        results = {}
+        for mode, create_prompt in modes.items():
+            server.cache.reset()
+            latencies = run_conversations(
+                generate_local_llm_response, create_prompt, args.users, args.turns, args.history_limit,
+                knowledge_base, args.seed)
+            results[mode] = {**server.cache.stats(), "latency": summarize_latencies(latencies)}
+            print(f"{mode:>14}: reused {results[mode]['reuse_ratio']:.1%} of "
+                  f"{results[mode]['prompt_tokens']} prompt tokens, "
+                  f"p50 {results[mode]['latency']['p50_ms']:.1f} ms")
+
+    write_json(args.output, {
+        "users": args.users,
+        "turns": args.turns,
+        "history_limit": args.history_limit,
+        "slots": args.slots,
+        "modes": results,
+    })
+
+
+if __name__ == "__main__":
+    main()
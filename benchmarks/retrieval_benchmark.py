@@ -0,0 +1,236 @@
+import argparse
+import itertools
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import lib.utils.constants as constants
+from backend.models.build_embeddings_request import BuildEmbeddingsRequest, InfoToEmbed
+from backend.utils.utils import convert_build_embeddings_request_to_docs, create_turn_history_object
+from benchmarks.bench_utils import summarize_latencies, time_call, write_json
+from benchmarks.fake_embeddings import HashingEmbeddings
+from lib.bm25_search.bm25_index_format import open_bm25_index
+from lib.bm25_search.inverted_index_external_docs import InvertedIndexExternalDocs
+from lib.hybrid_search.rrf_search_external_docs import RRFSearchExternalDocs
+from lib.semantic_search.chroma_client import get_chroma_client
+from lib.semantic_search.embedding_backends import create_embeddings
+from lib.semantic_search.query_embedding_cache import CachedQueryEmbeddings
+from lib.semantic_search.semantic_search_external_docs import SemanticSearchExternalDocs
+from lib.semantic_search.user_vector_store_cache import USER_VECTOR_STORE_CACHE
+from lib.utils.prompt_utils import count_tokens, get_personal_assistant_rag_messages
+from lib.utils.text_utils import tokenize_text
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows. Peak RSS is reported as null there.
+    resource = None
+
+EMBEDDERS = ["fake", "model"]
+
+# Words every knowledge base shares. Stop words are in there so the tokenizer has something to drop.
+COMMON_WORDS = [
+    "i", "my", "the", "a", "and", "to", "of", "in", "on", "with", "for", "every", "usually", "worked",
+    "working", "projects", "skills", "learning", "prefer", "meetings", "schedule", "weekend", "team",
+    "python", "flutter", "kotlin", "swift", "fastapi", "firebase", "docker", "gym", "reading", "travel",
+]
+SYLLABLES = ["ka", "lo", "mi", "ten", "ra", "vos", "el", "dun", "pi", "sor", "na", "qua", "bel", "tri", "zo"]
+
+
+def synthetic_vocabulary(size: int, rng: random.Random) -> list[str]:
+    """
+        Made up words on top of the common ones, so the index has a realistic number of distinct terms.
+    """
+    words = set(COMMON_WORDS)
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def synthetic_knowledge_base(size: int, vocabulary: list[str], rng: random.Random) -> list[InfoToEmbed]:
+    """
+        size knowledge base objects with 20 to 120 word details. Word frequencies follow a zipf curve like real text.
+    """
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    records = []
+    for index in range(size):
+        title = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(2, 5)))
+        details = " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(20, 120)))
+        records.append(InfoToEmbed(id=index, title=title.capitalize(), details=f"{details}."))
+    return records
+
+
+def synthetic_queries(count: int, vocabulary: list[str], rng: random.Random) -> list[str]:
+    # Distinct queries, so the query embedding cache doesn't hide the search cost
+    return [f"What about {' '.join(rng.sample(vocabulary, rng.randint(2, 6)))}?" for _ in range(count)]
+
+
+def peak_rss_mb() -> float | None:
+    """
+        Peak resident set size of the process so far.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on linux
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def measure_calls(func: Callable, inputs: list) -> dict:
+    """
+        Call func with every input. Returns the latency summary, the calls per second and the peak RSS after the calls.
+    """
+    latencies = []
+    start = time.perf_counter()
+    for item in inputs:
+        _, elapsed_ms = time_call(func, item)
+        latencies.append(elapsed_ms)
+    elapsed = time.perf_counter() - start
+    return {
+        "latency": summarize_latencies(latencies),
+        "per_sec": round(len(inputs) / elapsed, 1) if elapsed > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def measure_build(func: Callable, num_docs: int) -> dict:
+    """
+        Run one build. Returns the seconds, the docs per second and the peak RSS after the build.
+    """
+    _, elapsed_ms = time_call(func)
+    return {
+        "seconds": round(elapsed_ms / 1000, 3),
+        "docs_per_sec": round(num_docs / (elapsed_ms / 1000), 1) if elapsed_ms > 0 else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_size(size: int, embeddings, vocabulary: list[str], args) -> dict:
+    """
+        Build the indices of one synthetic knowledge base in a temporary directory and measure every stage.
+    """
+    rng = random.Random(args.seed + size)
+    uid = f"benchmark-{size}"
+    records, generate_ms = time_call(synthetic_knowledge_base, size, vocabulary, rng)
+    documents = convert_build_embeddings_request_to_docs(BuildEmbeddingsRequest(data=records), uid)
+    queries = synthetic_queries(args.queries, vocabulary, rng)
+    # The rrf search gets its own queries, so it embeds them like a real request would
+    rrf_queries = synthetic_queries(args.queries, vocabulary, rng)
+    texts = [f"{record.title} {record.details}" for record in records[:args.tokenize_texts]]
+    print(f"Generated {size} records in {generate_ms / 1000:.1f} s")
+
+    directory = tempfile.mkdtemp(prefix="retrieval_benchmark_")
+    constants.INDEX_DIR = directory
+    USER_VECTOR_STORE_CACHE.clear()
+    try:
+        inverted_index = InvertedIndexExternalDocs()
+        semantic_search = SemanticSearchExternalDocs(
+            embeddings=embeddings, chroma_client=get_chroma_client(f"{directory}/chroma"))
+        rrf_search = RRFSearchExternalDocs(inverted_index=inverted_index, semantic_search=semantic_search)
+
+        results = {"records": size, "generate_seconds": round(generate_ms / 1000, 3)}
+
+        results["tokenize"] = measure_calls(tokenize_text, texts)
+
+        # Same order as a knowledge base build. The bm25 build puts the title in front of the details.
+        results["bm25_build"] = measure_build(
+            lambda: inverted_index.update(documents=documents, removed_ids=[], uid=uid, rebuild=True), size)
+        index_path = inverted_index._uid_to_file_path(uid)
+        results["bm25_load"] = measure_calls(open_bm25_index, [index_path] * args.load_runs)
+        results["bm25_query"] = measure_calls(
+            lambda query: inverted_index.bm25_search(uid=uid, query=query, limit=constants.DEFAULT_ITEM_LIMIT),
+            queries)
+
+        results["chroma_build"] = measure_build(
+            lambda: semantic_search.update_embeddings(documents=documents, removed_ids=[], uid=uid, rebuild=True),
+            size)
+        results["chroma_query"] = measure_calls(
+            lambda query: semantic_search.semantic_search(uid=uid, query=query, limit=constants.DEFAULT_ITEM_LIMIT),
+            queries)
+
+        search_results = {}
+
+        def search(query: str):
+            search_results[query] = rrf_search.rrf_search(
+                uid=uid, query=query, limit=constants.DEFAULT_ITEM_LIMIT, k=constants.K_VALUE)
+
+        results["rrf_search"] = measure_calls(search, rrf_queries)
+
+        turn_history = [
+            create_turn_history_object(
+                constants.SPEAKER_USER if index % 2 == 0 else constants.SPEAKER_MODEL, query)
+            for index, query in enumerate(queries[:constants.TURN_HISTORY_LIMIT])
+        ]
+        results["prompt"] = measure_calls(
+            lambda query: get_personal_assistant_rag_messages(
+                query=query, result=search_results[query], turn_history=turn_history),
+            rrf_queries)
+
+        semantic_search.collections.delete(uid)
+        return results
+    finally:
+        USER_VECTOR_STORE_CACHE.clear()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the retrieval stack (tokenizer, bm25, chroma, rrf search and prompt assembly) "
+                    "on synthetic knowledge bases. Runs offline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1_000, 10_000],
+                        help="Number of knowledge base objects of each run. Up to 1M.")
+    parser.add_argument("--embedder", type=str, default="fake", choices=EMBEDDERS,
+                        help="fake hashes words into vectors. model runs the configured embedding backend, "
+                             "which must already be downloaded to run offline.")
+    parser.add_argument("--vocabulary-size", type=int, default=20_000)
+    parser.add_argument("--queries", type=int, default=200,
+                        help="Number of queries of each query stage.")
+    parser.add_argument("--tokenize-texts", type=int, default=10_000,
+                        help="Number of knowledge base texts tokenized for the tokenizer stage.")
+    parser.add_argument("--load-runs", type=int, default=5,
+                        help="Times the bm25 index is loaded from disk.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the json results. Printed if not set.")
+    args = parser.parse_args()
+
+    # The token stats log a line per prompt
+    constants.PROMPT_TOKEN_STATS_ENABLED = False
+
+    if args.embedder == "fake":
+        embeddings = HashingEmbeddings()
+        model_name = "hashing"
+    else:
+        embeddings = create_embeddings(constants.EMBEDDING_BACKEND)
+        model_name = constants.EMBEDDING_BACKEND
+    # No query embedding cache on disk. It would outlive the run.
+    embeddings = CachedQueryEmbeddings(embeddings, model_name=model_name, disk_path="")
+
+    # Load the prompt tokenizer before anything is measured
+    count_tokens("")
+
+    vocabulary = synthetic_vocabulary(args.vocabulary_size, random.Random(args.seed))
+    runs = []
+    for size in args.sizes:
+        result = run_size(size, embeddings, vocabulary, args)
+        runs.append(result)
+        print(f"{size:>8} records: bm25 build {result['bm25_build']['seconds']:.2f} s, "
+              f"chroma build {result['chroma_build']['seconds']:.2f} s, "
+              f"rrf search p50 {result['rrf_search']['latency']['p50_ms']:.2f} ms, "
+              f"p99 {result['rrf_search']['latency']['p99_ms']:.2f} ms, "
+              f"peak RSS {result['prompt']['peak_rss_mb']} MB")
+
+    write_json(args.output, {
+        "embedder": args.embedder,
+        "tokenizer_mode": constants.TOKENIZER_MODE,
+        "vocabulary_size": args.vocabulary_size,
+        "queries": args.queries,
+        "runs": runs,
+    })
+
+
+if __name__ == "__main__":
+    main()
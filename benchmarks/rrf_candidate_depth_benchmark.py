@@ -0,0 +1,101 @@
+import argparse
+
+from benchmarks.bench_utils import summarize_latencies, time_call, write_json
+from lib.hybrid_search.rrf_search_external_docs import RRFSearchExternalDocs
+import lib.utils.constants as constants
+
+# Candidate depth rrf search used before it became configurable
+LEGACY_CANDIDATE_MULTIPLIER = 500
+
+DEFAULT_QUERIES = [
+    "What are my skills?",
+    "What is my work schedule?",
+    "Which programming languages do I know?",
+    "What projects have I worked on?",
+    "How do I prefer to communicate?",
+]
+
+
+def run_mode(rrf_search: RRFSearchExternalDocs, uid: str, queries: list[str], limit: int, runs: int, **search_kwargs):
+    """
+        Run every query runs times with the given search options.
+        Returns the latencies and the ids of the last result of each query.
+    """
+    latencies = []
+    result_ids = {}
+    for _ in range(runs):
+        for query in queries:
+            results, elapsed_ms = time_call(
+                rrf_search.rrf_search, uid=uid, query=query, limit=limit, **search_kwargs)
+            latencies.append(elapsed_ms)
+            result_ids[query] = [doc.metadata["id"] for doc in results]
+    return latencies, result_ids
+
+
+def overlap(expected: list, actual: list) -> float:
+    """
+        Fraction of the expected ids that are also in actual.
+    """
+    if not expected:
+        return 1.0
+    return len(set(expected) & set(actual)) / len(expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare rrf search latency and results for different candidate depths.")
+    parser.add_argument("uid", type=str,
+                        help="Uid of a user whose embeddings and index are already built")
+    parser.add_argument("--queries-file", type=str,
+                        help="File with one query per line. Uses a few sample queries if not set.")
+    parser.add_argument("--limit", type=int,
+                        default=constants.DEFAULT_ITEM_LIMIT, help="Number of results.")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Times every query is run per mode.")
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the json results. Printed if not set.")
+    args = parser.parse_args()
+
+    queries = DEFAULT_QUERIES
+    if args.queries_file:
+        with open(args.queries_file) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    rrf_search = RRFSearchExternalDocs()
+    modes = {
+        "legacy": {"candidate_depth": args.limit * LEGACY_CANDIDATE_MULTIPLIER},
+        "adaptive": {"early_stop": False},
+        "early_stop": {"early_stop": True},
+    }
+
+    # Warm up the caches and the model so the first mode isn't penalized
+    run_mode(rrf_search, args.uid, queries, args.limit, 1)
+
+    results = {}
+    legacy_ids = None
+    for mode, search_kwargs in modes.items():
+        latencies, result_ids = run_mode(
+            rrf_search, args.uid, queries, args.limit, args.runs, **search_kwargs)
+        if legacy_ids is None:
+            legacy_ids = result_ids
+
+        overlaps = [overlap(legacy_ids[query], result_ids[query])
+                    for query in queries]
+        results[mode] = {
+            **summarize_latencies(latencies),
+            "overlap_with_legacy": round(sum(overlaps) / len(overlaps), 4),
+        }
+        print(f"{mode:>10}: p50 {results[mode]['p50_ms']:.2f} ms, "
+              f"mean {results[mode]['mean_ms']:.2f} ms, overlap@{args.limit} {results[mode]['overlap_with_legacy']:.2%}")
+
+    write_json(args.output, {
+        "uid": args.uid,
+        "limit": args.limit,
+        "queries": len(queries),
+        "runs": args.runs,
+        "modes": results,
+    })
+
+
+if __name__ == "__main__":
+    main()
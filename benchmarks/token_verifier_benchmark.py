@@ -0,0 +1,82 @@
+import argparse
+import sys
+
+from firebase_admin import auth
+
+from benchmarks.bench_utils import summarize_latencies, time_call, write_json
+from benchmarks.local_token_signer import LocalTokenSigner
+from backend.firebase.token_verifier import CertStore, FirebaseTokenVerifier
+
+
+def check_rejections(signer: LocalTokenSigner, verifier: FirebaseTokenVerifier) -> list[str]:
+    """
+        Return the names of the bad tokens the verifier accepted.
+    """
+    other_signer = LocalTokenSigner(project_id=signer.project_id)
+    valid_token = signer.sign("user")
+    bad_tokens = {
+        "expired": (signer.sign("user", expires_in=-60), auth.ExpiredIdTokenError),
+        "wrong_audience": (signer.sign("user", aud="other-project"), auth.InvalidIdTokenError),
+        "wrong_issuer": (signer.sign("user", iss="https://example.com"), auth.InvalidIdTokenError),
+        "empty_subject": (signer.sign(""), auth.InvalidIdTokenError),
+        "bad_signature": (valid_token[:-8] + "AAAAAAAA", auth.InvalidIdTokenError),
+        "unknown_key": (other_signer.sign("user"), auth.InvalidIdTokenError),
+        "malformed": ("not-a-token", auth.InvalidIdTokenError),
+    }
+
+    accepted = []
+    for name, (token, error_type) in bad_tokens.items():
+        try:
+            verifier.verify(token)
+            accepted.append(name)
+        except error_type:
+            pass
+    return accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare ID token verification with and without the verified token cache, using a local signer.")
+    parser.add_argument("--users", type=int, default=100,
+                        help="Number of distinct tokens.")
+    parser.add_argument("--requests", type=int, default=5000,
+                        help="Number of verifications per method.")
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the json results. Printed if not set.")
+    args = parser.parse_args()
+
+    signer = LocalTokenSigner()
+    cert_store = CertStore(fetch_certs=signer.fetch_certs)
+    cert_store.prewarm()
+    tokens = [signer.sign(f"user-{index}") for index in range(args.users)]
+    requests = [tokens[index % len(tokens)] for index in range(args.requests)]
+
+    # Every request pays for the signature check
+    uncached = FirebaseTokenVerifier(
+        project_id=signer.project_id, cert_store=cert_store, max_entries=0)
+    cached = FirebaseTokenVerifier(
+        project_id=signer.project_id, cert_store=cert_store)
+
+    accepted = check_rejections(signer, uncached)
+    print(f"Bad tokens accepted: {accepted or 'none'}")
+
+    results = {
+        "users": args.users,
+        "requests": args.requests,
+        "bad_tokens_accepted": accepted,
+        "uncached": summarize_latencies([time_call(uncached.verify, token)[1] for token in requests]),
+        "cached": summarize_latencies([time_call(cached.verify, token)[1] for token in requests]),
+        "cache": cached.stats(),
+        "cert_fetches": signer.fetch_count,
+    }
+    print(f"p50: uncached {results['uncached']['p50_ms']:.3f} ms, cached {results['cached']['p50_ms']:.4f} ms. "
+          f"Cert fetches: {signer.fetch_count}")
+
+    write_json(args.output, results)
+
+    if accepted:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import random
+import string
+
+from benchmarks.bench_utils import summarize_latencies, time_call, write_json
+import lib.utils.text_utils as text_utils
+
+# Words that exercise the tokenizer rules. Contractions, punctuation inside words, unicode quotes and so on.
+EDGE_CASE_WORDS = [
+    "cannot", "gimme", "Gonna", "gotta", "lemme", "wanna", "wannabe", "isn't", "don't", "can't", "won't",
+    "U.S.A.", "e-mail", "3.14", "1,000", "foo_bar", "50%", "@me", "#tag", "a--b", "C++", "it's", "they'll",
+    "(wanna)", "gonna.", "“quoted”", "naïve", "café", "—", "…", "tab\there", "new\nline",
+]
+COMMON_WORDS = [
+    "skills", "python", "engineer", "mobile", "apps", "developing", "worked", "projects", "running",
+    "schedule", "the", "and", "of", "meetings", "languages", "prefer", "communication", "weekends",
+]
+
+
+def random_texts(count: int, words_per_text: int, seed: int) -> list[str]:
+    """
+        Random texts mixing common words, edge cases and random ascii strings.
+    """
+    rng = random.Random(seed)
+    vocabulary = COMMON_WORDS * 4 + EDGE_CASE_WORDS
+    texts = []
+    for _ in range(count):
+        words = []
+        for _ in range(rng.randint(0, words_per_text)):
+            if rng.random() < 0.1:
+                words.append("".join(rng.choices(
+                    string.ascii_letters + string.digits + string.punctuation, k=rng.randint(1, 8))))
+            else:
+                words.append(rng.choice(vocabulary))
+        texts.append(" ".join(words))
+    return texts
+
+
+def time_per_text(tokenize, texts: list[str]) -> list[float]:
+    return [time_call(tokenize, text)[1] for text in texts]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the speed of the fast tokenizer and nltk. Parity is checked in tests/test_text_utils.py.")
+    parser.add_argument("--texts-file", type=str,
+                        help="File with one text per line. Uses random texts if not set.")
+    parser.add_argument("--count", type=int, default=5000,
+                        help="Number of random texts.")
+    parser.add_argument("--words", type=int, default=60,
+                        help="Max words per random text.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="",
+                        help="Path of the json results. Printed if not set.")
+    args = parser.parse_args()
+
+    if args.texts_file:
+        with open(args.texts_file) as f:
+            texts = [line.rstrip("\n") for line in f]
+    else:
+        texts = random_texts(args.count, args.words, args.seed)
+
+    # Cold memo for the fast tokenizer
+    text_utils.STEM_CACHE.clear()
+    _, fast_cold_ms = time_call(
+        lambda: [text_utils.tokenize_text_fast(text) for text in texts])
+
+    results = {
+        "texts": len(texts),
+        "nltk_query": summarize_latencies(time_per_text(text_utils.tokenize_text_nltk, texts)),
+        "fast_query": summarize_latencies(time_per_text(text_utils.tokenize_text_fast, texts)),
+        "nltk_batch_ms": round(time_call(lambda: [text_utils.tokenize_text_nltk(text) for text in texts])[1], 3),
+        "fast_batch_cold_ms": round(fast_cold_ms, 3),
+        "fast_batch_ms": round(time_call(lambda: [text_utils.tokenize_text_fast(text) for text in texts])[1], 3),
+        "stem_cache_entries": len(text_utils.STEM_CACHE),
+    }
+    results["batch_speedup"] = round(
+        results["nltk_batch_ms"] / max(results["fast_batch_ms"], 1e-9), 1)
+    print(f"Batch: nltk {results['nltk_batch_ms']:.1f} ms, fast {results['fast_batch_ms']:.1f} ms "
+          f"({results['batch_speedup']}x). Query p50: nltk {results['nltk_query']['p50_ms']:.3f} ms, "
+          f"fast {results['fast_query']['p50_ms']:.3f} ms")
+
+    write_json(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import argparse
 import nltk
 from lib.bm25_search.inverted_index import InvertedIndex
 from lib.bm25_search.inverted_index_external_docs import InvertedIndexExternalDocs
+from lib.bm25_search.bm25_index_format import convert_pickle_index
 
 import lib.utils.data_loader_utils as data_loader_utils
 
@@ -51,6 +52,13 @@ def handle_search_external(inv_index: InvertedIndexExternalDocs, query: str, lim
         print(f"{result.page_content}")
 
 
+def handle_convert_index(pickle_path: str, index_path: str):
+    """
+        Handles convert_index command. Converts a pickled index into the memory mapped index format.
+    """
+    convert_pickle_index(pickle_path, index_path)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
     subparsers = parser.add_subparsers(
@@ -86,6 +94,14 @@ def main():
     bm25_search_external_parser.add_argument(
         "--limit", type=int, help="Number of results.")
 
+    # Convert pickled index
+    convert_index_parser = subparsers.add_parser(
+        "convert_index", help="Convert a pickled index (cache/*.pkl) into the memory mapped index format.")
+    convert_index_parser.add_argument(
+        "pickle_path", type=str, help="Path of the pickled index")
+    convert_index_parser.add_argument(
+        "index_path", type=str, help="Path of the converted index. (e.g. cache/<uid>.bm25)")
+
     # Keyword search object
     inv_index = InvertedIndex()
     inv_index_ext_docs = InvertedIndexExternalDocs()
@@ -104,6 +120,8 @@ def main():
         case "search_external":
             handle_search_external(
                 inv_index_ext_docs, args.query, args.limit, args.uid)
+        case "convert_index":
+            handle_convert_index(args.pickle_path, args.index_path)
 
 
 if __name__ == "__main__":
@@ -26,16 +26,21 @@ def handle_rag(rag: RAG):
         turn_history.add_to_turn_history(
             speaker=constants.SPEAKER_USER, text=query)
 
-        # Response
-        response = rag.discuss(
-            query, turn_history=turn_history.get_turn_history_str())
+        # Stream the response as it's generated
+        sys.stdout.write("Assistant: ")
+        sys.stdout.flush()
+        chunks = []
+        for chunk in rag.discuss_stream(query, turn_history=turn_history.get_turn_history_str()):
+            chunks.append(chunk)
+            sys.stdout.write(chunk)
+            sys.stdout.flush()
+        print("")
+        response = "".join(chunks)
 
         # Add the response in Turn History
         turn_history.add_to_turn_history(
             speaker=constants.SPEAKER_MODEL, text=response)
 
-        print(f"Assistant: {response}")
-
 
 def main():
     parser = argparse.ArgumentParser(description="RAG CLI")
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, NamedTuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+import lib.utils.constants as constants
+
+
+class CachedAnswer(NamedTuple):
+    """
+        One generated answer. vector is the unit length query embedding.
+    """
+    vector: np.ndarray
+    context_ids: tuple
+    answer: str
+    created_at: float
+
+
+def context_ids(results: list[Document]) -> tuple:
+    """
+        Ids of the retrieved documents. Order doesn't matter, the prompt has the same context either way.
+    """
+    return tuple(sorted(str(document.metadata.get("id")) for document in results))
+
+
+def is_cacheable(turn_history: list[dict] | str) -> bool:
+    """
+        Only answers to questions without turn history are cached. With a history the answer depends on the
+        conversation, and every later message of a conversation has a different one, so a lookup would never hit.
+    """
+    return not turn_history
+
+
+class SemanticAnswerCache:
+    """
+        Per user cache of generated answers for near duplicate questions.
+
+        A cached answer is returned when the query embedding has cosine similarity >= threshold with a cached one,
+        and the same documents were retrieved. Callers only use it for questions without turn history. (is_cacheable)
+        A user's answers are dropped when their knowledge base is rebuilt (invalidate) and after ttl_seconds.
+        Each user keeps max_entries_per_user answers and the least recently used users are evicted.
+    """
+
+    def __init__(self,
+                 threshold: float = constants.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+                 max_entries_per_user: int = constants.ANSWER_CACHE_MAX_ENTRIES_PER_USER,
+                 max_users: int = constants.ANSWER_CACHE_MAX_USERS,
+                 ttl_seconds: float = constants.ANSWER_CACHE_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.threshold = threshold
+        self.max_entries_per_user = max_entries_per_user
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+
+        # uid -> answers, oldest first. Most recently used users are at the end.
+        self._users: OrderedDict[str, list[CachedAnswer]] = OrderedDict()
+        # uid -> number of invalidations. Answers generated before an invalidation are not stored.
+        self._generations: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, uid: str) -> int:
+        """
+            Take this before retrieving and pass it to store.
+        """
+        with self._lock:
+            return self._generations.get(uid, 0)
+
+    def lookup(self, uid: str, query_vector, results: list[Document]) -> str | None:
+        """
+            Return the cached answer of the most similar question or None.
+        """
+        vector = _unit_vector(query_vector)
+        ids = context_ids(results)
+
+        with self._lock:
+            answers = self._users.get(uid)
+            if answers:
+                # Drop the expired answers
+                now = self.clock()
+                answers[:] = [answer for answer in answers if now - answer.created_at < self.ttl_seconds]
+
+            candidates = [answer for answer in answers or []
+                          if answer.context_ids == ids]
+            if candidates:
+                similarities = np.stack([answer.vector for answer in candidates]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self._users.move_to_end(uid)
+                    self.hits += 1
+                    return candidates[best].answer
+
+            self.misses += 1
+            return None
+
+    def store(self, uid: str, query_vector, results: list[Document], answer: str, generation: int = None):
+        """
+            Cache a generated answer. Skipped if the knowledge base was rebuilt since generation was taken.
+        """
+        if not answer:
+            return
+
+        cached_answer = CachedAnswer(
+            vector=_unit_vector(query_vector),
+            context_ids=context_ids(results),
+            answer=answer,
+            created_at=self.clock()
+        )
+
+        with self._lock:
+            if generation is not None and generation != self._generations.get(uid, 0):
+                return
+
+            answers = self._users.setdefault(uid, [])
+            answers.append(cached_answer)
+            del answers[:-self.max_entries_per_user]
+
+            self._users.move_to_end(uid)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def invalidate(self, uid: str):
+        """
+            Drop the user's answers. Called when their knowledge base changes.
+        """
+        with self._lock:
+            self._users.pop(uid, None)
+            self._generations[uid] = self._generations.get(uid, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "users": len(self._users),
+                "entries": sum(len(answers) for answers in self._users.values()),
+            }
+
+
+def _unit_vector(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
@@ -0,0 +1,64 @@
+from langchain_core.embeddings import Embeddings
+
+import lib.utils.constants as constants
+from lib.augmented_generation.rag_external import RAGExternal
+from lib.bm25_search.inverted_index_external_docs import InvertedIndexExternalDocs
+from lib.hybrid_search.rrf_search_external_docs import RRFSearchExternalDocs
+from lib.semantic_search.semantic_search_external_docs import SemanticSearchExternalDocs
+from lib.semantic_search.embedding_backends import create_embeddings
+from lib.semantic_search.chroma_client import get_chroma_client
+from lib.utils.text_utils import tokenize_text
+from lib.utils.prompt_utils import count_tokens
+from lib.utils.executor_utils import RetrievalExecutor
+
+
+class EngineRegistry:
+    """
+        Owns the expensive RAG components once per process.
+        The embedding model, chroma client and bm25 loader are created here and shared by every request.
+    """
+
+    def __init__(self, embeddings: Embeddings = None):
+        # Use the given embedding model if provided (e.g. a stand-in for load tests). Otherwise load the configured one.
+        self.embeddings = embeddings or create_embeddings(constants.EMBEDDING_BACKEND)
+        self.chroma_client = get_chroma_client(constants.CHROMA_PATH)
+
+        self.inverted_index = InvertedIndexExternalDocs()
+        self.semantic_search = SemanticSearchExternalDocs(
+            embeddings=self.embeddings, chroma_client=self.chroma_client)
+        self.rrf_search = RRFSearchExternalDocs(
+            inverted_index=self.inverted_index, semantic_search=self.semantic_search)
+        self.retrieval_executor = RetrievalExecutor(
+            max_workers=constants.RETRIEVAL_MAX_WORKERS, max_pending=constants.RETRIEVAL_MAX_PENDING)
+        self.rag = RAGExternal(rrf_search=self.rrf_search,
+                               retrieval_executor=self.retrieval_executor)
+
+    def warmup(self):
+        """
+            Run the hot paths once so the first user request is not a cold start.
+            Loads the model weights, the nltk data, the prompt tokenizer and the chroma system.
+        """
+        try:
+            self.embeddings.embed_query(constants.WARMUP_QUERY)
+            tokenize_text(constants.WARMUP_QUERY)
+            count_tokens(constants.WARMUP_QUERY)
+            self.chroma_client.heartbeat()
+            print("Engine warmup complete.")
+        except Exception as e:
+            print(f"Engine warmup failed: {e}")
+
+    def cache_stats(self) -> dict:
+        """
+            Hit and miss counts of the per process caches.
+        """
+        return {
+            "query_embeddings": self.semantic_search.embeddings.stats(),
+            "answers": self.rag.answer_cache.stats(),
+        }
+
+    def close(self):
+        """
+            Release the worker threads and processes. Called when the server shuts down.
+        """
+        self.retrieval_executor.shutdown()
+        self.semantic_search.embedding_pipeline.close()
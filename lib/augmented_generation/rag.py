@@ -1,7 +1,7 @@
+from typing import Iterator
 from lib.hybrid_search.rrf_search import RRFSearch
 import lib.utils.constants as constants
-from lib.utils.gemini_utils import generate_response
-from lib.utils.local_ai_utils import generate_local_llm_response
+from lib.utils.llm_utils import generate_llm_response, generate_llm_response_stream
 from lib.utils.prompt_utils import get_personal_assistant_rag_prompt
 
 
@@ -23,11 +23,25 @@ class RAG:
             query=query, result=results, turn_history=turn_history)
 
         # Generate
-        # response = generate_response(prompt=prompt)
-        response = generate_local_llm_response(prompt=prompt)
+        response = generate_llm_response(prompt=prompt)
 
         return response
 
+    def discuss_stream(self, query: str, turn_history: str = "") -> Iterator[str]:
+        """
+            Same as discuss but yields the response text as the llm generates it.
+        """
+        # Do the search
+        results = self.rrf_search.rrf_search(
+            query, constants.DEFAULT_ITEM_LIMIT, constants.K_VALUE)
+
+        # Get the prompt
+        prompt = get_personal_assistant_rag_prompt(
+            query=query, result=results, turn_history=turn_history)
+
+        # Generate
+        yield from generate_llm_response_stream(prompt=prompt)
+
 
 # This Turn History is to be used in Cli app only.
 class InMemoryTurnHistory:
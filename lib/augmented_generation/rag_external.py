@@ -1,38 +1,215 @@
+from typing import Callable, Iterator, AsyncIterator
+import numpy as np
 from lib.augmented_generation.rag import RAG
 from lib.hybrid_search.rrf_search_external_docs import RRFSearchExternalDocs
 from langchain_core.documents import Document
 import lib.utils.constants as constants
-from lib.utils.gemini_utils import generate_response
-from lib.utils.local_ai_utils import generate_local_llm_response
-from lib.utils.prompt_utils import get_personal_assistant_rag_prompt
+from lib.utils.llm_utils import generate_llm_response, generate_llm_response_stream
+from lib.utils.llm_utils import generate_llm_response_async, generate_llm_response_stream_async
+from lib.utils.executor_utils import RetrievalExecutor
+from lib.utils.prompt_utils import get_personal_assistant_rag_messages
+from lib.augmented_generation.answer_cache import SemanticAnswerCache, is_cacheable
 
 
 class RAGExternal(RAG):
-    def __init__(self):
-        self.rrf_search = RRFSearchExternalDocs()
+    def __init__(self, rrf_search: RRFSearchExternalDocs = None, retrieval_executor: RetrievalExecutor = None,
+                 answer_cache: SemanticAnswerCache = None):
+        # Use the shared rrf search if provided. Otherwise create a new one.
+        self.rrf_search = rrf_search or RRFSearchExternalDocs()
+        # Retrieval is CPU bound. The async methods run it in this pool to keep the event loop free.
+        self.retrieval_executor = retrieval_executor or RetrievalExecutor(
+            max_workers=constants.RETRIEVAL_MAX_WORKERS, max_pending=constants.RETRIEVAL_MAX_PENDING)
+        # Answers of near duplicate questions without turn history. Only used if ANSWER_CACHE_ENABLED.
+        self.answer_cache = answer_cache or SemanticAnswerCache()
 
-    def build_embeddings_and_indices(self, documents: list[Document],  uid: str):
+    def build_embeddings_and_indices(self, documents: list[Document],  uid: str,
+                                     progress_callback: Callable[[float, str], None] = None) -> dict:
         """
             Build embeddings and indices from the given uid.
+            Returns the number of docs added, updated, unchanged and removed.
         """
-        self.rrf_search.build_embeddings_and_index(
-            documents=documents, uid=uid)
+        # Answers generated from the old knowledge base are dropped before and after the build
+        self.answer_cache.invalidate(uid)
+        try:
+            return self.rrf_search.build_embeddings_and_index(
+                documents=documents, uid=uid, progress_callback=progress_callback)
+        finally:
+            self.answer_cache.invalidate(uid)
 
-    def discuss(self, uid: str, query: str, turn_history: str = "") -> str:
+    def discuss(self, uid: str, query: str, turn_history: list[dict] | str = "") -> str:
         """
             Do a rrf search based on uid and query.
             Feed the results to LLM and get the result
         """
+        generation = self.answer_cache.generation(uid)
+
         # Get the search results
         results = self.rrf_search.rrf_search(
             uid=uid, query=query, limit=constants.DEFAULT_ITEM_LIMIT, k=constants.K_VALUE)
 
+        # Reuse the answer of a near duplicate question
+        query_vector, cached_answer = self._cached_answer(uid, query, results, turn_history)
+        if cached_answer is not None:
+            return cached_answer
+
         # Get the prompt
-        prompt = get_personal_assistant_rag_prompt(
+        prompt = get_personal_assistant_rag_messages(
             query=query, result=results, turn_history=turn_history)
 
         # Generate
-        # response = generate_response(prompt=prompt)
-        response = generate_local_llm_response(prompt=prompt)
+        response = generate_llm_response(prompt=prompt)
+
+        self._store_answer(uid, query_vector, results, response, generation)
 
         return response
+
+    def discuss_stream(self, uid: str, query: str, turn_history: list[dict] | str = "") -> Iterator[str]:
+        """
+            Same as discuss but yields the response text as the llm generates it.
+        """
+        generation = self.answer_cache.generation(uid)
+
+        # Get the search results
+        results = self.rrf_search.rrf_search(
+            uid=uid, query=query, limit=constants.DEFAULT_ITEM_LIMIT, k=constants.K_VALUE)
+
+        # Reuse the answer of a near duplicate question
+        query_vector, cached_answer = self._cached_answer(uid, query, results, turn_history)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+
+        # Get the prompt
+        prompt = get_personal_assistant_rag_messages(
+            query=query, result=results, turn_history=turn_history)
+
+        # Generate
+        chunks = []
+        for chunk in generate_llm_response_stream(prompt=prompt):
+            chunks.append(chunk)
+            yield chunk
+
+        self._store_answer(uid, query_vector, results, "".join(chunks), generation)
+
+    async def adiscuss(self, uid: str, query: str, turn_history: list[dict] | str = "") -> str:
+        """
+            Async version of discuss. Doesn't block the event loop.
+            Retrieval runs in the retrieval executor and the llm is called with the async clients.
+        """
+        generation = self.answer_cache.generation(uid)
+
+        # Get the search results
+        results = await self.aretrieve(uid=uid, query=query)
+
+        # Generate
+        return await self.agenerate(uid=uid, query=query, results=results, generation=generation,
+                                    turn_history=turn_history)
+
+    async def adiscuss_stream(self, uid: str, query: str, turn_history: list[dict] | str = "") -> AsyncIterator[str]:
+        """
+            Async version of discuss_stream. Doesn't block the event loop.
+        """
+        generation = self.answer_cache.generation(uid)
+
+        # Get the search results
+        results = await self.aretrieve(uid=uid, query=query)
+
+        # Generate
+        async for chunk in self.agenerate_stream(uid=uid, query=query, results=results, generation=generation,
+                                                 turn_history=turn_history):
+            yield chunk
+
+    async def aretrieve(self, uid: str, query: str) -> list[Document]:
+        """
+            Retrieval step of adiscuss. Doesn't need the turn history, so callers can run it alongside other work.
+            Take answer_cache.generation(uid) before calling this and pass it to agenerate.
+        """
+        return await self.retrieval_executor.run(
+            self.rrf_search.rrf_search, uid=uid, query=query, limit=constants.DEFAULT_ITEM_LIMIT, k=constants.K_VALUE)
+
+    async def agenerate(self, uid: str, query: str, results: list[Document], generation: int,
+                        turn_history: list[dict] | str = "") -> str:
+        """
+            Generation step of adiscuss, from the results of aretrieve.
+            generation is the answer cache generation taken before retrieving. The answer isn't cached if the
+            knowledge base was rebuilt since then, because results may come from the old one.
+            Returns the cached answer of a near duplicate question without calling the llm.
+        """
+        # Reuse the answer of a near duplicate question
+        query_vector, cached_answer = await self._acached_answer(uid, query, results, turn_history)
+        if cached_answer is not None:
+            return cached_answer
+
+        # Get the prompt
+        prompt = get_personal_assistant_rag_messages(
+            query=query, result=results, turn_history=turn_history)
+
+        # Generate
+        response = await generate_llm_response_async(prompt=prompt)
+
+        self._store_answer(uid, query_vector, results, response, generation)
+
+        return response
+
+    async def agenerate_stream(self, uid: str, query: str, results: list[Document], generation: int,
+                               turn_history: list[dict] | str = "") -> AsyncIterator[str]:
+        """
+            Streaming version of agenerate. A cached answer is sent as one chunk.
+        """
+        # Reuse the answer of a near duplicate question
+        query_vector, cached_answer = await self._acached_answer(uid, query, results, turn_history)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+
+        # Get the prompt
+        prompt = get_personal_assistant_rag_messages(
+            query=query, result=results, turn_history=turn_history)
+
+        # Generate
+        chunks = []
+        async for chunk in generate_llm_response_stream_async(prompt=prompt):
+            chunks.append(chunk)
+            yield chunk
+
+        # Only complete answers are cached
+        self._store_answer(uid, query_vector, results, "".join(chunks), generation)
+
+    def _cached_answer(self, uid: str, query: str, results: list[Document],
+                       turn_history: list[dict] | str) -> tuple[np.ndarray | None, str | None]:
+        """
+            Embed the query and look up the answer of a near duplicate question.
+            Returns (query vector, cached answer). The query vector is None if the answer can't be cached.
+        """
+        if not self._uses_answer_cache(turn_history):
+            return None, None
+
+        query_vector = self._embed_query(query)
+        return query_vector, self.answer_cache.lookup(uid, query_vector, results)
+
+    async def _acached_answer(self, uid: str, query: str, results: list[Document],
+                              turn_history: list[dict] | str) -> tuple[np.ndarray | None, str | None]:
+        """
+            Async version of _cached_answer. Embedding runs in the retrieval executor.
+        """
+        if not self._uses_answer_cache(turn_history):
+            return None, None
+
+        return await self.retrieval_executor.run(self._cached_answer, uid, query, results, turn_history)
+
+    @staticmethod
+    def _uses_answer_cache(turn_history: list[dict] | str) -> bool:
+        return constants.ANSWER_CACHE_ENABLED and is_cacheable(turn_history)
+
+    def _store_answer(self, uid: str, query_vector: np.ndarray | None, results: list[Document], answer: str,
+                      generation: int):
+        """
+            Cache the generated answer. query_vector comes from _cached_answer. Nothing is stored if it's None.
+        """
+        if query_vector is not None:
+            self.answer_cache.store(
+                uid, query_vector, results, answer, generation=generation)
+
+    def _embed_query(self, query: str) -> np.ndarray:
+        # Retrieval just embedded the same query, so this is a query embedding cache hit
+        return np.asarray(self.rrf_search.semantic_search.embeddings.embed_query(query), dtype=np.float32)
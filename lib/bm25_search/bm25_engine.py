@@ -0,0 +1,320 @@
+from collections import Counter
+from typing import Callable
+
+import numpy as np
+from langchain_core.documents import Document
+
+from lib.utils.text_utils import tokenize_text, tokenize_texts
+import lib.utils.constants as constants
+
+
+class BM25Engine:
+    """
+        Array backed BM25 (Okapi) engine.
+
+        Postings are stored in CSR layout. The postings of term_id live in
+        posting_doc_ids[indptr[term_id]:indptr[term_id + 1]] with their term frequencies in posting_tfs.
+        Document length norms and idf are precomputed at build time,
+        so a query only touches the postings of its own terms instead of scoring every document.
+        Scores are identical to rank_bm25's BM25Okapi which BM25Retriever used before.
+    """
+
+    def __init__(self,
+                 vocabulary,
+                 indptr: np.ndarray,
+                 posting_doc_ids: np.ndarray,
+                 posting_tfs: np.ndarray,
+                 doc_norms: np.ndarray,
+                 idf: np.ndarray,
+                 doc_store,
+                 doc_ids: np.ndarray,
+                 k1: float = constants.BM25_K1,
+                 b: float = constants.BM25_B):
+        # vocabulary and doc_store only need get(term, default) / document(doc_idx) and len().
+        # The on disk index provides memory mapped versions of them.
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.posting_doc_ids = posting_doc_ids
+        self.posting_tfs = posting_tfs
+        self.doc_norms = doc_norms
+        self.idf = idf
+        self.doc_store = doc_store
+        self.doc_ids = doc_ids
+        self.k1 = k1
+        self.b = b
+
+    @classmethod
+    def from_documents(cls,
+                       documents: list[Document],
+                       preprocess_func: Callable[[str], list[str]] = tokenize_text,
+                       k1: float = constants.BM25_K1,
+                       b: float = constants.BM25_B,
+                       epsilon: float = constants.BM25_EPSILON) -> "BM25Engine":
+        """
+            Tokenize the documents and build the CSR postings.
+        """
+        vocabulary: dict[str, int] = {}
+        posting_term_ids, posting_doc_ids, posting_tfs, doc_lengths = _tokenize_postings(
+            documents=documents, vocabulary=vocabulary, preprocess_func=preprocess_func)
+
+        return cls.from_postings(
+            vocabulary=vocabulary,
+            posting_term_ids=posting_term_ids,
+            posting_doc_ids=posting_doc_ids,
+            posting_tfs=posting_tfs,
+            doc_lengths=doc_lengths,
+            texts=[doc.page_content for doc in documents],
+            metadatas=[dict(doc.metadata) for doc in documents],
+            k1=k1,
+            b=b,
+            epsilon=epsilon
+        )
+
+    @classmethod
+    def from_postings(cls,
+                      vocabulary: dict[str, int],
+                      posting_term_ids: np.ndarray,
+                      posting_doc_ids: np.ndarray,
+                      posting_tfs: np.ndarray,
+                      doc_lengths: np.ndarray,
+                      texts: list[str],
+                      metadatas: list[dict],
+                      k1: float = constants.BM25_K1,
+                      b: float = constants.BM25_B,
+                      epsilon: float = constants.BM25_EPSILON) -> "BM25Engine":
+        """
+            Build the engine from unordered (term_id, doc_idx, tf) postings.
+            Sorts them into CSR layout and precomputes the norms and idf.
+        """
+        num_docs = len(texts)
+        num_terms = len(vocabulary)
+
+        # Group the postings by term. Doc ids stay sorted inside each term.
+        order = np.lexsort((posting_doc_ids, posting_term_ids))
+        posting_term_ids = posting_term_ids[order]
+        posting_doc_ids = np.ascontiguousarray(
+            posting_doc_ids[order], dtype=np.int32)
+        posting_tfs = np.ascontiguousarray(
+            posting_tfs[order], dtype=np.float32)
+
+        doc_freqs = np.bincount(posting_term_ids, minlength=num_terms)
+        indptr = np.zeros(num_terms + 1, dtype=np.int64)
+        np.cumsum(doc_freqs, out=indptr[1:])
+
+        # Same idf as BM25Okapi. Negative idf of very common terms is floored to epsilon * average idf.
+        idf = (np.log(num_docs - doc_freqs + 0.5) -
+               np.log(doc_freqs + 0.5)).astype(np.float32)
+        if num_terms > 0:
+            idf[idf < 0] = epsilon * float(idf.mean())
+
+        # Document length part of the bm25 denominator. k1 * (1 - b + b * doc_len / avgdl)
+        avgdl = float(doc_lengths.mean()) if num_docs > 0 else 0.0
+        if avgdl > 0:
+            doc_norms = k1 * (1 - b + b * doc_lengths / avgdl)
+        else:
+            doc_norms = np.full(num_docs, k1 * (1 - b), dtype=np.float32)
+
+        return cls(
+            vocabulary=vocabulary,
+            indptr=indptr,
+            posting_doc_ids=posting_doc_ids,
+            posting_tfs=posting_tfs,
+            doc_norms=doc_norms.astype(np.float32),
+            idf=idf,
+            doc_store=InMemoryDocStore(texts=texts, metadatas=metadatas),
+            doc_ids=np.asarray([to_doc_id(metadata.get("id"))
+                               for metadata in metadatas], dtype=np.int64),
+            k1=k1,
+            b=b
+        )
+
+    def update(self,
+               documents: list[Document],
+               removed_ids: list[int],
+               preprocess_func: Callable[[str], list[str]] = tokenize_text,
+               epsilon: float = constants.BM25_EPSILON) -> "BM25Engine":
+        """
+            Return a new engine with documents added or replacing the docs with the same id,
+            and the docs in removed_ids dropped.
+            Only the given documents are tokenized. The postings of the other docs are reused as they are.
+            idf and the length norms are recomputed since they depend on the whole collection.
+        """
+        # Drop the removed docs and the old versions of the updated ones
+        dropped_ids = np.asarray(
+            list(removed_ids) + [to_doc_id(doc.metadata.get("id")) for doc in documents], dtype=np.int64)
+        keep = ~np.isin(np.asarray(self.doc_ids), dropped_ids)
+        new_doc_idx = np.cumsum(keep) - 1
+
+        doc_freqs = np.diff(self.indptr)
+        posting_term_ids = np.repeat(
+            np.arange(len(doc_freqs), dtype=np.int64), doc_freqs)
+        posting_doc_ids = np.asarray(self.posting_doc_ids)
+        posting_tfs = np.asarray(self.posting_tfs, dtype=np.float32)
+        kept_postings = keep[posting_doc_ids]
+        posting_term_ids = posting_term_ids[kept_postings]
+        posting_doc_ids = new_doc_idx[posting_doc_ids[kept_postings]]
+        posting_tfs = posting_tfs[kept_postings]
+
+        # Only keep the terms that still have postings
+        used_terms = np.bincount(
+            posting_term_ids, minlength=len(doc_freqs)) > 0
+        new_term_ids = np.cumsum(used_terms) - 1
+        vocabulary = {term: int(new_term_ids[term_id])
+                      for term, term_id in self.vocabulary.items() if used_terms[term_id]}
+        posting_term_ids = new_term_ids[posting_term_ids]
+
+        # Doc length is the sum of the term frequencies of the doc
+        num_kept = int(keep.sum())
+        doc_lengths = np.bincount(
+            posting_doc_ids, weights=posting_tfs, minlength=num_kept).astype(np.float32)
+
+        kept_docs = [self.doc_store.document(int(doc_idx))
+                     for doc_idx in np.flatnonzero(keep)]
+
+        # Tokenize the new docs and append them after the kept ones
+        added_term_ids, added_doc_ids, added_tfs, added_lengths = _tokenize_postings(
+            documents=documents, vocabulary=vocabulary, preprocess_func=preprocess_func, doc_offset=num_kept)
+
+        all_docs = kept_docs + documents
+        return BM25Engine.from_postings(
+            vocabulary=vocabulary,
+            posting_term_ids=np.concatenate(
+                [posting_term_ids, added_term_ids]).astype(np.int32),
+            posting_doc_ids=np.concatenate(
+                [posting_doc_ids, added_doc_ids]).astype(np.int32),
+            posting_tfs=np.concatenate([posting_tfs, added_tfs]),
+            doc_lengths=np.concatenate([doc_lengths, added_lengths]),
+            texts=[doc.page_content for doc in all_docs],
+            metadatas=[dict(doc.metadata) for doc in all_docs],
+            k1=self.k1,
+            b=self.b,
+            epsilon=epsilon
+        )
+
+    @property
+    def num_docs(self) -> int:
+        return len(self.doc_store)
+
+    def __repr__(self) -> str:
+        return f"BM25Engine(docs={self.num_docs}, terms={len(self.indptr) - 1}, postings={len(self.posting_doc_ids)})"
+
+    def term_id(self, term: str) -> int:
+        """
+            Return the id of the term or -1 if the term is not in the vocabulary.
+        """
+        return self.vocabulary.get(term, -1)
+
+    def score(self, query: str, preprocess_func: Callable[[str], list[str]] = tokenize_text) -> tuple[np.ndarray, np.ndarray]:
+        """
+            Score the documents that contain at least one of the query terms.
+            Returns (doc_idx, score) arrays. Work is proportional to the postings touched.
+        """
+        doc_idx_parts = []
+        score_parts = []
+
+        # Repeated query terms count once per occurrence. Same as BM25Okapi.
+        for term, query_tf in Counter(preprocess_func(query)).items():
+            term_id = self.term_id(term)
+            if term_id < 0:
+                continue
+
+            start = self.indptr[term_id]
+            end = self.indptr[term_id + 1]
+            doc_ids = self.posting_doc_ids[start:end]
+            tfs = self.posting_tfs[start:end]
+
+            term_scores = tfs * (self.k1 + 1) / (tfs + self.doc_norms[doc_ids])
+            doc_idx_parts.append(doc_ids)
+            score_parts.append(term_scores * (self.idf[term_id] * query_tf))
+
+        if not doc_idx_parts:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+
+        # Sum the per term scores of each touched doc
+        doc_idx, inverse = np.unique(
+            np.concatenate(doc_idx_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+
+        return doc_idx, scores
+
+    def search(self, query: str, limit: int) -> list[Document]:
+        """
+            Return the top documents for the query ordered by bm25 score.
+            Only documents matching at least one query term are returned.
+        """
+        doc_idx, scores = self.score(query)
+        if len(doc_idx) == 0 or limit <= 0:
+            return []
+
+        # Select the top k without sorting every candidate
+        if limit < len(scores):
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.lexsort((doc_idx[top], -scores[top]))]
+
+        # Return fresh docs. Callers write ranks into the metadata.
+        return [self.doc_store.document(int(idx)) for idx in doc_idx[top]]
+
+
+class InMemoryDocStore:
+    """
+        Stored documents of a freshly built engine.
+    """
+
+    def __init__(self, texts: list[str], metadatas: list[dict]):
+        self.texts = texts
+        self.metadatas = metadatas
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def document(self, doc_idx: int) -> Document:
+        return Document(page_content=self.texts[doc_idx], metadata=dict(self.metadatas[doc_idx]))
+
+
+def _tokenize_postings(documents: list[Document],
+                       vocabulary: dict[str, int],
+                       preprocess_func: Callable[[str], list[str]],
+                       doc_offset: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+        Tokenize the documents into unordered (term_id, doc_idx, tf) postings and doc lengths.
+        New terms are added to vocabulary. Doc indices start at doc_offset.
+    """
+    posting_term_ids = []
+    posting_doc_ids = []
+    posting_tfs = []
+    doc_lengths = np.zeros(len(documents), dtype=np.float32)
+
+    # The default tokenizer has a batch api
+    texts = [doc.page_content for doc in documents]
+    if preprocess_func is tokenize_text:
+        token_lists = tokenize_texts(texts)
+    else:
+        token_lists = [preprocess_func(text) for text in texts]
+
+    for doc_idx, tokens in enumerate(token_lists):
+        doc_lengths[doc_idx] = len(tokens)
+
+        for term, count in Counter(tokens).items():
+            term_id = vocabulary.setdefault(term, len(vocabulary))
+            posting_term_ids.append(term_id)
+            posting_doc_ids.append(doc_offset + doc_idx)
+            posting_tfs.append(count)
+
+    return (
+        np.asarray(posting_term_ids, dtype=np.int32),
+        np.asarray(posting_doc_ids, dtype=np.int32),
+        np.asarray(posting_tfs, dtype=np.float32),
+        doc_lengths
+    )
+
+
+def to_doc_id(value) -> int:
+    """
+        Convert the id in document metadata to an int. Returns -1 if it's not an integer id.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
@@ -0,0 +1,247 @@
+import bisect
+import json
+import mmap
+import os
+import pickle
+import struct
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.retrievers import BM25Retriever
+
+from lib.bm25_search.bm25_engine import BM25Engine, InMemoryDocStore, to_doc_id
+from lib.utils.text_utils import tokenize_text
+
+# On disk layout. All numbers are little endian.
+#
+#   header   magic, version, counts, k1, b and the section table (offset, length) pairs
+#   sections each one starts on a SECTION_ALIGNMENT boundary
+#
+# Terms are stored in sorted utf-8 order, so the term id is the position in the sorted vocabulary
+# and a lookup is a binary search over the mapped vocabulary. Nothing is decoded up front.
+MAGIC = b"ORCBM25\x00"
+FORMAT_VERSION = 1
+SECTION_ALIGNMENT = 64
+
+SECTION_VOCAB_OFFSETS = 0
+SECTION_VOCAB_BLOB = 1
+SECTION_INDPTR = 2
+SECTION_POSTING_DOC_IDS = 3
+SECTION_POSTING_TFS = 4
+SECTION_IDF = 5
+SECTION_DOC_NORMS = 6
+SECTION_DOC_IDS = 7
+SECTION_DOC_OFFSETS = 8
+SECTION_DOC_BLOB = 9
+SECTION_COUNT = 10
+
+# magic, version, section count, num docs, num terms, num postings, k1, b
+HEADER_STRUCT = struct.Struct("<8sIIQQQdd")
+SECTION_STRUCT = struct.Struct("<QQ")
+HEADER_SIZE = HEADER_STRUCT.size + SECTION_COUNT * SECTION_STRUCT.size
+
+
+class BM25IndexFormatError(Exception):
+    """
+        The index file is not a bm25 index or was written by an incompatible format version.
+    """
+
+
+class MappedVocabulary:
+    """
+        Sorted vocabulary read straight from the mapped file.
+    """
+
+    def __init__(self, offsets: np.ndarray, blob: memoryview):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id: int) -> bytes:
+        return bytes(self.blob[self.offsets[term_id]:self.offsets[term_id + 1]])
+
+    def get(self, term: str, default: int = -1) -> int:
+        key = term.encode("utf-8")
+        term_id = bisect.bisect_left(self, key)
+        if term_id < len(self) and self[term_id] == key:
+            return term_id
+        return default
+
+    def items(self):
+        for term_id in range(len(self)):
+            yield self[term_id].decode("utf-8"), term_id
+
+
+class MappedDocStore:
+    """
+        Stored documents read straight from the mapped file. Each document is decoded only when it's returned.
+    """
+
+    def __init__(self, offsets: np.ndarray, blob: memoryview):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def document(self, doc_idx: int) -> Document:
+        record = json.loads(
+            bytes(self.blob[self.offsets[doc_idx]:self.offsets[doc_idx + 1]]))
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+
+def write_bm25_index(engine: BM25Engine, path: str):
+    """
+        Write the engine to path in the binary index format.
+        The file is written next to the target first and moved into place, so readers never see a partial index.
+    """
+    # Sort the vocabulary and reorder the postings to match the new term ids
+    terms = sorted((term.encode("utf-8"), term_id)
+                   for term, term_id in engine.vocabulary.items())
+    old_term_ids = np.asarray([term_id for _, term_id in terms], dtype=np.int64)
+
+    doc_freqs = np.diff(engine.indptr)[old_term_ids]
+    indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(doc_freqs, out=indptr[1:])
+
+    posting_order = np.concatenate(
+        [np.arange(engine.indptr[term_id], engine.indptr[term_id + 1]) for term_id in old_term_ids]
+    ).astype(np.int64) if len(terms) else np.empty(0, dtype=np.int64)
+
+    vocab_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    np.cumsum([len(term) for term, _ in terms], out=vocab_offsets[1:])
+
+    doc_records = [
+        json.dumps({"page_content": doc.page_content, "metadata": doc.metadata},
+                   ensure_ascii=False).encode("utf-8")
+        for doc in (engine.doc_store.document(doc_idx) for doc_idx in range(engine.num_docs))
+    ]
+    doc_offsets = np.zeros(len(doc_records) + 1, dtype=np.uint64)
+    np.cumsum([len(record) for record in doc_records], out=doc_offsets[1:])
+
+    sections = [None] * SECTION_COUNT
+    sections[SECTION_VOCAB_OFFSETS] = vocab_offsets.tobytes()
+    sections[SECTION_VOCAB_BLOB] = b"".join(term for term, _ in terms)
+    sections[SECTION_INDPTR] = indptr.tobytes()
+    sections[SECTION_POSTING_DOC_IDS] = np.asarray(
+        engine.posting_doc_ids, dtype="<i4")[posting_order].tobytes()
+    sections[SECTION_POSTING_TFS] = np.asarray(
+        engine.posting_tfs, dtype="<f4")[posting_order].tobytes()
+    sections[SECTION_IDF] = np.asarray(
+        engine.idf, dtype="<f4")[old_term_ids].tobytes()
+    sections[SECTION_DOC_NORMS] = np.asarray(
+        engine.doc_norms, dtype="<f4").tobytes()
+    sections[SECTION_DOC_IDS] = np.asarray(
+        engine.doc_ids, dtype="<i8").tobytes()
+    sections[SECTION_DOC_OFFSETS] = doc_offsets.tobytes()
+    sections[SECTION_DOC_BLOB] = b"".join(doc_records)
+
+    # Lay out the sections on aligned offsets
+    section_table = []
+    offset = _align(HEADER_SIZE)
+    for data in sections:
+        section_table.append((offset, len(data)))
+        offset = _align(offset + len(data))
+
+    header = HEADER_STRUCT.pack(
+        MAGIC, FORMAT_VERSION, SECTION_COUNT, engine.num_docs, len(terms),
+        len(posting_order), engine.k1, engine.b)
+    for section_offset, length in section_table:
+        header += SECTION_STRUCT.pack(section_offset, length)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        for (section_offset, _), data in zip(section_table, sections):
+            f.write(b"\x00" * (section_offset - f.tell()))
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+def open_bm25_index(path: str) -> BM25Engine:
+    """
+        Memory map the index at path. Only the header is parsed, so opening is O(1).
+        The pages are read lazily and shared with other processes through the page cache.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < HEADER_SIZE:
+            raise BM25IndexFormatError(f"{path} is too small to be a bm25 index.")
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, section_count, num_docs, num_terms, num_postings, k1, b = HEADER_STRUCT.unpack_from(
+        buffer, 0)
+    if magic != MAGIC:
+        raise BM25IndexFormatError(f"{path} is not a bm25 index.")
+    if version != FORMAT_VERSION or section_count != SECTION_COUNT:
+        raise BM25IndexFormatError(
+            f"{path} has index format version {version} but version {FORMAT_VERSION} is required. Please rebuild the index.")
+
+    view = memoryview(buffer)
+
+    def section(section_id: int) -> memoryview:
+        section_offset, length = SECTION_STRUCT.unpack_from(
+            buffer, HEADER_STRUCT.size + section_id * SECTION_STRUCT.size)
+        return view[section_offset:section_offset + length]
+
+    def array(section_id: int, dtype: str) -> np.ndarray:
+        return np.frombuffer(section(section_id), dtype=dtype)
+
+    return BM25Engine(
+        vocabulary=MappedVocabulary(
+            offsets=array(SECTION_VOCAB_OFFSETS, "<u8"),
+            blob=section(SECTION_VOCAB_BLOB)
+        ),
+        indptr=array(SECTION_INDPTR, "<i8"),
+        posting_doc_ids=array(SECTION_POSTING_DOC_IDS, "<i4"),
+        posting_tfs=array(SECTION_POSTING_TFS, "<f4"),
+        doc_norms=array(SECTION_DOC_NORMS, "<f4"),
+        idf=array(SECTION_IDF, "<f4"),
+        doc_store=MappedDocStore(
+            offsets=array(SECTION_DOC_OFFSETS, "<u8"),
+            blob=section(SECTION_DOC_BLOB)
+        ),
+        doc_ids=array(SECTION_DOC_IDS, "<i8"),
+        k1=k1,
+        b=b
+    )
+
+
+def convert_pickle_index(pickle_path: str, index_path: str):
+    """
+        Convert a pickled index (BM25Retriever or BM25Engine) into the binary index format.
+        Pickle can run arbitrary code. Only convert files this app wrote itself.
+    """
+    with open(pickle_path, "rb") as f:
+        index = pickle.load(f)
+
+    if isinstance(index, BM25Retriever):
+        # Retriever docs already have the title in their page content
+        index = BM25Engine.from_documents(
+            documents=index.docs,
+            preprocess_func=tokenize_text,
+            k1=index.vectorizer.k1,
+            b=index.vectorizer.b,
+            epsilon=index.vectorizer.epsilon
+        )
+    elif isinstance(index, BM25Engine) and not hasattr(index, "doc_store"):
+        # Engines pickled before the doc store existed kept the texts and metadata as lists
+        index.doc_store = InMemoryDocStore(
+            texts=index.texts, metadatas=index.metadatas)
+        index.doc_ids = np.asarray([to_doc_id(metadata.get("id"))
+                                    for metadata in index.metadatas], dtype=np.int64)
+    elif not isinstance(index, BM25Engine):
+        raise BM25IndexFormatError(
+            f"{pickle_path} does not contain a bm25 index.")
+
+    write_bm25_index(index, index_path)
+    print(f"Converted {pickle_path} to {index_path}")
+
+
+def _align(offset: int) -> int:
+    return (offset + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
@@ -1,11 +1,11 @@
 import os
 from lib.utils.text_utils import tokenize_text
 from langchain_core.documents import Document
-from langchain_community.retrievers import BM25Retriever
+from lib.bm25_search.bm25_engine import BM25Engine
+from lib.bm25_search.bm25_index_format import write_bm25_index, open_bm25_index, convert_pickle_index
 
 import lib.utils.constants as constants
 import lib.utils.data_loader_utils as data_loader_utils
-import pickle
 
 
 class InvertedIndex:
@@ -26,19 +26,17 @@ class InvertedIndex:
                 f"Successfully loaded json and created langchain docs")
 
             # Create the index
-            index: BM25Retriever = BM25Retriever.from_documents(
+            index = BM25Engine.from_documents(
                 documents=documents,
-                preprocess_func=tokenize_text,
-                k=25
+                preprocess_func=tokenize_text
             )
 
             print(f"Indexing complete {index}")
 
-            # Save the index into the pickle file
+            # Save the index into the index file
             try:
-                with open(constants.INDEX_FILE_PATH, 'wb') as f:
-                    pickle.dump(index, f)
-                    print(f"Successfully saved the index")
+                write_bm25_index(index, constants.INDEX_FILE_PATH)
+                print(f"Successfully saved the index")
             except Exception as e:
                 print(f"Error saving the index. {e}")
 
@@ -67,29 +65,39 @@ class InvertedIndex:
         """
             Do a bm25 search from saved index.
         """
-        retriever = self._build_or_load_index()
+        index = self._build_or_load_index()
 
-        # Set the top k results to the given limit.
-        retriever.k = limit
+        return index.search(query, limit)
 
-        # Change the k value after testing
-        docs = retriever.invoke(query)
-
-        return docs
-
-    def _build_or_load_index(self) -> BM25Retriever:
+    def _build_or_load_index(self) -> BM25Engine:
         """
             If the index hasn't been built yet, build it first.
             Then load the index and return it.
         """
+        # Convert the index saved in the old pickle format
+        self._convert_legacy_index(
+            constants.LEGACY_INDEX_FILE_PATH, constants.INDEX_FILE_PATH)
+
         # If index does not exist, build it first.
         if not os.path.exists(constants.INDEX_FILE_PATH):
             self.build()
 
         # Load the index and return
         try:
-            with open(constants.INDEX_FILE_PATH, 'rb') as f:
-                index = pickle.load(f)
-                return index
+            return open_bm25_index(constants.INDEX_FILE_PATH)
         except Exception as e:
             print(f"Error loading the index {e}")
+
+    def _convert_legacy_index(self, legacy_path: str, index_path: str):
+        """
+            Convert an index saved as pickle into the memory mapped format and remove the pickle.
+            Does nothing if there is no pickle or the index is already converted.
+        """
+        if not os.path.exists(legacy_path) or os.path.exists(index_path):
+            return
+
+        try:
+            convert_pickle_index(legacy_path, index_path)
+            os.remove(legacy_path)
+        except Exception as e:
+            print(f"Error converting the legacy index {legacy_path}. {e}")
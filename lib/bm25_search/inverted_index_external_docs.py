@@ -2,11 +2,19 @@ from lib.bm25_search.inverted_index import InvertedIndex
 import os
 from lib.utils.text_utils import tokenize_text
 from langchain_core.documents import Document
-from langchain_community.retrievers import BM25Retriever
+from lib.bm25_search.bm25_engine import BM25Engine
+from lib.bm25_search.bm25_index_format import write_bm25_index, open_bm25_index
 
 import lib.utils.constants as constants
 import lib.utils.data_loader_utils as data_loader_utils
-import pickle
+from lib.semantic_search.user_vector_store_cache import USER_VECTOR_STORE_CACHE, BM25_RETRIEVER
+from lib.utils.metrics_utils import BACKEND_BM25, STAGE_BM25_INDEX_LOAD, STAGE_BM25_SEARCH, measure_stage
+
+
+class BM25IndexLoadError(Exception):
+    """
+        The saved index of the user exists but couldn't be loaded. It can't be searched or updated until it's rebuilt.
+    """
 
 
 class InvertedIndexExternalDocs(InvertedIndex):
@@ -21,27 +29,86 @@ class InvertedIndexExternalDocs(InvertedIndex):
             f"Successfully loaded json and created langchain docs")
 
         # Create the index
-        index: BM25Retriever = BM25Retriever.from_documents(
+        index = BM25Engine.from_documents(
             documents=documents,
-            preprocess_func=tokenize_text,
-            k=25
+            preprocess_func=tokenize_text
         )
 
         print(f"Indexing complete {index}")
 
-        # Save the index into the pickle file
+        # Save the index into the index file
         try:
-            with open(self._uid_to_file_path(uid), 'wb') as f:
-                pickle.dump(index, f)
-                print(f"Successfully saved the index")
+            write_bm25_index(index, self._uid_to_file_path(uid))
+            print(f"Successfully saved the index")
         except Exception as e:
             print(f"Error saving the index. {e}")
 
-    def _load_index(self, uid: str) -> BM25Retriever:
+        # Drop the stale index from the cache
+        USER_VECTOR_STORE_CACHE.invalidate(uid, BM25_RETRIEVER)
+
+    def update(self, documents: list[Document], removed_ids: list[int], uid: str, rebuild: bool = False):
+        """
+            Add or replace the given documents and drop removed_ids in the saved index.
+            Only the given documents are tokenized. Builds the index from the documents if rebuild is set or there is no index yet.
+            Raises BM25IndexLoadError if there is an index that can't be loaded. Raises if the index can't be saved.
+        """
+        index = None
+        if not rebuild and self.has_index(uid):
+            # The unchanged docs are only in the saved index. Building from the given documents would drop them.
+            try:
+                index = self._load_index_from_disk(uid)
+            except BM25IndexLoadError:
+                raise
+            except Exception as e:
+                # The legacy index couldn't be converted
+                raise BM25IndexLoadError(f"Could not load the index of {uid}. {e}") from e
+
+        # Transform the documents. Add title before details in page content
+        documents = self._transform_docs(documents)
+
+        if index is None:
+            index = BM25Engine.from_documents(
+                documents=documents,
+                preprocess_func=tokenize_text
+            )
+        else:
+            index = index.update(
+                documents=documents,
+                removed_ids=removed_ids,
+                preprocess_func=tokenize_text
+            )
+
+        print(f"Indexing complete {index}")
+
+        write_bm25_index(index, self._uid_to_file_path(uid))
+
+        # Drop the stale index from the cache
+        USER_VECTOR_STORE_CACHE.invalidate(uid, BM25_RETRIEVER)
+
+    def has_index(self, uid: str) -> bool:
+        return os.path.exists(self._uid_to_file_path(uid)) or os.path.exists(self._uid_to_legacy_file_path(uid))
+
+    def _load_index(self, uid: str) -> BM25Engine:
+        """
+            Return the index of the user from the cache.
+            If it's not cached yet, load it from disk and cache it.
+        """
+        return USER_VECTOR_STORE_CACHE.get_or_load(
+            uid=uid,
+            kind=BM25_RETRIEVER,
+            loader=lambda: self._load_index_from_disk(uid),
+            size_func=lambda _: os.path.getsize(self._uid_to_file_path(uid))
+        )
+
+    def _load_index_from_disk(self, uid: str) -> BM25Engine:
         """
             If the index hasn't been built yet, raise an Exception.
-            If it's already built, just laod the index.
+            If it's already built, just laod the index. Raises BM25IndexLoadError if it can't be loaded.
         """
+        # Convert the index saved in the old pickle format
+        self._convert_legacy_index(
+            self._uid_to_legacy_file_path(uid), self._uid_to_file_path(uid))
+
         # If index does not exist, build it first.
         if not os.path.exists(self._uid_to_file_path(uid)):
             raise Exception(
@@ -49,25 +116,22 @@ class InvertedIndexExternalDocs(InvertedIndex):
 
         # Load the index and return
         try:
-            with open(self._uid_to_file_path(uid), 'rb') as f:
-                index = pickle.load(f)
-                return index
+            with measure_stage(STAGE_BM25_INDEX_LOAD, BACKEND_BM25):
+                return open_bm25_index(self._uid_to_file_path(uid))
         except Exception as e:
-            print(f"Error loading the index {e}")
+            raise BM25IndexLoadError(f"Could not load the index of {uid}. {e}") from e
 
     def bm25_search(self, uid: str, query: str, limit: int):
         """
             Do a bm25 search from saved index.
         """
-        retriever = self._load_index(uid=uid)
-
-        # Set the top k results to the given limit.
-        retriever.k = limit
+        index = self._load_index(uid=uid)
 
-        # Change the k value after testing
-        docs = retriever.invoke(query)
-
-        return docs
+        with measure_stage(STAGE_BM25_SEARCH, BACKEND_BM25):
+            return index.search(query, limit)
 
     def _uid_to_file_path(self, uid: str):
-        return f"cache/{uid}.pkl"
+        return f"{constants.INDEX_DIR}/{uid}.bm25"
+
+    def _uid_to_legacy_file_path(self, uid: str):
+        return f"{constants.INDEX_DIR}/{uid}.pkl"
@@ -0,0 +1,175 @@
+from itertools import chain
+from typing import NamedTuple, Sequence
+
+import numpy as np
+
+import lib.utils.constants as constants
+
+FUSION_RRF = "rrf"
+FUSION_COMBSUM = "combsum"
+FUSION_COMBMNZ = "combmnz"
+
+
+class FusedResult(NamedTuple):
+    """
+        One fused document. ranks has the 1 based rank from each source in input order. 0 means the source didn't return it.
+    """
+    id: object
+    score: float
+    ranks: tuple[int, ...]
+
+
+def fuse(ranked_ids: Sequence[Sequence],
+         weights: Sequence[float] = None,
+         mode: str = FUSION_RRF,
+         k: float = constants.K_VALUE,
+         scores: Sequence[Sequence[float]] = None,
+         limit: int = None) -> list[FusedResult]:
+    """
+        Fuse N ranked id lists (best first) into one ranking.
+
+        rrf      sum of weight / (k + rank)
+        combsum  sum of weight * normalized score
+        combmnz  combsum * number of sources that returned the doc
+
+        CombSUM and CombMNZ min-max normalize the given scores of each source (higher is better).
+        Without scores, a rank based score (n - rank + 1) / n is used.
+        Ties keep the order in which the docs first appeared in the inputs.
+    """
+    num_sources = len(ranked_ids)
+    weights = np.ones(num_sources) if weights is None else np.asarray(
+        weights, dtype=np.float64)
+    lengths = np.asarray([len(ids) for ids in ranked_ids], dtype=np.int64)
+    if num_sources == 0 or lengths.sum() == 0:
+        return []
+
+    # Map every id to a column. inverse[i] is the column of the i-th id in the concatenated lists.
+    flat_ids = list(chain.from_iterable(ranked_ids))
+    unique_ids, inverse = _unique_ids(flat_ids)
+    num_docs = len(unique_ids)
+
+    source_idx = np.repeat(np.arange(num_sources), lengths)
+    positions = np.concatenate([np.arange(1, length + 1) for length in lengths])
+
+    # rank_matrix[source, doc]. Written backwards so the best rank wins if a source repeats an id.
+    rank_matrix = np.zeros((num_sources, num_docs), dtype=np.int64)
+    rank_matrix[source_idx[::-1], inverse[::-1]] = positions[::-1]
+    present = rank_matrix > 0
+
+    if mode == FUSION_RRF:
+        contributions = np.where(present, 1.0 / (k + rank_matrix), 0.0)
+    elif mode in (FUSION_COMBSUM, FUSION_COMBMNZ):
+        contributions = _normalized_scores(
+            rank_matrix, present, lengths, source_idx, inverse, scores)
+    else:
+        raise ValueError(f"Unknown fusion mode {mode}")
+
+    fused_scores = weights @ contributions
+    if mode == FUSION_COMBMNZ:
+        fused_scores = fused_scores * present.sum(axis=0)
+
+    # First position of each doc in the inputs. Used to break ties.
+    first_seen = np.full(num_docs, len(flat_ids), dtype=np.int64)
+    np.minimum.at(first_seen, inverse, np.arange(len(flat_ids)))
+
+    # Select the top docs without sorting everything
+    candidates = np.arange(num_docs)
+    if limit is not None and limit < num_docs:
+        # argpartition picks any of the docs tied at the cut. Keep all of them so the tie break decides.
+        cutoff = fused_scores[np.argpartition(-fused_scores, limit - 1)[limit - 1]]
+        candidates = np.flatnonzero(fused_scores >= cutoff)
+    order = candidates[np.lexsort(
+        (first_seen[candidates], -fused_scores[candidates]))][:limit]
+
+    ranks = rank_matrix[:, order].T.tolist()
+    return [
+        FusedResult(id=doc_id, score=score, ranks=tuple(doc_ranks))
+        for doc_id, score, doc_ranks in zip(unique_ids[order].tolist(), fused_scores[order].tolist(), ranks)
+    ]
+
+
+def is_rrf_top_k_settled(results: list[FusedResult],
+                         limit: int,
+                         depths: Sequence[int],
+                         exhausted: Sequence[bool],
+                         weights: Sequence[float] = None,
+                         k: float = constants.K_VALUE) -> bool:
+    """
+        Check if fetching deeper candidates can still change which docs are in the rrf top results, or their order.
+        results must be the full rrf fusion of the current candidates.
+        A doc missing from source i can at most gain weight_i / (k + depth_i + 1) from it. (0 if the source is exhausted)
+        The top results are settled when their lowest score beats the best score any other doc can still reach,
+        and no top result can still overtake the one ranked above it.
+    """
+    num_sources = len(depths)
+    weights = np.ones(num_sources) if weights is None else np.asarray(
+        weights, dtype=np.float64)
+    bounds = np.where(np.asarray(exhausted), 0.0,
+                      weights / (k + np.asarray(depths) + 1))
+
+    # Docs that haven't shown up in any source yet
+    best_challenger = float(bounds.sum())
+    if len(results) < limit:
+        return best_challenger == 0.0
+
+    top = results[:limit]
+    top_scores = np.asarray([result.score for result in top])
+    top_missing = np.asarray([result.ranks for result in top]) == 0
+    # Results are sorted, so each one only has to stay behind the one right above it
+    if np.any(top_scores[:-1] < top_scores[1:] + top_missing[1:] @ bounds):
+        return False
+
+    lowest_top_score = float(top_scores.min())
+    rest = results[limit:]
+    if rest:
+        scores = np.asarray([result.score for result in rest])
+        missing = np.asarray([result.ranks for result in rest]) == 0
+        best_challenger = max(best_challenger, float(
+            (scores + missing @ bounds).max()))
+
+    return lowest_top_score >= best_challenger
+
+
+def _unique_ids(flat_ids: list) -> tuple[np.ndarray, np.ndarray]:
+    """
+        Unique ids and the column of each id. Integer ids use np.unique.
+        Other ids (strings or mixed types) are mapped with a dict so their python values are kept.
+    """
+    all_ids = np.asarray(flat_ids)
+    if all_ids.ndim == 1 and all_ids.dtype.kind in "iu":
+        return np.unique(all_ids, return_inverse=True)
+
+    columns: dict = {}
+    inverse = np.fromiter((columns.setdefault(doc_id, len(columns)) for doc_id in flat_ids),
+                          dtype=np.int64, count=len(flat_ids))
+    unique_ids = np.empty(len(columns), dtype=object)
+    unique_ids[:] = list(columns)
+    return unique_ids, inverse
+
+
+def _normalized_scores(rank_matrix: np.ndarray,
+                       present: np.ndarray,
+                       lengths: np.ndarray,
+                       source_idx: np.ndarray,
+                       inverse: np.ndarray,
+                       scores: Sequence[Sequence[float]] = None) -> np.ndarray:
+    """
+        Per source scores in [0, 1] laid out like rank_matrix. Missing docs get 0.
+    """
+    if scores is None:
+        # Rank based score. Best rank gets 1.
+        source_lengths = lengths[:, None].astype(np.float64)
+        return np.where(present, (source_lengths - rank_matrix + 1) / np.maximum(source_lengths, 1), 0.0)
+
+    score_matrix = np.zeros(rank_matrix.shape, dtype=np.float64)
+    for source, source_scores in enumerate(scores):
+        source_scores = np.asarray(source_scores, dtype=np.float64)
+        if len(source_scores) == 0:
+            continue
+        low, high = source_scores.min(), source_scores.max()
+        normalized = np.ones_like(source_scores) if high == low else (
+            source_scores - low) / (high - low)
+        columns = inverse[source_idx == source]
+        # Written backwards so the first (best) occurrence wins
+        score_matrix[source, columns[::-1]] = normalized[::-1]
+    return score_matrix
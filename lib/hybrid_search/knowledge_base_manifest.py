@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+from typing import NamedTuple
+
+from langchain_core.documents import Document
+
+import lib.utils.constants as constants
+from lib.semantic_search.embedding_backends import embedding_fingerprint
+
+MANIFEST_VERSION = 1
+
+
+class ManifestDiff(NamedTuple):
+    """
+        Doc ids of a knowledge base build grouped by what happened to them.
+    """
+    added: list[int]
+    updated: list[int]
+    unchanged: list[int]
+    removed: list[int]
+
+    def counts(self) -> dict:
+        return {
+            "added": len(self.added),
+            "updated": len(self.updated),
+            "unchanged": len(self.unchanged),
+            "removed": len(self.removed),
+        }
+
+
+def document_hash(doc: Document) -> str:
+    """
+        Content hash of a knowledge base doc. Covers the details and the title.
+        Other metadata such as the loader's seq_num changes with the doc position and is left out.
+    """
+    payload = json.dumps(
+        {"title": doc.metadata.get("title"), "details": doc.page_content},
+        sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def diff_manifest(old_hashes: dict[int, str], new_hashes: dict[int, str]) -> ManifestDiff:
+    """
+        Compare the doc hashes of the last build with the new ones.
+    """
+    added, updated, unchanged = [], [], []
+    for doc_id, doc_hash in new_hashes.items():
+        if doc_id not in old_hashes:
+            added.append(doc_id)
+        elif old_hashes[doc_id] != doc_hash:
+            updated.append(doc_id)
+        else:
+            unchanged.append(doc_id)
+
+    removed = [doc_id for doc_id in old_hashes if doc_id not in new_hashes]
+    return ManifestDiff(added=added, updated=updated, unchanged=unchanged, removed=removed)
+
+
+def load_manifest(uid: str) -> dict[int, str] | None:
+    """
+        Return the doc hashes of the last build of the user.
+        Returns None if there is no usable manifest, which means everything has to be rebuilt.
+    """
+    path = manifest_path(uid)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading the manifest {path}: {e}")
+        return None
+
+    # Vectors made by another embedding model can't be mixed with new ones
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("embedding_model") != embedding_fingerprint():
+        return None
+
+    # Json keys are strings
+    return {int(doc_id): doc_hash for doc_id, doc_hash in manifest["documents"].items()}
+
+
+def save_manifest(uid: str, hashes: dict[int, str]):
+    """
+        Save the doc hashes of the build. Written to a temporary file first and moved into place.
+    """
+    path = manifest_path(uid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "embedding_model": embedding_fingerprint(),
+        "documents": {str(doc_id): doc_hash for doc_id, doc_hash in hashes.items()},
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def delete_manifest(uid: str):
+    """
+        Forget the last build so the next one rebuilds everything.
+    """
+    try:
+        os.remove(manifest_path(uid))
+    except FileNotFoundError:
+        pass
+
+
+def manifest_path(uid: str) -> str:
+    return f"{constants.INDEX_DIR}/{uid}.manifest.json"
@@ -1,7 +1,17 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable
 from lib.semantic_search.semantic_search import SemanticSearch
 from lib.bm25_search.inverted_index import InvertedIndex
 from langchain_core.documents import Document
+from lib.hybrid_search.fusion import FUSION_RRF, fuse, is_rrf_top_k_settled
 import lib.utils.constants as constants
+from lib.utils.metrics_utils import STAGE_FUSION, measure_stage
+
+# Runs the other retrievers of a rrf search while the calling thread runs the first one
+RETRIEVER_EXECUTOR = ThreadPoolExecutor(
+    max_workers=constants.RRF_RETRIEVER_MAX_WORKERS, thread_name_prefix="rrf-retriever")
 
 
 class RRFSearch:
@@ -12,71 +22,134 @@ class RRFSearch:
         self.semantic_search = SemanticSearch()
         self.semantic_search.build_or_load_embeddings()
 
-    def rrf_search(self, query: str, limit: int, k: int = constants.K_VALUE):
-        bm25_results = self.inverted_index.bm25_search(
-            query=query, limit=limit * 500)
-
-        semantic_results = self.semantic_search.semantic_search(
-            query=query, limit=limit * 500)
-
-        result_dict: dict[str: Document] = {}
-
-        # Add bm25 search results
-        for index, bm_25_doc in enumerate(bm25_results):
-            # Get the rannk
-            bm25_rank = index + 1
-            # Get the doc id
-            doc_id = bm_25_doc.metadata["id"]
-            # Update the doc with bm25 rank
-            bm_25_doc.metadata["bm25_rank"] = bm25_rank
-            # Add placeholder for semantic rank
-            bm_25_doc.metadata["semantic_rank"] = 0.0
-            # Put in the result dict
-            result_dict[doc_id] = bm_25_doc
-
-        # Add semantic search results
-        for index, semantic_search_doc in enumerate(semantic_results):
-            # Get the rank
-            semantic_rank = index + 1
-            # Get the doc id
-            doc_id = semantic_search_doc.metadata["id"]
-
-            if doc_id in result_dict:
-                existing_doc = result_dict[doc_id]
-                existing_doc.metadata["semantic_rank"] = semantic_rank
-            else:
-                semantic_search_doc.metadata["semantic_rank"] = semantic_rank
-                semantic_search_doc.metadata["bm25_rank"] = 0.0
-                result_dict[doc_id] = semantic_search_doc
-
-        # Get the values
-        result = list(result_dict.values())
-
-        # Calculate rrf and update the results
-        for doc in result:
-            bm25_rank = doc.metadata["bm25_rank"]
-            semantic_rank = doc.metadata["semantic_rank"]
-
-            rrf_bm25 = 0.0
-            if bm25_rank != 0:
-                rrf_bm25 = self.rrf_score(bm25_rank, k)
-
-            rrf_semantic = 0.0
-            if semantic_rank != 0:
-                rrf_semantic = self.rrf_score(semantic_rank, k)
-
-            rrf_score = round(rrf_bm25 + rrf_semantic, 5)
-            doc.metadata["rrf_score"] = rrf_score
-
-        # Sort the results
-        result.sort(key=lambda doc: float(
-            doc.metadata["rrf_score"]), reverse=True)
+    def rrf_search(self, query: str, limit: int, k: int = constants.K_VALUE,
+                   candidate_depth: int = None, early_stop: bool = constants.RRF_EARLY_STOP):
+        """
+            Do a rrf search for given query.
+            candidate_depth is the number of candidates fetched from each retriever. Defaults to a small multiple of limit.
+            With early_stop, candidates are fetched in growing rounds until the top results can't change any more.
+        """
+        return self._fused_search(
+            retrievers={
+                "bm25": lambda depth: self.inverted_index.bm25_search(
+                    query=query, limit=depth),
+                "semantic": lambda depth: self.semantic_search.semantic_search(
+                    query=query, limit=depth),
+            },
+            limit=limit,
+            k=k,
+            candidate_depth=candidate_depth,
+            early_stop=early_stop
+        )
+
+    def candidate_depth(self, limit: int) -> int:
+        """
+            Default number of candidates fetched from each retriever for the given limit.
+        """
+        return max(limit * constants.RRF_CANDIDATE_MULTIPLIER, constants.RRF_MIN_CANDIDATE_DEPTH)
+
+    def _fused_search(self,
+                      retrievers: dict[str, Callable[[int], list[Document]]],
+                      limit: int,
+                      k: float,
+                      candidate_depth: int = None,
+                      early_stop: bool = False) -> list[Document]:
+        """
+            Fetch candidates from every retriever and fuse them.
+            retrievers maps the retriever name to a search taking the number of candidates to fetch.
+            The rank from each retriever is written into the doc metadata as <name>_rank.
+            Early stop only applies to rrf fusion. Other modes fetch candidate_depth candidates in one round.
+        """
+        names = list(retrievers)
+        weights = [constants.FUSION_WEIGHTS.get(name, 1.0) for name in names]
+
+        # The stop check bounds rrf scores. CombSUM and CombMNZ scores are normalized over the fetched lists,
+        # so deeper candidates can change every score and no such bound holds.
+        early_stop = early_stop and constants.FUSION_MODE == FUSION_RRF
+
+        if early_stop:
+            # Start small and double the depth until the top results are settled
+            depth = max(limit, 1)
+            max_depth = candidate_depth or constants.RRF_EARLY_STOP_MAX_DEPTH
+        else:
+            depth = candidate_depth or self.candidate_depth(limit)
+            max_depth = depth
+
+        while True:
+            results, timings = self._run_retrievers(
+                {name: partial(search, depth) for name, search in retrievers.items()})
+            with measure_stage(STAGE_FUSION, constants.FUSION_MODE):
+                fused = fuse(
+                    ranked_ids=[[doc.metadata["id"] for doc in results[name]]
+                                for name in names],
+                    weights=weights,
+                    mode=constants.FUSION_MODE,
+                    k=k,
+                    limit=None if early_stop else limit
+                )
+
+            # A retriever that returned less than asked for has no more candidates
+            exhausted = [len(results[name]) < depth for name in names]
+            if depth >= max_depth or all(exhausted):
+                break
+            if is_rrf_top_k_settled(fused, limit, [depth] * len(names), exhausted, weights, k):
+                break
+            depth = min(depth * 2, max_depth)
+
+        # Map the fused ids back to the docs. The first retriever returning a doc provides it.
+        docs_by_id = {}
+        for name in reversed(names):
+            docs_by_id.update(
+                (doc.metadata["id"], doc) for doc in results[name])
+
+        timings["candidate_depth"] = depth
+        result = []
+        for fused_result in fused[:limit]:
+            doc = docs_by_id[fused_result.id]
+            for name, rank in zip(names, fused_result.ranks):
+                doc.metadata[f"{name}_rank"] = rank
+            doc.metadata["rrf_score"] = round(fused_result.score, 5)
+            # Per retriever timings of the last round. Shows which leg dominates the latency.
+            doc.metadata.update(timings)
+            result.append(doc)
 
         # Return the limited results
-        return result[:limit]
+        return result
+
+    def _run_retrievers(self, retrievers: dict[str, Callable[[], list[Document]]]):
+        """
+            Run the retriever searches at the same time and time each of them.
+            The first one runs in the calling thread, the others in RETRIEVER_EXECUTOR.
+            Returns (results by name, timings). Timings are in milliseconds.
+        """
+        start = time.perf_counter()
+        searches = list(retrievers.items())
+        futures = {name: RETRIEVER_EXECUTOR.submit(_timed, search)
+                   for name, search in searches[1:]}
+
+        results = {}
+        timings = {}
+        first_name, first_search = searches[0]
+        results[first_name], timings[f"{first_name}_ms"] = _timed(
+            first_search)
+        for name, future in futures.items():
+            results[name], timings[f"{name}_ms"] = future.result()
+
+        timings["retrieval_ms"] = round(
+            (time.perf_counter() - start) * 1000, 3)
+        return results, timings
 
     def rrf_score(self, rank, k=60.0):
         """
             Calculate the reciprocral rank fusion score based on rank and k
         """
         return 1.0 / (k + rank)
+
+
+def _timed(func: Callable[[], list[Document]]) -> tuple[list[Document], float]:
+    """
+        Call func and return its result with the elapsed milliseconds.
+    """
+    start = time.perf_counter()
+    result = func()
+    return result, round((time.perf_counter() - start) * 1000, 3)
@@ -1,86 +1,94 @@
+from typing import Callable
 from lib.hybrid_search.rrf_search import RRFSearch
-from lib.bm25_search.inverted_index_external_docs import InvertedIndexExternalDocs
+from lib.bm25_search.inverted_index_external_docs import BM25IndexLoadError, InvertedIndexExternalDocs
 from lib.semantic_search.semantic_search_external_docs import SemanticSearchExternalDocs
+from lib.semantic_search.user_vector_store_cache import USER_VECTOR_STORE_CACHE
+from lib.hybrid_search.knowledge_base_manifest import document_hash, diff_manifest, load_manifest, save_manifest, delete_manifest
 
 import lib.utils.constants as constants
+from lib.utils.metrics_utils import BACKEND_BM25, STAGE_BM25_INDEX_UPDATE, STAGE_EMBEDDING_UPDATE, measure_stage
 from langchain_core.documents import Document
 
 
 class RRFSearchExternalDocs(RRFSearch):
-    def __init__(self):
-        self.inverted_index = InvertedIndexExternalDocs()
-        self.semantic_search = SemanticSearchExternalDocs()
+    def __init__(self, inverted_index: InvertedIndexExternalDocs = None, semantic_search: SemanticSearchExternalDocs = None):
+        # Use the shared search objects if provided. Otherwise create new ones.
+        self.inverted_index = inverted_index or InvertedIndexExternalDocs()
+        self.semantic_search = semantic_search or SemanticSearchExternalDocs()
 
-    def build_embeddings_and_index(self, documents: list[Document], uid: str):
+    def build_embeddings_and_index(self, documents: list[Document], uid: str,
+                                   progress_callback: Callable[[float, str], None] = None) -> dict:
         """
-            Build embeddings for both keyword search and semantic search
+            Build embeddings for both keyword search and semantic search.
+            documents is the whole knowledge base of the user. Each doc is hashed and compared with the manifest of the last build,
+            so only new and changed docs are embedded and indexed, and docs missing from documents are removed.
+            progress_callback(progress, stage) is called as the build moves on. progress goes from 0 to 1.
+            Returns the number of docs added, updated, unchanged and removed.
         """
-        self.inverted_index.build(documents=documents, uid=uid)
-        self.semantic_search.build_embeddings(
-            documents=documents, uid=uid, is_chunked=False)
-
-    def rrf_search(self, uid: str, query: str, limit: int, k: int = constants.K_VALUE):
+        progress_callback = progress_callback or (lambda progress, stage: None)
+
+        # Later docs win if an id repeats
+        documents_by_id = {doc.metadata["id"]: doc for doc in documents}
+        new_hashes = {doc_id: document_hash(doc)
+                      for doc_id, doc in documents_by_id.items()}
+
+        # Rebuild everything if there's no manifest, the retrievers are gone or the embedding backend changed
+        old_hashes = load_manifest(uid)
+        rebuild = (old_hashes is None
+                   or not self.inverted_index.has_index(uid)
+                   or not self.semantic_search.has_embeddings(uid)
+                   or self.semantic_search.needs_rebuild(uid))
+        diff = diff_manifest({} if rebuild else old_hashes, new_hashes)
+
+        changed_docs = [documents_by_id[doc_id]
+                        for doc_id in diff.added + diff.updated]
+        if rebuild or changed_docs or diff.removed:
+            # Forget the last build first. If this build fails halfway, the next one starts from scratch.
+            delete_manifest(uid)
+
+            progress_callback(0.1, "indexing")
+            with measure_stage(STAGE_BM25_INDEX_UPDATE, BACKEND_BM25):
+                try:
+                    self.inverted_index.update(
+                        documents=changed_docs, removed_ids=diff.removed, uid=uid, rebuild=rebuild)
+                except BM25IndexLoadError as e:
+                    # The saved index is unusable. Index every doc of the request again.
+                    print(f"{e} Rebuilding the bm25 index of {uid} from all docs.")
+                    self.inverted_index.update(
+                        documents=list(documents_by_id.values()), removed_ids=[], uid=uid, rebuild=True)
+            progress_callback(0.3, "embedding")
+            with measure_stage(STAGE_EMBEDDING_UPDATE, constants.EMBEDDING_BACKEND):
+                self.semantic_search.update_embeddings(
+                    documents=changed_docs, removed_ids=diff.removed, uid=uid, rebuild=rebuild,
+                    progress_callback=lambda progress: progress_callback(0.3 + 0.65 * progress, "embedding"))
+
+            progress_callback(0.95, "saving")
+            save_manifest(uid, new_hashes)
+
+            # Make sure the next search loads the rebuilt retrievers
+            USER_VECTOR_STORE_CACHE.invalidate(uid)
+
+        counts = diff.counts()
+        print(f"Knowledge base of {uid} built. {counts}")
+        return counts
+
+    def rrf_search(self, uid: str, query: str, limit: int, k: int = constants.K_VALUE,
+                   candidate_depth: int = None, early_stop: bool = constants.RRF_EARLY_STOP):
         """
             Do a rrf search for given uid and query.
+            candidate_depth is the number of candidates fetched from each retriever. Defaults to a small multiple of limit.
+            With early_stop, candidates are fetched in growing rounds until the top results can't change any more.
         """
-        bm25_results = self.inverted_index.bm25_search(uid=uid,
-                                                       query=query, limit=limit * 500)
-
-        semantic_results = self.semantic_search.semantic_search(uid=uid,
-                                                                query=query, limit=limit * 500)
-
-        result_dict: dict[str: Document] = {}
-
-        # Add bm25 search results
-        for index, bm_25_doc in enumerate(bm25_results):
-            # Get the rannk
-            bm25_rank = index + 1
-            # Get the doc id
-            doc_id = bm_25_doc.metadata["id"]
-            # Update the doc with bm25 rank
-            bm_25_doc.metadata["bm25_rank"] = bm25_rank
-            # Add placeholder for semantic rank
-            bm_25_doc.metadata["semantic_rank"] = 0.0
-            # Put in the result dict
-            result_dict[doc_id] = bm_25_doc
-
-        # Add semantic search results
-        for index, semantic_search_doc in enumerate(semantic_results):
-            # Get the rank
-            semantic_rank = index + 1
-            # Get the doc id
-            doc_id = semantic_search_doc.metadata["id"]
-
-            if doc_id in result_dict:
-                existing_doc = result_dict[doc_id]
-                existing_doc.metadata["semantic_rank"] = semantic_rank
-            else:
-                semantic_search_doc.metadata["semantic_rank"] = semantic_rank
-                semantic_search_doc.metadata["bm25_rank"] = 0.0
-                result_dict[doc_id] = semantic_search_doc
-
-        # Get the values
-        result = list(result_dict.values())
-
-        # Calculate rrf and update the results
-        for doc in result:
-            bm25_rank = doc.metadata["bm25_rank"]
-            semantic_rank = doc.metadata["semantic_rank"]
-
-            rrf_bm25 = 0.0
-            if bm25_rank != 0:
-                rrf_bm25 = self.rrf_score(bm25_rank, k)
-
-            rrf_semantic = 0.0
-            if semantic_rank != 0:
-                rrf_semantic = self.rrf_score(semantic_rank, k)
-
-            rrf_score = round(rrf_bm25 + rrf_semantic, 5)
-            doc.metadata["rrf_score"] = rrf_score
-
-        # Sort the results
-        result.sort(key=lambda doc: float(
-            doc.metadata["rrf_score"]), reverse=True)
-
-        # Return the limited results
-        return result[:limit]
+        # Both retrievers run at the same time
+        return self._fused_search(
+            retrievers={
+                "bm25": lambda depth: self.inverted_index.bm25_search(
+                    uid=uid, query=query, limit=depth),
+                "semantic": lambda depth: self.semantic_search.semantic_search(
+                    uid=uid, query=query, limit=depth),
+            },
+            limit=limit,
+            k=k,
+            candidate_depth=candidate_depth,
+            early_stop=early_stop
+        )
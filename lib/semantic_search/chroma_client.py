@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+import chromadb
+from chromadb.api.models.Collection import Collection
+from chromadb.errors import NotFoundError
+
+import lib.utils.constants as constants
+
+_clients: dict[str, chromadb.ClientAPI] = {}
+_clients_lock = threading.Lock()
+
+
+def get_chroma_client(path: str = constants.CHROMA_PATH) -> chromadb.ClientAPI:
+    """
+        Return the process wide persistent client for path. Created on first use.
+    """
+    with _clients_lock:
+        client = _clients.get(path)
+        if client is None:
+            client = chromadb.PersistentClient(path=path)
+            _clients[path] = client
+        return client
+
+
+class ChromaCollectionCache:
+    """
+        LRU of collection handles by name.
+        Lookups are a direct get by name instead of listing every collection, and a cached handle skips chroma entirely.
+        Collections must be deleted through this cache so no stale handle is kept.
+    """
+
+    def __init__(self, client: chromadb.ClientAPI, max_entries: int = constants.CHROMA_COLLECTION_CACHE_MAX_ENTRIES):
+        self.client = client
+        self.max_entries = max_entries
+        self._handles: OrderedDict[str, Collection] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Collection | None:
+        """
+            Return the collection or None if it doesn't exist.
+        """
+        with self._lock:
+            collection = self._handles.get(name)
+            if collection is not None:
+                self._handles.move_to_end(name)
+                return collection
+
+        try:
+            # Vectors are always passed in, so no embedding function is attached
+            collection = self.client.get_collection(
+                name=name, embedding_function=None)
+        except NotFoundError:
+            return None
+
+        self._put(name, collection)
+        return collection
+
+    def get_or_create(self, name: str, metadata: dict = None) -> Collection:
+        """
+            Return the collection. metadata is only used when the collection is created.
+        """
+        collection = self.get(name)
+        if collection is not None:
+            return collection
+
+        collection = self.client.get_or_create_collection(
+            name=name, embedding_function=None, metadata=metadata)
+        self._put(name, collection)
+        return collection
+
+    def exists(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def delete(self, name: str):
+        """
+            Delete the collection. Does nothing if it doesn't exist.
+        """
+        self.invalidate(name)
+        try:
+            self.client.delete_collection(name=name)
+        except NotFoundError:
+            pass
+
+    def invalidate(self, name: str):
+        with self._lock:
+            self._handles.pop(name, None)
+
+    def _put(self, name: str, collection: Collection):
+        with self._lock:
+            self._handles[name] = collection
+            self._handles.move_to_end(name)
+            while len(self._handles) > self.max_entries:
+                self._handles.popitem(last=False)
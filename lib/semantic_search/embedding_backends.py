@@ -0,0 +1,46 @@
+from langchain_huggingface import HuggingFaceEmbeddings
+
+import lib.utils.constants as constants
+
+# Backends that run the model with fp32 weights produce the same vectors up to float rounding
+FP32_BACKENDS = (constants.EMBEDDING_BACKEND_TORCH,
+                 constants.EMBEDDING_BACKEND_ONNX)
+
+
+def create_embeddings(backend: str = constants.EMBEDDING_BACKEND,
+                      model_name: str = constants.EMBEDDING_MODEL_NAME) -> HuggingFaceEmbeddings:
+    """
+        Create the embedding model for the given backend. All backends run on cpu.
+
+        torch      fp32 PyTorch. The original backend.
+        onnx       fp32 ONNX Runtime. Same vectors as torch, lower latency.
+        onnx_int8  int8 quantized ONNX Runtime. Fastest, but the vectors drift a little from fp32.
+
+        The onnx backends need the onnx extras of sentence-transformers. (sentence-transformers[onnx])
+    """
+    if backend == constants.EMBEDDING_BACKEND_TORCH:
+        model_kwargs = {"device": "cpu"}
+    elif backend == constants.EMBEDDING_BACKEND_ONNX:
+        model_kwargs = {"device": "cpu", "backend": "onnx"}
+    elif backend == constants.EMBEDDING_BACKEND_ONNX_INT8:
+        # The model repo ships quantized exports next to the fp32 one
+        model_kwargs = {
+            "device": "cpu",
+            "backend": "onnx",
+            "model_kwargs": {"file_name": constants.EMBEDDING_ONNX_INT8_FILE_NAME},
+        }
+    else:
+        raise ValueError(f"Unknown embedding backend {backend}")
+
+    return HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs)
+
+
+def embedding_fingerprint(backend: str = constants.EMBEDDING_BACKEND,
+                          model_name: str = constants.EMBEDDING_MODEL_NAME) -> str:
+    """
+        Identifies the vector space of a backend. Vectors with the same fingerprint can be mixed in one collection.
+        fp32 backends use the bare model name, which is what collections built before the backends existed were made with.
+    """
+    if backend in FP32_BACKENDS:
+        return model_name
+    return f"{model_name}#{backend}"
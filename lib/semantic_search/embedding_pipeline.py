@@ -0,0 +1,152 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from chromadb.api.models.Collection import Collection
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+import lib.utils.constants as constants
+from lib.semantic_search.query_embedding_cache import CachedQueryEmbeddings
+
+
+class EmbeddingPipeline:
+    """
+        Batched document embedding for knowledge base builds.
+
+        Documents are encoded batch_size at a time and each batch is upserted into chroma as soon as it's encoded,
+        so only about two batches of vectors are in memory at once. The chroma write of one batch overlaps with
+        encoding the next one.
+        Builds with at least multi_process_min_docs documents are encoded by a pool of num_processes
+        sentence-transformers worker processes. The pool is started on first use and kept until close().
+    """
+
+    def __init__(self,
+                 embeddings: Embeddings,
+                 batch_size: int = constants.EMBEDDING_BATCH_SIZE,
+                 num_processes: int = constants.EMBEDDING_NUM_PROCESSES,
+                 multi_process_min_docs: int = constants.EMBEDDING_MULTI_PROCESS_MIN_DOCS):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.num_processes = num_processes
+        self.multi_process_min_docs = multi_process_min_docs
+
+        # Model and worker processes for multi process builds. Started on first use.
+        self._model = None
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Single writer. Chroma upserts happen in order, one batch at a time.
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="embedding-writer")
+
+    def run(self,
+            collection: Collection,
+            documents: list[Document],
+            ids: list[str],
+            progress_callback: Callable[[float], None] = None) -> dict:
+        """
+            Embed the documents and upsert them into the collection with the given ids.
+            progress_callback(progress) is called after each batch is written. progress goes from 0 to 1.
+            Returns the number of docs and batches, the elapsed seconds and the docs per second.
+        """
+        start = time.perf_counter()
+        use_pool = self._can_use_pool(len(documents))
+        pending_write: Future | None = None
+        num_batches = 0
+
+        for batch_start in range(0, len(documents), self.batch_size):
+            batch = documents[batch_start:batch_start + self.batch_size]
+            vectors = self._encode(
+                [doc.page_content for doc in batch], use_pool)
+
+            # Wait for the previous batch so at most one batch is waiting to be written
+            if pending_write is not None:
+                pending_write.result()
+            pending_write = self._writer.submit(
+                collection.upsert,
+                ids=ids[batch_start:batch_start + self.batch_size],
+                embeddings=vectors,
+                metadatas=[doc.metadata for doc in batch],
+                documents=[doc.page_content for doc in batch]
+            )
+            num_batches += 1
+
+            if progress_callback:
+                progress_callback(
+                    min(batch_start + len(batch), len(documents)) / len(documents))
+
+        if pending_write is not None:
+            pending_write.result()
+
+        elapsed = time.perf_counter() - start
+        stats = {
+            "docs": len(documents),
+            "batches": num_batches,
+            "seconds": round(elapsed, 3),
+            "docs_per_sec": round(len(documents) / elapsed, 1) if elapsed > 0 else 0.0,
+            "processes": self.num_processes if use_pool else 1,
+        }
+        print(f"Embedded {stats['docs']} docs in {stats['batches']} batches. "
+              f"{stats['docs_per_sec']} docs/sec with {stats['processes']} process(es).")
+        return stats
+
+    def close(self):
+        """
+            Stop the encode worker processes and the writer thread.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._model.stop_multi_process_pool(self._pool)
+                self._pool = None
+                self._model = None
+        self._writer.shutdown(wait=True)
+
+    def _encode(self, texts: list[str], use_pool: bool):
+        if not use_pool:
+            return self.embeddings.embed_documents(texts)
+
+        # Same text cleanup and encode options as HuggingFaceEmbeddings.embed_documents
+        model, pool = self._get_pool()
+        return model.encode(
+            [text.replace("\n", " ") for text in texts],
+            pool=pool,
+            **self._hf_embeddings().encode_kwargs
+        )
+
+    def _can_use_pool(self, num_docs: int) -> bool:
+        return (self.num_processes > 1
+                and num_docs >= self.multi_process_min_docs
+                and self._hf_embeddings() is not None)
+
+    def _get_pool(self):
+        """
+            Return the model and the pool of worker processes. Loads the model and starts the workers on first use.
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                self._model = self._load_sentence_transformer()
+                print(
+                    f"Starting {self.num_processes} embedding worker processes...")
+                self._pool = self._model.start_multi_process_pool(
+                    target_devices=["cpu"] * self.num_processes)
+            return self._model, self._pool
+
+    def _hf_embeddings(self) -> HuggingFaceEmbeddings | None:
+        embeddings = self.embeddings
+        if isinstance(embeddings, CachedQueryEmbeddings):
+            embeddings = embeddings.embeddings
+        return embeddings if isinstance(embeddings, HuggingFaceEmbeddings) else None
+
+    def _load_sentence_transformer(self):
+        """
+            Load the model from the public settings of the HuggingFaceEmbeddings, the same way it loads its own.
+            Its model is a private attribute, so the pool gets a model of its own.
+        """
+        # Imported here. sentence-transformers pulls in torch, which only multi process builds need.
+        from sentence_transformers import SentenceTransformer
+
+        hf_embeddings = self._hf_embeddings()
+        return SentenceTransformer(
+            hf_embeddings.model_name, cache_folder=hf_embeddings.cache_folder, **hf_embeddings.model_kwargs)
@@ -0,0 +1,192 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+import lib.utils.constants as constants
+from lib.utils.metrics_utils import STAGE_QUERY_EMBEDDING, measure_stage
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+        Embeddings wrapper that caches query embeddings.
+        Queries are normalized (trimmed, whitespace collapsed, lower cased if ignore_case) and keyed by model name,
+        so retries and regenerations of the same question skip the model.
+        The model always gets the query as the user typed it, only with the whitespace collapsed.
+        ignore_case is only safe for models with an uncased tokenizer, like the default MiniLM model.
+        Documents are passed straight through. They are embedded once at build time.
+
+        Lookups go memory LRU -> optional sqlite file -> model.
+    """
+
+    def __init__(self,
+                 embeddings: Embeddings,
+                 model_name: str = None,
+                 max_entries: int = constants.QUERY_EMBEDDING_CACHE_MAX_ENTRIES,
+                 disk_path: str = constants.QUERY_EMBEDDING_CACHE_PATH,
+                 disk_max_entries: int = constants.QUERY_EMBEDDING_CACHE_DISK_MAX_ENTRIES,
+                 ignore_case: bool = constants.QUERY_EMBEDDING_CACHE_IGNORE_CASE):
+        self.embeddings = embeddings
+        self.ignore_case = ignore_case
+        self.model_name = model_name or getattr(
+            embeddings, "model_name", type(embeddings).__name__)
+        self.max_entries = max_entries
+
+        # (model_name, normalized query) -> float32 vector. Most recently used items are at the end.
+        self._entries: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._disk = None
+        if disk_path:
+            self._disk = QueryEmbeddingDiskCache(
+                path=disk_path, max_entries=disk_max_entries)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        query = collapse_whitespace(text)
+        key = (self.model_name, query.lower() if self.ignore_case else query)
+
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector.tolist()
+
+        # Check the disk tier before running the model
+        vector = self._disk.get(*key) if self._disk else None
+        if vector is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            # Embed outside the lock so a slow embedding doesn't block the other requests
+            with measure_stage(STAGE_QUERY_EMBEDDING, constants.EMBEDDING_BACKEND):
+                vector = np.asarray(
+                    self.embeddings.embed_query(query), dtype=np.float32)
+            with self._lock:
+                self.misses += 1
+            if self._disk:
+                self._disk.put(*key, vector)
+
+        self._put(key, vector)
+        return vector.tolist()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def _put(self, key: tuple[str, str], vector: np.ndarray):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class QueryEmbeddingDiskCache:
+    """
+        sqlite file holding query embeddings so the cache survives restarts.
+        Oldest rows are pruned once the table grows past max_entries.
+    """
+
+    # Prune every N writes instead of counting the rows on every write
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # One connection shared by the worker threads. Access is serialized with the lock.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS query_embeddings (
+                    model_name TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (model_name, query)
+                )
+                """
+            )
+
+    def get(self, model_name: str, query: str) -> np.ndarray | None:
+        try:
+            with self._lock:
+                row = self._connection.execute(
+                    "SELECT vector FROM query_embeddings WHERE model_name = ? AND query = ?",
+                    (model_name, query)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading the query embedding cache: {e}")
+            return None
+
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def put(self, model_name: str, query: str, vector: np.ndarray):
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?)",
+                    (model_name, query, np.asarray(
+                        vector, dtype=np.float32).tobytes(), time.time())
+                )
+                self._writes += 1
+                if self._writes % self.PRUNE_INTERVAL == 0:
+                    self._prune()
+        except sqlite3.Error as e:
+            # The disk tier is only an optimization. Never fail the search because of it.
+            print(f"Error writing the query embedding cache: {e}")
+
+    def _prune(self):
+        # Lock and transaction must be held by the caller
+        self._connection.execute(
+            """
+            DELETE FROM query_embeddings WHERE rowid IN (
+                SELECT rowid FROM query_embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,)
+        )
+
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def collapse_whitespace(text: str) -> str:
+    """
+        Trim and collapse whitespace runs to one space.
+    """
+    return _WHITESPACE_PATTERN.sub(" ", text).strip()
@@ -1,5 +1,7 @@
 from lib.semantic_search.semantic_search import SemanticSearch
 import os
+import uuid
+from typing import Callable
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
@@ -10,15 +12,38 @@ from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 import chromadb
 from chromadb.api.models.Collection import Collection
-from lib.semantic_search.user_vector_store_cache import USER_VECTOR_STORE_CACHE
+from lib.semantic_search.user_vector_store_cache import USER_VECTOR_STORE_CACHE, CHROMA_HANDLE
+from lib.semantic_search.query_embedding_cache import CachedQueryEmbeddings
+from lib.semantic_search.embedding_pipeline import EmbeddingPipeline
+from lib.semantic_search.embedding_backends import create_embeddings, embedding_fingerprint
+from lib.semantic_search.chroma_client import get_chroma_client, ChromaCollectionCache
+from lib.utils.metrics_utils import BACKEND_CHROMA, STAGE_CHROMA_QUERY, measure_stage
+
+
+# Collection metadata key holding the embedding fingerprint
+EMBEDDING_FINGERPRINT_KEY = "embedding_fingerprint"
 
 
 class SemanticSearchExternalDocs(SemanticSearch):
-    def __init__(self):
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name=constants.EMBEDDING_MODEL_NAME,
-            model_kwargs={"device": "cpu"}
-        )
+    def __init__(self, embeddings: HuggingFaceEmbeddings = None, chroma_client: chromadb.ClientAPI = None):
+        # Reuse the shared embedding model and chroma client if provided. Loading them is expensive.
+        self.embeddings = embeddings
+        if self.embeddings is None:
+            self.embeddings = create_embeddings(constants.EMBEDDING_BACKEND)
+        # Vector space of the configured backend. Stored on the collections to catch mixed vectors.
+        self.embedding_fingerprint = embedding_fingerprint(
+            constants.EMBEDDING_BACKEND)
+        # Repeated queries skip the model
+        if not isinstance(self.embeddings, CachedQueryEmbeddings):
+            self.embeddings = CachedQueryEmbeddings(
+                self.embeddings, model_name=self.embedding_fingerprint)
+
+        self.chroma_client = chroma_client or get_chroma_client()
+        # Collection lookups by name. Never lists the collections of every user.
+        self.collections = ChromaCollectionCache(self.chroma_client)
+
+        # Batched document embedding for builds
+        self.embedding_pipeline = EmbeddingPipeline(self.embeddings)
 
     def semantic_search(self, uid: str, query: str, limit=3) -> list[Document]:
         """
@@ -30,8 +55,10 @@ class SemanticSearchExternalDocs(SemanticSearch):
         # Fetch double the amount of chunks since they'll have to be mapped back to documents
         # docs_with_scores = vector_db.similarity_search_with_score(
         #     query, limit)
-        result = vector_db.similarity_search(
-            query, limit)
+        # Includes embedding the query. A cache miss is also timed as query_embedding.
+        with measure_stage(STAGE_CHROMA_QUERY, BACKEND_CHROMA):
+            result = vector_db.similarity_search(
+                query, limit)
 
         # TODO: - If chunking is required later, add the logic back.
         # # Map the chunks to a dict with doc_idx as key and score as value
@@ -94,13 +121,14 @@ class SemanticSearchExternalDocs(SemanticSearch):
             # If embeddings already exist delete it to avoid duplicate embeddings
             if self._check_chroma_client_collection_exists(uid=uid):
                 self._delete_chroma_collection(uid=uid)
+                # The cached handle points to the deleted collection. Drop it.
+                USER_VECTOR_STORE_CACHE.invalidate(uid, CHROMA_HANDLE)
 
-            # Save the embeddings in chroma db.
-            Chroma.from_documents(
+            # Save the embeddings in chroma db. Batch by batch.
+            self.embedding_pipeline.run(
+                collection=self._get_or_create_collection(uid),
                 documents=all_chunks,
-                embedding=self.embeddings,
-                persist_directory=constants.CHROMA_PATH,
-                collection_name=uid
+                ids=[str(uuid.uuid4()) for _ in all_chunks]
             )
 
             print(
@@ -109,7 +137,67 @@ class SemanticSearchExternalDocs(SemanticSearch):
         except Exception as e:
             print(f"Embedding failed with exception {e}")
 
+    def update_embeddings(self, documents: list[Document], removed_ids: list[int], uid: str, rebuild: bool = False,
+                          progress_callback: Callable[[float], None] = None):
+        """
+            Upsert the given documents and delete removed_ids in the user's collection.
+            Chroma ids are the document ids, so a changed doc replaces its old vector.
+            With rebuild, the collection is deleted first. Raises if chroma fails.
+            progress_callback(progress) is called after each embedded batch.
+        """
+        if rebuild and self._check_chroma_client_collection_exists(uid=uid):
+            self._delete_chroma_collection(uid=uid)
+        # The cached handle may point to the deleted collection. Drop it.
+        USER_VECTOR_STORE_CACHE.invalidate(uid, CHROMA_HANDLE)
+
+        collection = self._get_or_create_collection(uid)
+
+        if documents:
+            print(
+                f"Embedding and upserting {len(documents)} documents for {uid}...")
+            self.embedding_pipeline.run(
+                collection=collection,
+                documents=documents,
+                ids=[str(doc.metadata["id"]) for doc in documents],
+                progress_callback=progress_callback
+            )
+
+        if removed_ids:
+            collection.delete(ids=[str(doc_id) for doc_id in removed_ids])
+
+        print(
+            f"Embedding update for {uid} complete. {len(documents)} upserted, {len(removed_ids)} removed.")
+
+    def has_embeddings(self, uid: str) -> bool:
+        return self._check_chroma_client_collection_exists(uid)
+
+    def needs_rebuild(self, uid: str) -> bool:
+        """
+            Check if the user's collection was embedded with a backend whose vectors can't be mixed with the configured one.
+            Collections made before fingerprints were stored were embedded with the fp32 model.
+        """
+        collection = self.collections.get(uid)
+        if collection is None:
+            return False
+
+        metadata = collection.metadata or {}
+        fingerprint = metadata.get(
+            EMBEDDING_FINGERPRINT_KEY, constants.EMBEDDING_MODEL_NAME)
+        return fingerprint != self.embedding_fingerprint
+
     def load_embeddings(self, uid: str) -> Chroma:
+        """
+            Return the chroma handle of the user from the cache.
+            If it's not cached yet, open it and cache it.
+        """
+        return USER_VECTOR_STORE_CACHE.get_or_load(
+            uid=uid,
+            kind=CHROMA_HANDLE,
+            loader=lambda: self._open_embeddings(uid),
+            size_func=lambda _: constants.CHROMA_HANDLE_SIZE_BYTES
+        )
+
+    def _open_embeddings(self, uid: str) -> Chroma:
         """
             Load the embeddings.
             If embeddings haven't been built yet, raise an exception
@@ -117,23 +205,33 @@ class SemanticSearchExternalDocs(SemanticSearch):
 
         # Load the documents first. To be sure
         if self._check_chroma_client_collection_exists(uid):
+            if self.needs_rebuild(uid):
+                print(f"Embeddings of {uid} were made with a different embedding backend than {self.embedding_fingerprint}. "
+                      f"Search quality suffers until the knowledge base is rebuilt.")
             return Chroma(
-                persist_directory=constants.CHROMA_PATH,
+                client=self.chroma_client,
                 embedding_function=self.embeddings,
-                collection_name=uid
+                collection_name=uid,
+                create_collection_if_not_exists=False
             )
         else:
             raise Exception("Embeddings haven't been built yet.")
 
+    def _get_or_create_collection(self, uid: str) -> Collection:
+        """
+            Return the chroma collection of the user. Vectors are always passed in, so no embedding function is attached.
+        """
+        return self.collections.get_or_create(
+            name=uid,
+            metadata={EMBEDDING_FINGERPRINT_KEY: self.embedding_fingerprint}
+        )
+
     def _check_chroma_client_collection_exists(self, uid: str) -> bool:
         """
             Check if chroma collection exists with the given uid
         """
         try:
-            client = chromadb.PersistentClient(path=constants.CHROMA_PATH)
-            collections: list[Collection] = client.list_collections()
-            exists = any(c.name == uid for c in collections)
-            return exists
+            return self.collections.exists(uid)
         except Exception as e:
             print(f"Error checking chroma collection {e}")
             return False
@@ -141,9 +239,7 @@ class SemanticSearchExternalDocs(SemanticSearch):
     def _delete_chroma_collection(self, uid: str):
         """Deletes the entire collection for the given user UID."""
         try:
-            client = chromadb.PersistentClient(path=constants.CHROMA_PATH)
-
-            client.delete_collection(name=uid)
+            self.collections.delete(uid)
             print(f"Collection '{uid}' successfully deleted.")
         except Exception as e:
             print(f"Error during collection deletion (may not exist): {e}")
@@ -1,4 +1,199 @@
-from langchain_chroma import Chroma
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
 
-# TODO: - Implement LRU cache later
-USER_VECTOR_STORE_CACHE: dict[str, Chroma] = {}
+import lib.utils.constants as constants
+
+# Kinds of retrievers kept per user
+BM25_RETRIEVER = "bm25"
+CHROMA_HANDLE = "chroma"
+
+
+class _PendingLoad:
+    """
+        A load in progress. Other misses for the same retriever wait for it instead of loading again.
+        generation is the generation of the retriever when the load started.
+    """
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.value = None
+        self.error: BaseException | None = None
+        self._done = threading.Event()
+
+    def finish(self, value=None, error: BaseException = None):
+        self.value = value
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class UserVectorStoreCache:
+    """
+        Thread safe LRU cache for per user retrievers. (BM25 index and Chroma handle)
+        Bounded by entry count and estimated bytes. Entries expire after ttl_seconds.
+        Each retriever has a generation that invalidate bumps. A load that started before an invalidate
+        is not cached, so a rebuild is never hidden by the index it replaced.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        # (uid, kind) -> (value, size_bytes, expires_at). Most recently used items are at the end.
+        self._entries: OrderedDict[tuple[str, str], tuple[Any, int, float]] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        # (uid, kind) -> generation. Bumped by invalidate.
+        self._generations: dict[tuple[str, str], int] = {}
+        # (uid, kind) -> load in progress
+        self._loading: dict[tuple[str, str], _PendingLoad] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, uid: str, kind: str):
+        """
+            Return the cached retriever or None if it's missing or expired.
+        """
+        key = (uid, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, _, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, uid: str, kind: str, value, size_bytes: int = 0):
+        """
+            Cache the retriever. Least recently used entries are evicted until the budget fits.
+            Retrievers bigger than the whole byte budget are not cached.
+        """
+        if size_bytes > self.max_bytes:
+            return
+
+        with self._lock:
+            self._put((uid, kind), value, size_bytes)
+
+    def get_or_load(self, uid: str, kind: str, loader: Callable[[], Any], size_func: Callable[[Any], int] = None):
+        """
+            Return the cached retriever. If it's not cached, load it with loader and cache the result.
+            Concurrent misses share one load. The result isn't cached if the retriever was invalidated while loading.
+        """
+        value = self.get(uid, kind)
+        if value is not None:
+            return value
+
+        key = (uid, kind)
+        with self._lock:
+            pending = self._loading.get(key)
+            if pending is not None:
+                owner = False
+            else:
+                pending = _PendingLoad(self._generations.get(key, 0))
+                self._loading[key] = pending
+                owner = True
+        if not owner:
+            return pending.wait()
+
+        # Load outside the lock so a slow load doesn't block the other users
+        try:
+            value = loader()
+            size_bytes = size_func(value) if size_func and value is not None else 0
+        except BaseException as e:
+            with self._lock:
+                if self._loading.get(key) is pending:
+                    del self._loading[key]
+            pending.finish(error=e)
+            raise
+
+        with self._lock:
+            if self._loading.get(key) is pending:
+                del self._loading[key]
+            # A rebuild finished while loading. value may be the index it replaced.
+            if value is not None and size_bytes <= self.max_bytes \
+                    and self._generations.get(key, 0) == pending.generation:
+                self._put(key, value, size_bytes)
+        pending.finish(value=value)
+        return value
+
+    def invalidate(self, uid: str, kind: str = None):
+        """
+            Drop the cached retrievers of the user.
+            Must be called whenever the user's embeddings or index are rebuilt.
+        """
+        kinds = [kind] if kind else [BM25_RETRIEVER, CHROMA_HANDLE]
+        with self._lock:
+            for item_kind in kinds:
+                key = (uid, item_kind)
+                self._generations[key] = self._generations.get(key, 0) + 1
+                # Later misses start a new load instead of waiting for one that may return the old retriever
+                self._loading.pop(key, None)
+                if key in self._entries:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            # Loads in progress must not fill the cache again
+            for key in self._loading:
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._loading.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _put(self, key: tuple[str, str], value, size_bytes: int):
+        # Lock must be held by the caller
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (
+            value, size_bytes, time.monotonic() + self.ttl_seconds)
+        self._total_bytes += size_bytes
+
+        while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key: tuple[str, str]):
+        # Lock must be held by the caller
+        _, size_bytes, _ = self._entries.pop(key)
+        self._total_bytes -= size_bytes
+
+
+USER_VECTOR_STORE_CACHE = UserVectorStoreCache(
+    max_entries=constants.USER_CACHE_MAX_ENTRIES,
+    max_bytes=constants.USER_CACHE_MAX_BYTES,
+    ttl_seconds=constants.USER_CACHE_TTL_SECONDS
+)
@@ -1,18 +1,87 @@
 ABOUT_ME_FILE_PATH = "data/about_me.json"
 
 # BM25
-INDEX_FILE_PATH = "cache/index.pkl"
+INDEX_FILE_PATH = "cache/index.bm25"
+LEGACY_INDEX_FILE_PATH = "cache/index.pkl"
+INDEX_DIR = "cache"
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+# Tokenizer for bm25. "fast" gives the same tokens as "nltk" and only falls back to nltk for non ascii text.
+TOKENIZER_MODE_FAST = "fast"
+TOKENIZER_MODE_NLTK = "nltk"
+TOKENIZER_MODE = TOKENIZER_MODE_FAST
+STEM_CACHE_MAX_ENTRIES = 200_000
 
 # Semantic Search
 CHROMA_PATH = "chroma_db"
 EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 COLLECTION_NAME = "personal_profile_rag"
+# Embedding backends. onnx_int8 vectors differ slightly from fp32, so switching to or from it rebuilds the knowledge bases.
+EMBEDDING_BACKEND_TORCH = "torch"
+EMBEDDING_BACKEND_ONNX = "onnx"
+EMBEDDING_BACKEND_ONNX_INT8 = "onnx_int8"
+EMBEDDING_BACKEND = EMBEDDING_BACKEND_TORCH
+# Quantized export inside the model repo. Use onnx/model_qint8_arm64.onnx on arm hosts.
+EMBEDDING_ONNX_INT8_FILE_NAME = "onnx/model_quint8_avx2.onnx"
+# Query embedding cache. Set QUERY_EMBEDDING_CACHE_PATH to keep the embeddings across restarts.
+QUERY_EMBEDDING_CACHE_MAX_ENTRIES = 4096
+QUERY_EMBEDDING_CACHE_PATH = None
+QUERY_EMBEDDING_CACHE_DISK_MAX_ENTRIES = 100_000
+# Queries differing only in case share a cache entry. Safe for the default MiniLM model since its tokenizer is uncased.
+# Set to False for a cased EMBEDDING_MODEL_NAME.
+QUERY_EMBEDDING_CACHE_IGNORE_CASE = True
+# Documents embedded and written to chroma per batch during a build
+EMBEDDING_BATCH_SIZE = 256
+# Encode worker processes for big builds. 1 encodes in the build thread.
+EMBEDDING_NUM_PROCESSES = 1
+# Starting the worker processes loads the model in each of them. Only worth it for big builds.
+EMBEDDING_MULTI_PROCESS_MIN_DOCS = 2000
+
+# Open collection handles kept per process
+CHROMA_COLLECTION_CACHE_MAX_ENTRIES = 1024
+
+# Per user retriever cache
+USER_CACHE_MAX_ENTRIES = 256
+USER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+USER_CACHE_TTL_SECONDS = 15 * 60
+# Rough in-memory size of a chroma handle. The vectors themselves live inside chroma.
+CHROMA_HANDLE_SIZE_BYTES = 64 * 1024
+
+# Engine
+WARMUP_QUERY = "What are my skills?"
+# Request level retrieval pool. Runs whole rrf searches of the async endpoints off the event loop.
+RETRIEVAL_MAX_WORKERS = 4
+RETRIEVAL_MAX_PENDING = 32
 
 # RRF Search
 K_VALUE = 60.0
+# Shared pool that runs the other retrievers of each rrf search while the calling thread runs the first one
+RRF_RETRIEVER_MAX_WORKERS = 8
+# Candidates fetched from each retriever = limit * RRF_CANDIDATE_MULTIPLIER. (At least RRF_MIN_CANDIDATE_DEPTH)
+RRF_CANDIDATE_MULTIPLIER = 4
+RRF_MIN_CANDIDATE_DEPTH = 20
+# Early stop fetches candidates in doubling rounds until the top results are settled. Only with rrf fusion.
+RRF_EARLY_STOP = False
+RRF_EARLY_STOP_MAX_DEPTH = 500
+# Fusion of the retriever results. "rrf", "combsum" or "combmnz"
+FUSION_MODE = "rrf"
+# Weight of each retriever in the fused score. Retrievers not listed get 1.0
+FUSION_WEIGHTS = {"bm25": 1.0, "semantic": 1.0}
 
 # AI
 GEMINI_FLASH_MODEL = "gemini-3-flash-preview"
+LOCAL_LLM_MODEL = "llama3.1"
+LOCAL_LLM_BASE_URL = "http://localhost:11434/v1"
+# How long the local server keeps the model and its prompt cache loaded after a request.
+# Sent with every request. Servers that don't know the field ignore it (OLLAMA_KEEP_ALIVE sets it server side).
+LOCAL_LLM_KEEP_ALIVE = "30m"
+# Ask llama.cpp based servers to reuse the cached prompt prefix
+LOCAL_LLM_CACHE_PROMPT = True
+LLM_BACKEND_GEMINI = "gemini"
+LLM_BACKEND_OLLAMA = "ollama"
+# Switch to LLM_BACKEND_GEMINI to use Gemini instead of the local model
+LLM_BACKEND = LLM_BACKEND_OLLAMA
 
 # Item Limit
 DEFAULT_ITEM_LIMIT = 5
@@ -21,3 +90,26 @@ DEFAULT_ITEM_LIMIT = 5
 TURN_HISTORY_LIMIT = 5
 SPEAKER_USER = "user"
 SPEAKER_MODEL = "model"
+
+# Prompt packing. Retrieved documents and turn history are cut to these token budgets.
+PROMPT_CONTEXT_TOKEN_BUDGET = 1536
+PROMPT_TURN_HISTORY_TOKEN_BUDGET = 512
+# A document or turn that doesn't fit is truncated if at least this many tokens are left. Otherwise it's dropped.
+PROMPT_MIN_TRUNCATED_TOKENS = 32
+# Tokenizer used to count prompt tokens. The embedding model's tokenizer is already downloaded.
+# Set a llama 3 tokenizer repo for exact counts of the local model.
+PROMPT_TOKENIZER_NAME = EMBEDDING_MODEL_NAME
+# Log and count the prompt tokens saved by packing. Off by default, it tokenizes the unpacked documents
+# and turn history of every prompt again and prints a line per prompt.
+PROMPT_TOKEN_STATS_ENABLED = False
+
+# Answer cache for near duplicate questions of the same user. Only questions without turn history are cached.
+ANSWER_CACHE_ENABLED = True
+# Cosine similarity of the query embeddings needed to reuse an answer
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95
+ANSWER_CACHE_MAX_ENTRIES_PER_USER = 64
+ANSWER_CACHE_MAX_USERS = 10_000
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Prometheus metrics on /metrics. A timed stage adds about 3 microseconds.
+METRICS_ENABLED = True
@@ -0,0 +1,27 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class RetrievalExecutor:
+    """
+        Bounded thread pool for CPU bound retrieval work called from the event loop.
+        At most max_workers jobs run at once and at most max_pending more wait for a thread.
+        Callers beyond that wait on the event loop instead of piling up in the pool's queue.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="retrieval")
+        self.semaphore = asyncio.Semaphore(max_workers + max_pending)
+
+    async def run(self, func, *args, **kwargs):
+        """
+            Run func in the pool without blocking the event loop and return its result.
+        """
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,7 +1,10 @@
 import os
+from typing import Callable, Iterator, AsyncIterator
 from dotenv import load_dotenv
 from google import genai
+from google.genai import types
 import lib.utils.constants as constants
+from lib.utils.prompt_utils import ChatPrompt
 
 load_dotenv()
 gemini_client = None
@@ -25,10 +28,71 @@ def get_client() -> genai.Client:
     return gemini_client
 
 
-def generate_response(prompt) -> str:
+def create_request(prompt: str | ChatPrompt) -> dict:
     """
-        Generates resposne using a prompt
+        Contents and config for the prompt. Turn history objects are already in the gemini format.
+        The system instruction goes in the config, so every request of a conversation starts the same.
+    """
+    if isinstance(prompt, str):
+        return {"contents": prompt}
+
+    contents = list(prompt.turns)
+    contents.append({"role": constants.SPEAKER_USER, "parts": [{"text": prompt.user}]})
+    return {
+        "contents": contents,
+        "config": types.GenerateContentConfig(system_instruction=prompt.system),
+    }
+
+
+def report_usage(usage_metadata, on_usage: Callable[[int], None] = None):
+    """
+        Pass the number of generated tokens gemini reported to on_usage.
+    """
+    if on_usage is not None and usage_metadata is not None and usage_metadata.candidates_token_count is not None:
+        on_usage(usage_metadata.candidates_token_count)
+
+
+def generate_response(prompt: str | ChatPrompt, on_usage: Callable[[int], None] = None) -> str:
+    """
+        Generates resposne using a prompt. on_usage is called with the number of generated tokens.
     """
     response = gemini_client.models.generate_content(
-        model=constants.GEMINI_FLASH_MODEL, contents=prompt)
+        model=constants.GEMINI_FLASH_MODEL, **create_request(prompt))
+    report_usage(response.usage_metadata, on_usage)
+    return response.text
+
+
+def generate_response_stream(prompt: str | ChatPrompt, on_usage: Callable[[int], None] = None) -> Iterator[str]:
+    """
+        Generates response using a prompt. Yields the text as the chunks arrive.
+        on_usage is called with the number of generated tokens so far as the chunks arrive.
+    """
+    stream = gemini_client.models.generate_content_stream(
+        model=constants.GEMINI_FLASH_MODEL, **create_request(prompt))
+    for chunk in stream:
+        report_usage(chunk.usage_metadata, on_usage)
+        if chunk.text:
+            yield chunk.text
+
+
+async def generate_response_async(prompt: str | ChatPrompt, on_usage: Callable[[int], None] = None) -> str:
+    """
+        Generates response using a prompt without blocking the event loop.
+    """
+    response = await gemini_client.aio.models.generate_content(
+        model=constants.GEMINI_FLASH_MODEL, **create_request(prompt))
+    report_usage(response.usage_metadata, on_usage)
     return response.text
+
+
+async def generate_response_stream_async(prompt: str | ChatPrompt,
+                                         on_usage: Callable[[int], None] = None) -> AsyncIterator[str]:
+    """
+        Generates response using a prompt without blocking the event loop. Yields the text as the chunks arrive.
+    """
+    stream = await gemini_client.aio.models.generate_content_stream(
+        model=constants.GEMINI_FLASH_MODEL, **create_request(prompt))
+    async for chunk in stream:
+        report_usage(chunk.usage_metadata, on_usage)
+        if chunk.text:
+            yield chunk.text
@@ -0,0 +1,62 @@
+from typing import Iterator, AsyncIterator
+import lib.utils.constants as constants
+from lib.utils.prompt_utils import ChatPrompt
+from lib.utils.metrics_utils import LLMGeneration, measure_llm_stream, measure_llm_stream_async
+from lib.utils.gemini_utils import generate_response, generate_response_stream
+from lib.utils.gemini_utils import generate_response_async, generate_response_stream_async
+from lib.utils.local_ai_utils import generate_local_llm_response, generate_local_llm_response_stream
+from lib.utils.local_ai_utils import generate_local_llm_response_async, generate_local_llm_response_stream_async
+
+
+def generate_llm_response(prompt: str | ChatPrompt) -> str:
+    """
+        Generates response with the llm backend set in constants.LLM_BACKEND
+    """
+    generation = LLMGeneration(constants.LLM_BACKEND)
+    if constants.LLM_BACKEND == constants.LLM_BACKEND_GEMINI:
+        response = generate_response(prompt=prompt, on_usage=generation.set_completion_tokens)
+    else:
+        response = generate_local_llm_response(prompt=prompt, on_usage=generation.set_completion_tokens)
+    generation.finish()
+    return response
+
+
+def generate_llm_response_stream(prompt: str | ChatPrompt) -> Iterator[str]:
+    """
+        Streams the response with the llm backend set in constants.LLM_BACKEND
+    """
+    generation = LLMGeneration(constants.LLM_BACKEND)
+    if constants.LLM_BACKEND == constants.LLM_BACKEND_GEMINI:
+        stream = generate_response_stream(prompt=prompt, on_usage=generation.set_completion_tokens)
+    else:
+        stream = generate_local_llm_response_stream(prompt=prompt, on_usage=generation.set_completion_tokens)
+    if not constants.METRICS_ENABLED:
+        return stream
+    return measure_llm_stream(stream, generation)
+
+
+async def generate_llm_response_async(prompt: str | ChatPrompt) -> str:
+    """
+        Async version of generate_llm_response. Doesn't block the event loop.
+    """
+    generation = LLMGeneration(constants.LLM_BACKEND)
+    if constants.LLM_BACKEND == constants.LLM_BACKEND_GEMINI:
+        response = await generate_response_async(prompt=prompt, on_usage=generation.set_completion_tokens)
+    else:
+        response = await generate_local_llm_response_async(prompt=prompt, on_usage=generation.set_completion_tokens)
+    generation.finish()
+    return response
+
+
+def generate_llm_response_stream_async(prompt: str | ChatPrompt) -> AsyncIterator[str]:
+    """
+        Async version of generate_llm_response_stream. Doesn't block the event loop.
+    """
+    generation = LLMGeneration(constants.LLM_BACKEND)
+    if constants.LLM_BACKEND == constants.LLM_BACKEND_GEMINI:
+        stream = generate_response_stream_async(prompt=prompt, on_usage=generation.set_completion_tokens)
+    else:
+        stream = generate_local_llm_response_stream_async(prompt=prompt, on_usage=generation.set_completion_tokens)
+    if not constants.METRICS_ENABLED:
+        return stream
+    return measure_llm_stream_async(stream, generation)
@@ -1,23 +1,121 @@
+from typing import Callable, Iterator, AsyncIterator
 from openai import AsyncOpenAI
 from openai import OpenAI
+import lib.utils.constants as constants
+from lib.utils.prompt_utils import ChatPrompt
 
 
 client = OpenAI(
-    base_url="http://localhost:11434/v1",
+    base_url=constants.LOCAL_LLM_BASE_URL,
     api_key="ollama"
 )
 
+async_client = AsyncOpenAI(
+    base_url=constants.LOCAL_LLM_BASE_URL,
+    api_key="ollama"
+)
+
+
+def create_messages(prompt: str | ChatPrompt) -> list[dict]:
+    """
+        OpenAI chat messages for the prompt. A plain string is sent as one user message.
+    """
+    if isinstance(prompt, str):
+        return [
+            {"role": "user", "content": prompt}
+        ]
+
+    messages = [{"role": "system", "content": prompt.system}]
+    for turn in prompt.turns:
+        role = "assistant" if turn["role"] == constants.SPEAKER_MODEL else "user"
+        text = " ".join(part.get("text", "") for part in turn["parts"])
+        messages.append({"role": role, "content": text})
+    messages.append({"role": "user", "content": prompt.user})
+    return messages
+
 
-def generate_local_llm_response(prompt) -> str:
+def create_extra_body() -> dict:
     """
-        Generates resposne using a prompt
+        Server options that aren't part of the OpenAI api. Keep the model loaded and reuse the prompt cache.
     """
-    messages = [
-        {"role": "user", "content": prompt}
-    ]
+    return {
+        "keep_alive": constants.LOCAL_LLM_KEEP_ALIVE,
+        "cache_prompt": constants.LOCAL_LLM_CACHE_PROMPT,
+    }
 
+
+def report_usage(usage, on_usage: Callable[[int], None] = None):
+    """
+        Pass the number of generated tokens the server reported to on_usage. Servers can leave usage out.
+    """
+    if on_usage is not None and usage is not None:
+        on_usage(usage.completion_tokens)
+
+
+def generate_local_llm_response(prompt: str | ChatPrompt, on_usage: Callable[[int], None] = None) -> str:
+    """
+        Generates resposne using a prompt. on_usage is called with the number of generated tokens.
+    """
     response = client.chat.completions.create(
-        model="llama3.1",
-        messages=messages
+        model=constants.LOCAL_LLM_MODEL,
+        messages=create_messages(prompt),
+        extra_body=create_extra_body()
     )
+    report_usage(response.usage, on_usage)
     return response.choices[0].message.content
+
+
+def generate_local_llm_response_stream(prompt: str | ChatPrompt, on_usage: Callable[[int], None] = None) -> Iterator[str]:
+    """
+        Generates response using a prompt. Yields the text as the tokens arrive.
+        on_usage is called with the number of generated tokens once the server sends the usage.
+    """
+    stream = client.chat.completions.create(
+        model=constants.LOCAL_LLM_MODEL,
+        messages=create_messages(prompt),
+        extra_body=create_extra_body(),
+        stream_options={"include_usage": True},
+        stream=True
+    )
+    for chunk in stream:
+        # The usage comes in a last chunk without choices
+        report_usage(chunk.usage, on_usage)
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content
+        if text:
+            yield text
+
+
+async def generate_local_llm_response_async(prompt: str | ChatPrompt, on_usage: Callable[[int], None] = None) -> str:
+    """
+        Generates response using a prompt without blocking the event loop.
+    """
+    response = await async_client.chat.completions.create(
+        model=constants.LOCAL_LLM_MODEL,
+        messages=create_messages(prompt),
+        extra_body=create_extra_body()
+    )
+    report_usage(response.usage, on_usage)
+    return response.choices[0].message.content
+
+
+async def generate_local_llm_response_stream_async(prompt: str | ChatPrompt,
+                                                   on_usage: Callable[[int], None] = None) -> AsyncIterator[str]:
+    """
+        Generates response using a prompt without blocking the event loop. Yields the text as the tokens arrive.
+    """
+    stream = await async_client.chat.completions.create(
+        model=constants.LOCAL_LLM_MODEL,
+        messages=create_messages(prompt),
+        extra_body=create_extra_body(),
+        stream_options={"include_usage": True},
+        stream=True
+    )
+    async for chunk in stream:
+        report_usage(chunk.usage, on_usage)
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content
+        if text:
+            yield text
@@ -0,0 +1,231 @@
+import time
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Iterator
+
+from prometheus_client import REGISTRY, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+import lib.utils.constants as constants
+
+# Stages
+STAGE_TOKEN_VERIFICATION = "token_verification"
+STAGE_HISTORY_READ = "history_read"
+STAGE_MESSAGE_WRITE = "message_write"
+STAGE_KNOWLEDGE_BASE_WRITE = "knowledge_base_write"
+STAGE_TOKENIZE = "tokenize"
+STAGE_TOKENIZE_BATCH = "tokenize_batch"
+STAGE_BM25_SEARCH = "bm25_search"
+STAGE_BM25_INDEX_LOAD = "bm25_index_load"
+STAGE_BM25_INDEX_UPDATE = "bm25_index_update"
+STAGE_QUERY_EMBEDDING = "query_embedding"
+STAGE_CHROMA_QUERY = "chroma_query"
+STAGE_EMBEDDING_UPDATE = "embedding_update"
+STAGE_KNOWLEDGE_BASE_BUILD = "knowledge_base_build"
+STAGE_FUSION = "fusion"
+STAGE_LLM_FIRST_TOKEN = "llm_first_token"
+STAGE_LLM_GENERATE = "llm_generate"
+
+# Backends that aren't set in constants
+BACKEND_FIREBASE = "firebase"
+BACKEND_FIRESTORE = "firestore"
+BACKEND_BM25 = "bm25"
+BACKEND_CHROMA = "chroma"
+
+# From tens of microseconds (fusion, a cached token) to minutes (llm answers, knowledge base builds)
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+STAGE_SECONDS = Histogram(
+    "orcal_stage_duration_seconds",
+    "Time spent in each stage of the chat and build paths. backend is the component that ran the stage.",
+    ["stage", "backend"],
+    buckets=DURATION_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "orcal_request_duration_seconds",
+    "Time to handle a request, until the last byte for streams.",
+    ["endpoint"],
+    buckets=DURATION_BUCKETS
+)
+PROMPT_TOKENS = Histogram(
+    "orcal_prompt_tokens",
+    "Tokens of the packed context and turn history of each prompt.",
+    ["part"],
+    buckets=(0, 32, 64, 128, 256, 512, 1024, 1536, 2048, 4096, 8192)
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "orcal_llm_tokens_per_second",
+    "Generated tokens per second of each llm response. Tokens come from the server's usage, "
+    "or one per chunk for streams without usage.",
+    ["backend"],
+    buckets=(1, 2.5, 5, 10, 20, 40, 80, 160, 320, 640)
+)
+LLM_COMPLETION_TOKENS = Counter(
+    "orcal_llm_completion_tokens",
+    "Generated tokens from the server's usage, or one per chunk for streams without usage.",
+    ["backend"]
+)
+
+# Stats keys that only go up. The other numeric stats are exported as gauges.
+COUNTER_STATS = {"hits", "misses", "disk_hits", "evictions"}
+
+
+def observe_stage(stage: str, backend: str, seconds: float):
+    if constants.METRICS_ENABLED:
+        _stage_histogram(stage, backend).observe(seconds)
+
+
+class measure_stage:
+    """
+        Time the with block as stage. Works around awaits too.
+        A plain class instead of contextlib.contextmanager, which costs a generator per block.
+    """
+    __slots__ = ("stage", "backend", "start")
+
+    def __init__(self, stage: str, backend: str):
+        self.stage = stage
+        self.backend = backend
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        observe_stage(self.stage, self.backend, time.perf_counter() - self.start)
+
+
+def observe_request(endpoint: str, seconds: float):
+    if constants.METRICS_ENABLED:
+        _request_histogram(endpoint).observe(seconds)
+
+
+def observe_prompt_tokens(context_tokens: int, turn_history_tokens: int):
+    if constants.METRICS_ENABLED:
+        _prompt_tokens_histogram("context").observe(context_tokens)
+        _prompt_tokens_histogram("turn_history").observe(turn_history_tokens)
+
+
+def observe_llm_generation(backend: str, completion_tokens: int | None, seconds: float):
+    """
+        Record the latency and the token rate of one llm response. Only the latency if completion_tokens is None.
+    """
+    if not constants.METRICS_ENABLED:
+        return
+    _stage_histogram(STAGE_LLM_GENERATE, backend).observe(seconds)
+    if completion_tokens is None:
+        return
+    LLM_COMPLETION_TOKENS.labels(backend=backend).inc(completion_tokens)
+    if seconds > 0:
+        LLM_TOKENS_PER_SECOND.labels(backend=backend).observe(completion_tokens / seconds)
+
+
+class LLMGeneration:
+    """
+        Times one llm response. The backend passes the completion tokens the server reported to set_completion_tokens,
+        so nothing is tokenized again. A stream without usage counts one token per chunk,
+        which is what OpenAI compatible servers send.
+    """
+    __slots__ = ("backend", "start", "chunks", "completion_tokens")
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self.start = time.perf_counter()
+        self.chunks = 0
+        self.completion_tokens = None
+
+    def set_completion_tokens(self, completion_tokens: int | None):
+        self.completion_tokens = completion_tokens
+
+    def observe_chunk(self):
+        if self.chunks == 0:
+            observe_stage(STAGE_LLM_FIRST_TOKEN, self.backend, time.perf_counter() - self.start)
+        self.chunks += 1
+
+    def finish(self):
+        completion_tokens = self.completion_tokens
+        if completion_tokens is None and self.chunks:
+            completion_tokens = self.chunks
+        observe_llm_generation(self.backend, completion_tokens, time.perf_counter() - self.start)
+
+
+def measure_llm_stream(stream: Iterator[str], generation: LLMGeneration) -> Iterator[str]:
+    """
+        Pass the chunks through. Records the time to the first chunk and the whole generation once the stream ends.
+    """
+    generation.start = time.perf_counter()
+    for chunk in stream:
+        generation.observe_chunk()
+        yield chunk
+    generation.finish()
+
+
+async def measure_llm_stream_async(stream: AsyncIterator[str], generation: LLMGeneration) -> AsyncIterator[str]:
+    """
+        Async version of measure_llm_stream.
+    """
+    generation.start = time.perf_counter()
+    async for chunk in stream:
+        generation.observe_chunk()
+        yield chunk
+    generation.finish()
+
+
+class CacheStatsCollector(Collector):
+    """
+        Exports the stats() of the caches when /metrics is scraped, so the caches don't do any extra work per request.
+        sources maps the cache name to its stats function. Each numeric stat becomes orcal_cache_<key>{cache=<name>}.
+    """
+
+    def __init__(self, sources: dict[str, Callable[[], dict]]):
+        self.sources = sources
+
+    def collect(self):
+        families = {}
+        for name, stats_func in self.sources.items():
+            try:
+                stats = stats_func()
+            except Exception as e:
+                print(f"Could not read the stats of the {name} cache: {e}")
+                continue
+
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                family = families.get(key)
+                if family is None:
+                    family_class = CounterMetricFamily if key in COUNTER_STATS else GaugeMetricFamily
+                    family = family_class(
+                        f"orcal_cache_{key}", f"{key.replace('_', ' ').capitalize()} of each cache.", labels=["cache"])
+                    families[key] = family
+                family.add_metric([name], value)
+
+        yield from families.values()
+
+
+def register_cache_stats(sources: dict[str, Callable[[], dict]]) -> CacheStatsCollector:
+    """
+        Export the cache stats on /metrics. Unregister the returned collector on shutdown.
+    """
+    collector = CacheStatsCollector(sources)
+    REGISTRY.register(collector)
+    return collector
+
+
+def unregister_cache_stats(collector: CacheStatsCollector):
+    REGISTRY.unregister(collector)
+
+
+# Label lookups take a lock and a dict lookup. The children are resolved once per label set instead.
+@lru_cache(maxsize=None)
+def _stage_histogram(stage: str, backend: str):
+    return STAGE_SECONDS.labels(stage=stage, backend=backend)
+
+
+@lru_cache(maxsize=None)
+def _request_histogram(endpoint: str):
+    return REQUEST_SECONDS.labels(endpoint=endpoint)
+
+
+@lru_cache(maxsize=None)
+def _prompt_tokens_histogram(part: str):
+    return PROMPT_TOKENS.labels(part=part)
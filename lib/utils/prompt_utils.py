@@ -1,37 +1,292 @@
-def get_personal_assistant_rag_prompt(query: str, result: str, turn_history: str = "") -> str:
+import re
+import threading
+from typing import NamedTuple
+
+from langchain_core.documents import Document
+from huggingface_hub import hf_hub_download
+from tokenizers import Tokenizer
+
+import lib.utils.constants as constants
+from lib.utils.metrics_utils import observe_prompt_tokens
+
+# Used when the tokenizer can't be loaded. Close to what subword tokenizers give for english text.
+_APPROXIMATE_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+
+class PackedContext(NamedTuple):
+    """
+        Context and turn history that fit the token budgets, with what was left out.
+        turns has the kept turn history objects. Empty if the turn history was a plain string.
+    """
+    context: str
+    turn_history: str
+    turns: list[dict]
+    context_tokens: int
+    turn_history_tokens: int
+    dropped_documents: int
+    dropped_turns: int
+
+
+class ChatPrompt(NamedTuple):
+    """
+        Prompt as chat messages. system never changes and turns only grow at the end,
+        so consecutive requests of a conversation share a prefix the llm server can reuse.
+        turns are turn history objects ({"role": "user" or "model", "parts": [{"text": ...}]}).
+        user has the retrieved context and the query.
+    """
+    system: str
+    turns: list[dict]
+    user: str
+
+
+class PromptTokenStats:
+    """
+        Running totals of context and turn history tokens before and after packing.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.packed_tokens = 0
+        self.unpacked_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, packed_tokens: int, unpacked_tokens: int):
+        with self._lock:
+            self.requests += 1
+            self.packed_tokens += packed_tokens
+            self.unpacked_tokens += unpacked_tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "packed_tokens": self.packed_tokens,
+                "unpacked_tokens": self.unpacked_tokens,
+                "saved_tokens": self.unpacked_tokens - self.packed_tokens,
+            }
+
+
+PROMPT_TOKEN_STATS = PromptTokenStats()
+
+# System Instruction / Persona Setting
+# The initial block sets the rules for the model.
+# Hard constraint
+# SYSTEM_INSTRUCTION = (
+#     "You are a highly capable and concise Personal Assistant for the user. "
+#     "Your responses must be based **EXCLUSIVELY** on the 'PRIVATE CONTEXT' provided. "
+#     "Do not use external knowledge. "
+#     "If the answer is not contained within the context, you MUST politely state that the information is unavailable in the current knowledge base. "
+#     "Maintain a professional, helpful, and supportive tone."
+# )
+
+# Soft constraint
+SYSTEM_INSTRUCTION = (
+    "You are a highly capable and concise Personal Assistant for the user. "
+    "Your responses must be based on the 'PRIVATE CONTEXT' provided. "
+    "Previous messages with you will be provided in 'TURN HISTORY' but it can also be empty "
+    "Maintain a helpful, and supportive tone. "
+    "Instead of just answering the question. Suggest the user on what they should do and try to solve their problem."
+)
+
+# Same rules for chat messages. The previous messages are real turns of the conversation there.
+CHAT_SYSTEM_INSTRUCTION = (
+    "You are a highly capable and concise Personal Assistant for the user. "
+    "Your responses must be based on the 'PRIVATE CONTEXT' provided in the user's latest message. "
+    "The earlier messages are your conversation with the user so far and can be empty. "
+    "Maintain a helpful, and supportive tone. "
+    "Instead of just answering the question. Suggest the user on what they should do and try to solve their problem."
+)
+
+
+def get_personal_assistant_rag_prompt(query: str, result: list[Document] | str, turn_history: list[dict] | str = "") -> str:
     """
     Generates a prompt for a personal assistant RAG system.
 
     This prompt guides the LLM to act as a knowledgeable personal assistant,
     answering queries based strictly on the provided context (from about_me.json).
+    The retrieved documents and the turn history are packed into the token budgets first.
     """
 
-    # 1. System Instruction / Persona Setting
-    # The initial block sets the rules for the model.
-    # Hard constraint
-    # system_instruction = (
-    #     "You are a highly capable and concise Personal Assistant for the user. "
-    #     "Your responses must be based **EXCLUSIVELY** on the 'PRIVATE CONTEXT' provided. "
-    #     "Do not use external knowledge. "
-    #     "If the answer is not contained within the context, you MUST politely state that the information is unavailable in the current knowledge base. "
-    #     "Maintain a professional, helpful, and supportive tone."
-    # )
-
-    # Soft constraint
-    system_instruction = (
-        "You are a highly capable and concise Personal Assistant for the user. "
-        "Your responses must be based on the 'PRIVATE CONTEXT' provided. "
-        "Previous messages with you will be provided in 'TURN HISTORY' but it can also be empty "
-        "Maintain a helpful, and supportive tone. "
-        "Instead of just answering the question. Suggest the user on what they should do and try to solve their problem."
-    )
+    # Fit the context and the turn history in their budgets
+    packed = pack_context(results=result, turn_history=turn_history)
 
-    # 2. Main Prompt Structure
+    # Main Prompt Structure
     # This structure clearly separates the context from the query for the model.
-    full_prompt = (
+    full_prompt = _format_prompt(
+        SYSTEM_INSTRUCTION, packed.context, packed.turn_history, query)
+
+    if constants.PROMPT_TOKEN_STATS_ENABLED:
+        _record_token_savings(packed, result, turn_history)
+
+    return full_prompt
+
+
+def get_personal_assistant_rag_messages(query: str, result: list[Document],
+                                        turn_history: list[dict] | str = "") -> ChatPrompt:
+    """
+        Same prompt as get_personal_assistant_rag_prompt as chat messages:
+        the system instruction, the turn history as real turns, then the context and the query.
+    """
+    packed = pack_context(results=result, turn_history=turn_history)
+
+    user_message = (
+        f"--- PRIVATE CONTEXT ---\n"
+        f"{packed.context}\n"
+    )
+    # A plain string history can't be split into turns
+    if packed.turn_history and not packed.turns:
+        user_message += (
+            f"--- TURN HISTORY ---\n"
+            f"{packed.turn_history}\n"
+        )
+    user_message += (
+        f"-----------------------\n\n"
+        f"USER QUERY:\n"
+        f"{query}"
+    )
+
+    chat_prompt = ChatPrompt(
+        system=CHAT_SYSTEM_INSTRUCTION, turns=packed.turns, user=user_message)
+
+    if constants.PROMPT_TOKEN_STATS_ENABLED:
+        _record_token_savings(packed, result, turn_history)
+
+    return chat_prompt
+
+
+def render_chat_prompt(chat_prompt: ChatPrompt) -> str:
+    """
+        Flatten the messages to one text. For token counts and backends without chat messages.
+    """
+    lines = [chat_prompt.system]
+    lines.extend(render_turn(turn) for turn in chat_prompt.turns)
+    lines.append(chat_prompt.user)
+    return "\n\n".join(lines)
+
+
+def pack_context(results: list[Document] | str,
+                 turn_history: list[dict] | str,
+                 context_token_budget: int = constants.PROMPT_CONTEXT_TOKEN_BUDGET,
+                 turn_history_token_budget: int = constants.PROMPT_TURN_HISTORY_TOKEN_BUDGET) -> PackedContext:
+    """
+        Render the documents as title + details in fused score order until the context budget is full.
+        Keep the newest turns that fit the turn history budget. Older turns are truncated or dropped first.
+    """
+    # Context
+    if isinstance(results, str):
+        documents = [results] if results else []
+    else:
+        documents = [render_document(document) for document in _by_fused_score(results)]
+    context_lines, context_tokens = _fill_budget(
+        documents, context_token_budget, keep_end=False)
+
+    # Turn history. Filled newest first so the oldest turns are the ones left out.
+    # A plain string is cut from the start, since its newest messages are at the end.
+    if isinstance(turn_history, str):
+        history_texts = [turn_history] if turn_history else []
+        kept_texts, history_tokens = _fill_budget(
+            history_texts, turn_history_token_budget, keep_end=True)
+        turns = []
+        history_lines = kept_texts
+    else:
+        # Only the message texts count toward the budget
+        history_texts = [_turn_text(turn) for turn in turn_history]
+        kept_texts, history_tokens = _fill_budget(
+            history_texts[::-1], turn_history_token_budget, keep_end=False)
+        kept_turns = turn_history[len(turn_history) - len(kept_texts):]
+        turns = [
+            {"role": turn["role"], "parts": [{"text": text}]}
+            for turn, text in zip(kept_turns, reversed(kept_texts))
+        ]
+        history_lines = [render_turn(turn) for turn in turns]
+
+    observe_prompt_tokens(context_tokens, history_tokens)
+
+    return PackedContext(
+        context="\n".join(context_lines),
+        turn_history="\n".join(history_lines),
+        turns=turns,
+        context_tokens=context_tokens,
+        turn_history_tokens=history_tokens,
+        dropped_documents=len(documents) - len(context_lines),
+        dropped_turns=len(history_texts) - len(kept_texts),
+    )
+
+
+def render_document(document: Document) -> str:
+    """
+        Only the title and the details. The rest of the metadata (ids, ranks, scores) means nothing to the llm.
+    """
+    details = " ".join(document.page_content.split())
+    title = document.metadata.get("title")
+    return f"- {title}: {details}" if title else f"- {details}"
+
+
+def render_turn(turn: dict) -> str:
+    """
+        Render a turn history object ({"role": ..., "parts": [{"text": ...}]}) as "role: text".
+    """
+    return f"{turn.get('role', '')}: {_turn_text(turn)}"
+
+
+def _turn_text(turn: dict) -> str:
+    return " ".join(part.get("text", "") for part in turn.get("parts", []))
+
+
+def count_tokens(text: str) -> int:
+    return len(_token_spans(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep_end: bool = False) -> str:
+    """
+        Cut text to its first max_tokens tokens, or its last ones if keep_end.
+    """
+    spans = _token_spans(text)
+    if len(spans) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    if keep_end:
+        return text[spans[-max_tokens][0]:]
+    return text[:spans[max_tokens - 1][1]]
+
+
+def _fill_budget(texts: list[str], token_budget: int, keep_end: bool) -> tuple[list[str], int]:
+    """
+        Take texts in order while they fit. The first one that doesn't fit is truncated if enough budget is left.
+    """
+    selected = []
+    used_tokens = 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if used_tokens + tokens <= token_budget:
+            selected.append(text)
+            used_tokens += tokens
+            continue
+
+        remaining = token_budget - used_tokens
+        if remaining >= constants.PROMPT_MIN_TRUNCATED_TOKENS:
+            truncated = truncate_to_tokens(text, remaining, keep_end=keep_end)
+            selected.append(truncated)
+            used_tokens += count_tokens(truncated)
+        break
+    return selected, used_tokens
+
+
+def _by_fused_score(results: list[Document]) -> list[Document]:
+    # Results usually come sorted already. Documents without a score keep their place after the scored ones.
+    return sorted(results, key=lambda document: -document.metadata.get("rrf_score", float("-inf")))
+
+
+def _format_prompt(system_instruction: str, context: str, turn_history: str, query: str) -> str:
+    return (
         f"{system_instruction}\n\n"
         f"--- PRIVATE CONTEXT ---\n"
-        f"{result}\n"
+        f"{context}\n"
         f"--- TURN HISTORY ---\n"
         F"{turn_history}\n"
         f"-----------------------\n\n"
@@ -40,4 +295,55 @@ def get_personal_assistant_rag_prompt(query: str, result: str, turn_history: str
         f"ASSISTANT RESPONSE:"
     )
 
-    return full_prompt
+
+def _record_token_savings(packed: PackedContext, results: list[Document] | str, turn_history: list[dict] | str):
+    """
+        Compare the packed context and turn history with the documents and the turn history as they were
+        put in the prompt before packing. The rest of the prompt is the same either way.
+    """
+    packed_tokens = packed.context_tokens + packed.turn_history_tokens
+    unpacked_tokens = count_tokens(f"{results}") + count_tokens(f"{turn_history}")
+    PROMPT_TOKEN_STATS.record(packed_tokens, unpacked_tokens)
+    print(f"Context and turn history tokens: {packed_tokens} (unpacked {unpacked_tokens}, "
+          f"saved {unpacked_tokens - packed_tokens}). "
+          f"Dropped {packed.dropped_documents} documents and {packed.dropped_turns} turns.")
+
+
+def _token_spans(text: str) -> list[tuple[int, int]]:
+    """
+        Character span of each token of text.
+    """
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return [match.span() for match in _APPROXIMATE_TOKEN_PATTERN.finditer(text)]
+    return tokenizer.encode(text, add_special_tokens=False).offsets
+
+
+def _get_tokenizer():
+    """
+        Load PROMPT_TOKENIZER_NAME once. Falls back to approximate counts if it can't be loaded (e.g. offline).
+    """
+    global _tokenizer, _tokenizer_loaded
+    if _tokenizer_loaded:
+        return _tokenizer
+
+    with _tokenizer_lock:
+        if not _tokenizer_loaded:
+            try:
+                tokenizer = Tokenizer.from_file(_download_tokenizer_file())
+                # Count every token, not just the ones the model would keep
+                tokenizer.no_truncation()
+                tokenizer.no_padding()
+                _tokenizer = tokenizer
+            except Exception as e:
+                print(f"Could not load the prompt tokenizer. Using approximate token counts: {e}")
+            _tokenizer_loaded = True
+    return _tokenizer
+
+
+def _download_tokenizer_file() -> str:
+    # The local cache first, so a cached tokenizer doesn't need the network
+    try:
+        return hf_hub_download(constants.PROMPT_TOKENIZER_NAME, "tokenizer.json", local_files_only=True)
+    except Exception:
+        return hf_hub_download(constants.PROMPT_TOKENIZER_NAME, "tokenizer.json")
@@ -1,25 +1,102 @@
+import re
 import string
 import nltk
-from nltk.tokenize import word_tokenize
+from nltk.tokenize import word_tokenize, NLTKWordTokenizer
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
 
+import lib.utils.constants as constants
+from lib.utils.metrics_utils import STAGE_TOKENIZE, STAGE_TOKENIZE_BATCH, measure_stage
+
 
 STOP_WORDS = set(stopwords.words('english'))
 STEMMER = PorterStemmer()
 
+# Removes the ascii punctuation
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+# Tokens the fast path handles itself. Other tokens (unicode quotes, control characters, ...) go through nltk's word tokenizer.
+# Once the ascii punctuation is gone, the word tokenizer rules only look inside a whitespace separated token,
+# so tokenizing such a token on its own gives the same result as tokenizing the whole text.
+ASCII_WORD = re.compile(r"[a-z0-9]+")
+WORD_TOKENIZER = NLTKWordTokenizer()
+
+# For plain ascii words, the only thing word_tokenize does besides splitting on whitespace
+# is splitting these contractions. (nltk's MacIntyreContractions that don't need an apostrophe)
+CONTRACTIONS = {
+    "cannot": ["can", "not"],
+    "gimme": ["gim", "me"],
+    "gonna": ["gon", "na"],
+    "gotta": ["got", "ta"],
+    "lemme": ["lem", "me"],
+    "wanna": ["wan", "na"],
+}
+
+# token -> stem. Stemming is a pure function of the token, so results are reused across calls.
+STEM_CACHE: dict[str, str] = {}
+
 
 def tokenize_text(text: str):
     """
         Create tokens for the given text.
     """
+    with measure_stage(STAGE_TOKENIZE, constants.TOKENIZER_MODE):
+        if constants.TOKENIZER_MODE == constants.TOKENIZER_MODE_FAST:
+            return tokenize_text_fast(text)
+        return tokenize_text_nltk(text)
+
+
+def tokenize_texts(texts: list[str]) -> list[list[str]]:
+    """
+        Create tokens for many texts. Used when building indices.
+    """
+    with measure_stage(STAGE_TOKENIZE_BATCH, constants.TOKENIZER_MODE):
+        if constants.TOKENIZER_MODE == constants.TOKENIZER_MODE_FAST:
+            return [tokenize_text_fast(text) for text in texts]
+        return [tokenize_text_nltk(text) for text in texts]
+
+
+def tokenize_text_fast(text: str) -> list[str]:
+    """
+        Same tokens as tokenize_text_nltk without running the nltk tokenizer for plain ascii words.
+        Stems are memoized.
+    """
+    # Change to lower case and remove punctuation
+    text = text.lower().translate(PUNCTUATION_TABLE)
+
+    result = []
+    for token in text.split():
+        if ASCII_WORD.fullmatch(token):
+            words = CONTRACTIONS.get(token, (token,))
+        else:
+            words = WORD_TOKENIZER.tokenize(token)
+
+        for word in words:
+            # Remove stop words
+            if word in STOP_WORDS:
+                continue
+
+            # Stem
+            stem = STEM_CACHE.get(word)
+            if stem is None:
+                stem = STEMMER.stem(word)
+                if len(STEM_CACHE) < constants.STEM_CACHE_MAX_ENTRIES:
+                    STEM_CACHE[word] = stem
+            result.append(stem)
+
+    return result
+
+
+def tokenize_text_nltk(text: str) -> list[str]:
+    """
+        Create tokens for the given text with the nltk tokenizer.
+    """
 
     # Change to lower case
     text = text.lower()
 
     # Remove punctuation
-    trans_table = str.maketrans("", "", string.punctuation)
-    text = text.translate(trans_table)
+    text = text.translate(PUNCTUATION_TABLE)
 
     # Tokenize
     tokens = word_tokenize(text)
@@ -0,0 +1,77 @@
+import unittest
+
+import numpy as np
+from langchain_core.documents import Document
+
+from lib.augmented_generation.answer_cache import SemanticAnswerCache, is_cacheable
+
+RESULTS = [Document(page_content="Python engineer", metadata={"id": 1}),
+           Document(page_content="Plays chess", metadata={"id": 2})]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class SemanticAnswerCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = SemanticAnswerCache(threshold=0.95, max_entries_per_user=2, max_users=2, ttl_seconds=60,
+                                         clock=self.clock)
+
+    def test_near_duplicate_question_hits(self):
+        self.cache.store("user1", [1.0, 0.0], RESULTS, "answer")
+
+        self.assertEqual(self.cache.lookup("user1", [0.99, 0.05], RESULTS), "answer")
+        self.assertIsNone(self.cache.lookup("user1", [0.5, 0.5], RESULTS))
+        self.assertIsNone(self.cache.lookup("user2", [1.0, 0.0], RESULTS))
+
+    def test_other_documents_miss(self):
+        self.cache.store("user1", [1.0, 0.0], RESULTS, "answer")
+
+        self.assertEqual(self.cache.lookup("user1", [1.0, 0.0], RESULTS[::-1]), "answer")
+        self.assertIsNone(self.cache.lookup("user1", [1.0, 0.0], RESULTS[:1]))
+
+    def test_answers_expire(self):
+        self.cache.store("user1", [1.0, 0.0], RESULTS, "answer")
+        self.clock.now += 60
+
+        self.assertIsNone(self.cache.lookup("user1", [1.0, 0.0], RESULTS))
+
+    def test_answer_from_before_a_rebuild_is_not_stored(self):
+        generation = self.cache.generation("user1")
+        self.cache.invalidate("user1")
+
+        self.cache.store("user1", [1.0, 0.0], RESULTS, "answer", generation=generation)
+
+        self.assertIsNone(self.cache.lookup("user1", [1.0, 0.0], RESULTS))
+
+    def test_entries_and_users_are_bounded(self):
+        for i, vector in enumerate(np.eye(3)):
+            self.cache.store("user1", vector, RESULTS, f"answer {i}")
+
+        # The oldest answer of the user is dropped
+        self.assertIsNone(self.cache.lookup("user1", [1.0, 0.0, 0.0], RESULTS))
+        self.assertEqual(self.cache.lookup("user1", [0.0, 0.0, 1.0], RESULTS), "answer 2")
+
+        # The least recently used user is dropped
+        self.cache.store("user2", [1.0, 0.0, 0.0], RESULTS, "answer")
+        self.cache.store("user3", [1.0, 0.0, 0.0], RESULTS, "answer")
+
+        self.assertEqual(self.cache.stats()["users"], 2)
+        self.assertIsNone(self.cache.lookup("user1", [0.0, 0.0, 1.0], RESULTS))
+        self.assertEqual(self.cache.lookup("user3", [1.0, 0.0, 0.0], RESULTS), "answer")
+
+    def test_only_questions_without_turn_history_are_cacheable(self):
+        self.assertTrue(is_cacheable(""))
+        self.assertTrue(is_cacheable([]))
+        self.assertFalse(is_cacheable("user: hi"))
+        self.assertFalse(is_cacheable([{"role": "user", "parts": [{"text": "hi"}]}]))
+
+
+if __name__ == "__main__":
+    unittest.main()
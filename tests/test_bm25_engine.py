@@ -0,0 +1,112 @@
+import unittest
+
+import numpy as np
+from langchain_core.documents import Document
+from rank_bm25 import BM25Okapi
+
+from lib.bm25_search.bm25_engine import BM25Engine
+from lib.utils.text_utils import tokenize_text
+
+TEXTS = [
+    "Python engineer building mobile apps",
+    "Worked on python projects and data pipelines",
+    "Prefers meetings in the morning and python",
+    "Runs on weekends and plays chess",
+    "Python python python everywhere",
+    "Speaks three languages and writes python",
+]
+
+QUERIES = [
+    "python",
+    "python apps",
+    "python python",
+    "weekend chess",
+    "meetings languages projects",
+]
+
+
+def make_documents(texts: list[str], first_id: int = 0) -> list[Document]:
+    return [Document(page_content=text, metadata={"id": first_id + i}) for i, text in enumerate(texts)]
+
+
+def full_scores(engine: BM25Engine, query: str) -> np.ndarray:
+    """
+        Scores of every document. Documents without a query term score 0, like BM25Okapi.
+    """
+    scores = np.zeros(engine.num_docs)
+    doc_idx, touched_scores = engine.score(query)
+    scores[doc_idx] = touched_scores
+    return scores
+
+
+class BM25EngineScoreTest(unittest.TestCase):
+    def test_scores_match_bm25_okapi(self):
+        engine = BM25Engine.from_documents(make_documents(TEXTS))
+        okapi = BM25Okapi([tokenize_text(text) for text in TEXTS])
+
+        for query in QUERIES:
+            with self.subTest(query=query):
+                np.testing.assert_allclose(
+                    full_scores(engine, query), okapi.get_scores(tokenize_text(query)), rtol=1e-5, atol=1e-6)
+
+    def test_negative_idf_is_floored_like_bm25_okapi(self):
+        # "python" is in more than half of the documents, so its raw idf is negative
+        engine = BM25Engine.from_documents(make_documents(TEXTS))
+        okapi = BM25Okapi([tokenize_text(text) for text in TEXTS])
+        term = tokenize_text("python")[0]
+
+        self.assertGreater(okapi.idf[term], 0)
+        self.assertAlmostEqual(float(engine.idf[engine.term_id(term)]), okapi.idf[term], places=5)
+        np.testing.assert_allclose(
+            full_scores(engine, "python"), okapi.get_scores([term]), rtol=1e-5, atol=1e-6)
+
+
+class BM25EngineUpdateTest(unittest.TestCase):
+    def test_update_replaces_and_removes_documents(self):
+        engine = BM25Engine.from_documents(make_documents(TEXTS))
+        updated = Document(page_content="Plays chess and go on weekends", metadata={"id": 1})
+
+        engine = engine.update(documents=[updated], removed_ids=[3, 5])
+        expected = BM25Engine.from_documents(
+            [doc for doc in make_documents(TEXTS) if doc.metadata["id"] not in (1, 3, 5)] + [updated])
+
+        self.assertEqual(engine.doc_ids.tolist(), [0, 2, 4, 1])
+        self.assertEqual(engine.doc_store.document(3).page_content, updated.page_content)
+        for query in QUERIES + ["chess go"]:
+            with self.subTest(query=query):
+                np.testing.assert_allclose(full_scores(engine, query), full_scores(expected, query), rtol=1e-5)
+
+    def test_update_drops_terms_without_postings(self):
+        engine = BM25Engine.from_documents(make_documents(TEXTS))
+
+        engine = engine.update(documents=[], removed_ids=[3])
+
+        self.assertEqual(engine.term_id(tokenize_text("chess")[0]), -1)
+        self.assertEqual(engine.search("chess", limit=5), [])
+
+
+class BM25EngineSearchTest(unittest.TestCase):
+    def test_search_orders_by_score(self):
+        engine = BM25Engine.from_documents(make_documents(TEXTS))
+
+        results = engine.search("python apps", limit=3)
+
+        scores = full_scores(engine, "python apps")
+        expected = sorted(range(len(TEXTS)), key=lambda idx: (-scores[idx], idx))[:3]
+        self.assertEqual([doc.metadata["id"] for doc in results], expected)
+
+    def test_ties_are_ordered_by_document_index(self):
+        engine = BM25Engine.from_documents(make_documents(["python apps"] * 5 + ["chess"]))
+
+        self.assertEqual([doc.metadata["id"] for doc in engine.search("python", limit=3)], [0, 1, 2])
+        self.assertEqual([doc.metadata["id"] for doc in engine.search("python", limit=10)], [0, 1, 2, 3, 4])
+
+    def test_no_matching_term_returns_nothing(self):
+        engine = BM25Engine.from_documents(make_documents(TEXTS))
+
+        self.assertEqual(engine.search("quantum", limit=5), [])
+        self.assertEqual(engine.search("", limit=5), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
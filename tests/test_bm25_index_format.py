@@ -0,0 +1,159 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+from langchain_community.retrievers import BM25Retriever
+from langchain_core.documents import Document
+
+from lib.bm25_search.bm25_engine import BM25Engine
+from lib.bm25_search.bm25_index_format import (
+    BM25IndexFormatError, MappedVocabulary, convert_pickle_index, open_bm25_index, write_bm25_index)
+from lib.utils.text_utils import tokenize_text
+
+TEXTS = [
+    "Python engineer building mobile apps",
+    "Worked on python projects and data pipelines",
+    "Prefers meetings in the morning",
+    "Runs on weekends and plays chess",
+    "Café owner who speaks naïve français",
+    "Python python python everywhere",
+]
+
+QUERIES = ["python", "python apps", "weekends chess", "café", "meetings projects", "quantum"]
+
+
+def make_documents() -> list[Document]:
+    return [Document(page_content=text, metadata={"id": i, "title": f"doc {i}"}) for i, text in enumerate(TEXTS)]
+
+
+def search_results(engine: BM25Engine, query: str) -> list[tuple[str, dict]]:
+    return [(doc.page_content, doc.metadata) for doc in engine.search(query, limit=10)]
+
+
+class BM25IndexFormatTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, "index", "user1.bm25")
+        self.engine = BM25Engine.from_documents(make_documents())
+
+    def test_round_trip_gives_the_same_results(self):
+        write_bm25_index(self.engine, self.path)
+        mapped = open_bm25_index(self.path)
+
+        self.assertEqual(mapped.num_docs, self.engine.num_docs)
+        self.assertEqual(mapped.doc_ids.tolist(), self.engine.doc_ids.tolist())
+        for query in QUERIES:
+            with self.subTest(query=query):
+                self.assertEqual(search_results(mapped, query), search_results(self.engine, query))
+                np.testing.assert_allclose(
+                    sorted(mapped.score(query)[1]), sorted(self.engine.score(query)[1]), rtol=1e-6)
+
+    def test_mapped_index_can_be_updated(self):
+        write_bm25_index(self.engine, self.path)
+        added = Document(page_content="Plays chess online", metadata={"id": 10})
+
+        updated = open_bm25_index(self.path).update(documents=[added], removed_ids=[3])
+        expected = self.engine.update(documents=[added], removed_ids=[3])
+
+        for query in QUERIES:
+            with self.subTest(query=query):
+                self.assertEqual(search_results(updated, query), search_results(expected, query))
+
+    def test_empty_index(self):
+        write_bm25_index(BM25Engine.from_documents([]), self.path)
+
+        self.assertEqual(open_bm25_index(self.path).search("python", limit=5), [])
+
+    def test_wrong_magic_is_rejected(self):
+        write_bm25_index(self.engine, self.path)
+        with open(self.path, "r+b") as f:
+            f.write(b"NOTBM25\x00")
+
+        with self.assertRaisesRegex(BM25IndexFormatError, "is not a bm25 index"):
+            open_bm25_index(self.path)
+
+    def test_wrong_version_is_rejected(self):
+        write_bm25_index(self.engine, self.path)
+        with open(self.path, "r+b") as f:
+            f.seek(8)
+            f.write((99).to_bytes(4, "little"))
+
+        with self.assertRaisesRegex(BM25IndexFormatError, "version 99"):
+            open_bm25_index(self.path)
+
+    def test_truncated_file_is_rejected(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "wb") as f:
+            f.write(b"ORCBM25\x00")
+
+        with self.assertRaisesRegex(BM25IndexFormatError, "too small"):
+            open_bm25_index(self.path)
+
+
+class MappedVocabularyTest(unittest.TestCase):
+    def setUp(self):
+        terms = sorted(term.encode("utf-8") for term in ["app", "apple", "café", "chess", "python"])
+        offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+        np.cumsum([len(term) for term in terms], out=offsets[1:])
+        self.vocabulary = MappedVocabulary(offsets=offsets, blob=memoryview(b"".join(terms)))
+
+    def test_get_finds_every_term(self):
+        for term_id, (term, item_id) in enumerate(self.vocabulary.items()):
+            self.assertEqual(item_id, term_id)
+            self.assertEqual(self.vocabulary.get(term), term_id)
+
+    def test_get_handles_missing_terms(self):
+        # Before the first term, after the last, between two terms and prefixes of a term
+        for term in ["", "a", "aa", "appl", "apples", "b", "caf", "zzz"]:
+            with self.subTest(term=term):
+                self.assertEqual(self.vocabulary.get(term), -1)
+        self.assertEqual(self.vocabulary.get("zzz", default=None), None)
+
+
+class ConvertPickleIndexTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.pickle_path = os.path.join(tmp_dir.name, "user1.pkl")
+        self.index_path = os.path.join(tmp_dir.name, "user1.bm25")
+
+    def test_convert_bm25_retriever(self):
+        retriever = BM25Retriever.from_documents(make_documents(), preprocess_func=tokenize_text)
+        with open(self.pickle_path, "wb") as f:
+            pickle.dump(retriever, f)
+
+        convert_pickle_index(self.pickle_path, self.index_path)
+        mapped = open_bm25_index(self.index_path)
+
+        expected = BM25Engine.from_documents(make_documents())
+        for query in QUERIES:
+            with self.subTest(query=query):
+                self.assertEqual(search_results(mapped, query), search_results(expected, query))
+        # The top result agrees with the retriever it replaces
+        retriever.k = 1
+        self.assertEqual(mapped.search("python apps", limit=1)[0].page_content,
+                         retriever.invoke("python apps")[0].page_content)
+
+    def test_convert_bm25_engine(self):
+        engine = BM25Engine.from_documents(make_documents())
+        with open(self.pickle_path, "wb") as f:
+            pickle.dump(engine, f)
+
+        convert_pickle_index(self.pickle_path, self.index_path)
+
+        self.assertEqual(search_results(open_bm25_index(self.index_path), "python"), search_results(engine, "python"))
+
+    def test_other_pickles_are_rejected(self):
+        with open(self.pickle_path, "wb") as f:
+            pickle.dump({"not": "an index"}, f)
+
+        with self.assertRaises(BM25IndexFormatError):
+            convert_pickle_index(self.pickle_path, self.index_path)
+        self.assertFalse(os.path.exists(self.index_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
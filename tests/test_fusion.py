@@ -0,0 +1,172 @@
+import random
+import unittest
+from unittest import mock
+
+from langchain_core.documents import Document
+
+from lib.hybrid_search.fusion import FUSION_COMBMNZ, FUSION_COMBSUM, FUSION_RRF, fuse, is_rrf_top_k_settled
+from lib.hybrid_search.rrf_search import RRFSearch
+import lib.utils.constants as constants
+
+
+def fused_ids(results) -> list:
+    return [result.id for result in results]
+
+
+class RRFEarlyStopTest(unittest.TestCase):
+    """
+        Early stop must return the same top results, in the same order, as fusing every candidate.
+    """
+
+    def setUp(self):
+        # Only the fusion loop is used. No retrievers are loaded.
+        self.rrf_search = RRFSearch.__new__(RRFSearch)
+        self.enterContext(mock.patch.object(constants, "FUSION_MODE", FUSION_RRF))
+
+    def retrievers(self, rankings: dict[str, list[int]], calls: list[int] = None) -> dict:
+        def retriever(ranking: list[int]):
+            def search(depth: int) -> list[Document]:
+                if calls is not None:
+                    calls.append(depth)
+                return [Document(page_content=str(doc_id), metadata={"id": doc_id}) for doc_id in ranking[:depth]]
+            return search
+        return {name: retriever(ranking) for name, ranking in rankings.items()}
+
+    def search(self, rankings: dict[str, list[int]], limit: int, early_stop: bool, calls: list[int] = None) -> list:
+        max_length = max(len(ranking) for ranking in rankings.values())
+        docs = self.rrf_search._fused_search(
+            retrievers=self.retrievers(rankings, calls), limit=limit, k=constants.K_VALUE,
+            candidate_depth=max(max_length, 1), early_stop=early_stop)
+        return [doc.metadata["id"] for doc in docs]
+
+    def assert_same_as_full_depth(self, seed: int, weights: list[float] = None):
+        rng = random.Random(seed)
+        num_docs = rng.randint(5, 300)
+        rankings = {
+            "bm25": rng.sample(range(num_docs), rng.randint(0, num_docs)),
+            "semantic": rng.sample(range(num_docs), rng.randint(1, num_docs)),
+        }
+        limit = rng.randint(1, 10)
+        fusion_weights = dict(zip(rankings, weights or [1.0, 1.0]))
+
+        with mock.patch.object(constants, "FUSION_WEIGHTS", fusion_weights):
+            expected = fused_ids(fuse(list(rankings.values()), weights=list(fusion_weights.values()),
+                                      k=constants.K_VALUE, limit=limit))
+            self.assertEqual(self.search(rankings, limit, early_stop=False), expected)
+            self.assertEqual(self.search(rankings, limit, early_stop=True), expected)
+
+    def test_random_rankings(self):
+        for seed in range(300):
+            with self.subTest(seed=seed):
+                self.assert_same_as_full_depth(seed)
+
+    def test_random_weighted_rankings(self):
+        for seed in range(300):
+            with self.subTest(seed=seed):
+                weights = random.Random(-seed).choice([[2.0, 1.0], [1.0, 0.5], [0.3, 1.7]])
+                self.assert_same_as_full_depth(seed, weights)
+
+    def test_exhausted_source(self):
+        # bm25 only has two candidates. Its bound drops to 0 once it returns less than asked for.
+        rankings = {"bm25": [7, 3], "semantic": list(range(200))}
+        expected = fused_ids(fuse(list(rankings.values()), k=constants.K_VALUE, limit=3))
+        calls = []
+
+        self.assertEqual(self.search(rankings, limit=3, early_stop=True, calls=calls), expected)
+        self.assertLess(max(calls), 200)
+
+    def test_stops_early_when_sources_agree(self):
+        rankings = {"bm25": list(range(500)), "semantic": list(range(500))}
+        calls = []
+
+        self.assertEqual(self.search(rankings, limit=5, early_stop=True, calls=calls), [0, 1, 2, 3, 4])
+        self.assertLess(max(calls), 500)
+
+    def test_early_stop_is_off_for_other_fusion_modes(self):
+        rankings = {"bm25": list(range(100)), "semantic": list(range(100))}
+        calls = []
+
+        with mock.patch.object(constants, "FUSION_MODE", FUSION_COMBSUM):
+            self.search(rankings, limit=5, early_stop=True, calls=calls)
+
+        self.assertEqual(calls, [100, 100])
+
+
+class FuseLimitTest(unittest.TestCase):
+    def test_ties_at_the_limit_keep_first_seen_order(self):
+        # Docs at the same rank of each source tie. The ones seen first win the last places.
+        rankings = [list(range(0, 50)), list(range(100, 150))]
+
+        for limit in range(1, 20):
+            with self.subTest(limit=limit):
+                self.assertEqual(fused_ids(fuse(rankings, limit=limit)), fused_ids(fuse(rankings))[:limit])
+        self.assertEqual(fused_ids(fuse(rankings, limit=3)), [0, 100, 1])
+
+
+class IsRRFTopKSettledTest(unittest.TestCase):
+    def test_unseen_docs_can_still_enter(self):
+        results = fuse([[1], [1]], k=60)
+
+        self.assertFalse(is_rrf_top_k_settled(results, limit=2, depths=[1, 1], exhausted=[False, False], k=60))
+        self.assertTrue(is_rrf_top_k_settled(results, limit=2, depths=[1, 1], exhausted=[True, True], k=60))
+
+    def test_top_doc_missing_from_a_source_can_overtake(self):
+        # 2 is second but missing from the first source. Rank 3 there would put it ahead of 1.
+        results = fuse([[1, 3], [1, 2]], k=1)
+
+        self.assertEqual(fused_ids(results)[:2], [1, 3])
+        self.assertFalse(is_rrf_top_k_settled(results, limit=2, depths=[2, 2], exhausted=[False, False], k=1))
+
+    def test_settled_when_top_docs_are_out_of_reach(self):
+        results = fuse([[1, 2, 3, 4], [1, 2, 3, 4]], k=1)
+
+        self.assertTrue(is_rrf_top_k_settled(results, limit=1, depths=[4, 4], exhausted=[False, False], k=1))
+
+
+class NormalizedFusionTest(unittest.TestCase):
+    def test_combsum_rank_based(self):
+        # Rank scores. first source: 1 -> 1, 2 -> 2/3, 3 -> 1/3. second source: 3 -> 1, 1 -> 1/2.
+        results = fuse([[1, 2, 3], [3, 1]], mode=FUSION_COMBSUM)
+
+        self.assertEqual(fused_ids(results), [1, 3, 2])
+        for result, score in zip(results, [1.5, 4 / 3, 2 / 3]):
+            self.assertAlmostEqual(result.score, score)
+        self.assertEqual([result.ranks for result in results], [(1, 2), (3, 1), (2, 0)])
+
+    def test_combmnz_rank_based(self):
+        results = fuse([[1, 2, 3], [3, 1]], mode=FUSION_COMBMNZ)
+
+        self.assertEqual(fused_ids(results), [1, 3, 2])
+        for result, score in zip(results, [3.0, 8 / 3, 2 / 3]):
+            self.assertAlmostEqual(result.score, score)
+
+    def test_combsum_min_max_normalizes_scores(self):
+        # first source: 10, 6, 2 -> 1, 0.5, 0. second source: 0.9, 0.3 -> 1, 0.
+        # 2 and 3 tie at 1 and keep the order they first appeared in.
+        results = fuse([[1, 2, 3], [3, 1]], weights=[2.0, 1.0], mode=FUSION_COMBSUM,
+                       scores=[[10, 6, 2], [0.9, 0.3]])
+
+        self.assertEqual(fused_ids(results), [1, 2, 3])
+        for result, score in zip(results, [2.0, 1.0, 1.0]):
+            self.assertAlmostEqual(result.score, score)
+
+    def test_combmnz_min_max_normalizes_scores(self):
+        results = fuse([[1, 2, 3], [3, 1]], weights=[2.0, 1.0], mode=FUSION_COMBMNZ,
+                       scores=[[10, 6, 2], [0.9, 0.3]])
+
+        self.assertEqual(fused_ids(results), [1, 3, 2])
+        for result, score in zip(results, [4.0, 2.0, 1.0]):
+            self.assertAlmostEqual(result.score, score)
+
+    def test_equal_scores_normalize_to_one(self):
+        results = fuse([["a", "b"]], mode=FUSION_COMBSUM, scores=[[0.4, 0.4]])
+
+        self.assertEqual([(result.id, result.score) for result in results], [("a", 1.0), ("b", 1.0)])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            fuse([[1]], mode="borda")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import chromadb
+from langchain_core.documents import Document
+
+from benchmarks.fake_embeddings import HashingEmbeddings
+from lib.bm25_search.inverted_index_external_docs import BM25IndexLoadError, InvertedIndexExternalDocs
+from lib.hybrid_search.knowledge_base_manifest import document_hash, diff_manifest, load_manifest, save_manifest
+from lib.hybrid_search.rrf_search_external_docs import RRFSearchExternalDocs
+from lib.semantic_search.query_embedding_cache import CachedQueryEmbeddings
+from lib.semantic_search.semantic_search_external_docs import SemanticSearchExternalDocs
+from lib.semantic_search.user_vector_store_cache import USER_VECTOR_STORE_CACHE
+import lib.utils.constants as constants
+
+UID = "user1"
+
+KNOWLEDGE_BASE = {
+    1: ("Skills", "Python engineer building mobile apps"),
+    2: ("Projects", "Worked on data pipelines and search"),
+    3: ("Schedule", "Prefers meetings in the morning"),
+    4: ("Hobbies", "Runs on weekends and plays chess"),
+}
+
+
+def make_documents(knowledge_base: dict[int, tuple[str, str]]) -> list[Document]:
+    # Fresh docs for every build. Indexing puts the title in the page content of the docs it's given.
+    return [Document(page_content=details, metadata={"id": doc_id, "title": title})
+            for doc_id, (title, details) in knowledge_base.items()]
+
+
+class ManifestTest(unittest.TestCase):
+    def test_diff_manifest(self):
+        diff = diff_manifest(
+            old_hashes={1: "a", 2: "b", 3: "c"},
+            new_hashes={1: "a", 2: "changed", 4: "d"})
+
+        self.assertEqual(diff.added, [4])
+        self.assertEqual(diff.updated, [2])
+        self.assertEqual(diff.unchanged, [1])
+        self.assertEqual(diff.removed, [3])
+
+    def test_document_hash_ignores_other_metadata(self):
+        doc = Document(page_content="details", metadata={"id": 1, "title": "title", "seq_num": 1})
+        moved = Document(page_content="details", metadata={"id": 1, "title": "title", "seq_num": 7})
+        retitled = Document(page_content="details", metadata={"id": 1, "title": "other"})
+
+        self.assertEqual(document_hash(doc), document_hash(moved))
+        self.assertNotEqual(document_hash(doc), document_hash(retitled))
+
+
+class IncrementalBuildTest(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.enterContext(mock.patch.object(constants, "INDEX_DIR", os.path.join(tmp_dir.name, "cache")))
+        USER_VECTOR_STORE_CACHE.clear()
+        self.addCleanup(USER_VECTOR_STORE_CACHE.clear)
+
+        self.semantic_search = SemanticSearchExternalDocs(
+            embeddings=CachedQueryEmbeddings(HashingEmbeddings(), model_name="hashing", disk_path=""),
+            chroma_client=chromadb.PersistentClient(path=os.path.join(tmp_dir.name, "chroma")))
+        self.addCleanup(self.semantic_search.embedding_pipeline.close)
+        self.inverted_index = InvertedIndexExternalDocs()
+        self.rrf_search = RRFSearchExternalDocs(
+            inverted_index=self.inverted_index, semantic_search=self.semantic_search)
+
+    def build(self, knowledge_base: dict[int, tuple[str, str]]) -> dict:
+        return self.rrf_search.build_embeddings_and_index(make_documents(knowledge_base), UID)
+
+    def bm25_docs(self) -> dict[int, str]:
+        index = self.inverted_index._load_index(UID)
+        return {int(doc_id): index.doc_store.document(doc_idx).page_content
+                for doc_idx, doc_id in enumerate(index.doc_ids)}
+
+    def chroma_docs(self) -> dict[int, str]:
+        result = self.semantic_search.collections.get(UID).get()
+        return {int(doc_id): text for doc_id, text in zip(result["ids"], result["documents"])}
+
+    def assert_indexed(self, knowledge_base: dict[int, tuple[str, str]]):
+        expected = {doc_id: f"{title} {details}" for doc_id, (title, details) in knowledge_base.items()}
+        self.assertEqual(self.bm25_docs(), expected)
+        self.assertEqual(self.chroma_docs(), expected)
+
+    def test_first_build_adds_everything(self):
+        counts = self.build(KNOWLEDGE_BASE)
+
+        self.assertEqual(counts, {"added": 4, "updated": 0, "unchanged": 0, "removed": 0})
+        self.assert_indexed(KNOWLEDGE_BASE)
+        self.assertEqual(set(load_manifest(UID)), set(KNOWLEDGE_BASE))
+
+    def test_counts_added_updated_unchanged_and_removed(self):
+        self.build(KNOWLEDGE_BASE)
+        knowledge_base = dict(KNOWLEDGE_BASE)
+        knowledge_base[2] = ("Projects", "Built a retrieval augmented chat app")
+        del knowledge_base[4]
+        knowledge_base[5] = ("Languages", "Speaks three languages")
+
+        with mock.patch.object(self.semantic_search.embedding_pipeline, "run",
+                               wraps=self.semantic_search.embedding_pipeline.run) as run:
+            counts = self.build(knowledge_base)
+
+        self.assertEqual(counts, {"added": 1, "updated": 1, "unchanged": 2, "removed": 1})
+        # Only the changed docs are embedded
+        self.assertEqual(sorted(doc.metadata["id"] for doc in run.call_args.kwargs["documents"]), [2, 5])
+        self.assert_indexed(knowledge_base)
+
+    def test_nothing_changed_does_no_work(self):
+        self.build(KNOWLEDGE_BASE)
+
+        with mock.patch.object(self.inverted_index, "update") as update, \
+                mock.patch.object(self.semantic_search, "update_embeddings") as update_embeddings:
+            counts = self.build(KNOWLEDGE_BASE)
+
+        self.assertEqual(counts, {"added": 0, "updated": 0, "unchanged": 4, "removed": 0})
+        update.assert_not_called()
+        update_embeddings.assert_not_called()
+        self.assert_indexed(KNOWLEDGE_BASE)
+
+    def test_changed_embedding_fingerprint_rebuilds_everything(self):
+        self.build(KNOWLEDGE_BASE)
+
+        # The configured embedding backend changed since the last build
+        self.semantic_search.embedding_fingerprint = "other-model"
+        with mock.patch("lib.hybrid_search.knowledge_base_manifest.embedding_fingerprint", return_value="other-model"):
+            self.assertIsNone(load_manifest(UID))
+            counts = self.build(KNOWLEDGE_BASE)
+            self.assertEqual(set(load_manifest(UID)), set(KNOWLEDGE_BASE))
+
+        self.assertEqual(counts, {"added": 4, "updated": 0, "unchanged": 0, "removed": 0})
+        self.assertFalse(self.semantic_search.needs_rebuild(UID))
+        self.assert_indexed(KNOWLEDGE_BASE)
+
+    def test_changed_collection_fingerprint_rebuilds_everything(self):
+        self.build(KNOWLEDGE_BASE)
+        # The manifest still matches but the collection was embedded by another backend
+        self.semantic_search.embedding_fingerprint = "other-model"
+        save_manifest(UID, load_manifest(UID))
+
+        counts = self.build(KNOWLEDGE_BASE)
+
+        self.assertEqual(counts, {"added": 4, "updated": 0, "unchanged": 0, "removed": 0})
+        self.assert_indexed(KNOWLEDGE_BASE)
+
+    def test_unloadable_bm25_index_is_rebuilt_from_all_documents(self):
+        self.build(KNOWLEDGE_BASE)
+        with open(self.inverted_index._uid_to_file_path(UID), "wb") as f:
+            f.write(b"not a bm25 index" * 16)
+        knowledge_base = dict(KNOWLEDGE_BASE)
+        knowledge_base[3] = ("Schedule", "Prefers meetings after lunch")
+
+        counts = self.build(knowledge_base)
+
+        self.assertEqual(counts, {"added": 0, "updated": 1, "unchanged": 3, "removed": 0})
+        # The unchanged docs are still in the bm25 index
+        self.assert_indexed(knowledge_base)
+
+    def test_search_on_unloadable_bm25_index_raises_load_error(self):
+        self.build(KNOWLEDGE_BASE)
+        USER_VECTOR_STORE_CACHE.clear()
+        with open(self.inverted_index._uid_to_file_path(UID), "wb") as f:
+            f.write(b"not a bm25 index" * 16)
+
+        with self.assertRaises(BM25IndexLoadError):
+            self.inverted_index.bm25_search(UID, "python", limit=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from langchain_core.embeddings import Embeddings
+
+from lib.semantic_search.query_embedding_cache import CachedQueryEmbeddings
+
+
+class RecordingEmbeddings(Embeddings):
+    """
+        Embeds a text as its length and records what the model was given.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        self.queries.append(text)
+        return [float(len(text)), 1.0]
+
+
+class CachedQueryEmbeddingsTest(unittest.TestCase):
+    def setUp(self):
+        self.model = RecordingEmbeddings()
+
+    def test_model_gets_the_query_as_typed(self):
+        cache = CachedQueryEmbeddings(self.model, model_name="model", disk_path="")
+
+        cache.embed_query("  What are my   Python skills? ")
+
+        self.assertEqual(self.model.queries, ["What are my Python skills?"])
+
+    def test_case_and_whitespace_variants_share_an_entry(self):
+        cache = CachedQueryEmbeddings(self.model, model_name="model", disk_path="", ignore_case=True)
+
+        first = cache.embed_query("What are my Python skills?")
+        second = cache.embed_query("what are my  python skills?")
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.model.queries), 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_case_variants_are_embedded_separately_for_cased_models(self):
+        cache = CachedQueryEmbeddings(self.model, model_name="model", disk_path="", ignore_case=False)
+
+        cache.embed_query("What are my Python skills?")
+        cache.embed_query("what are my python skills?")
+        cache.embed_query("what are my  python skills?")
+
+        self.assertEqual(self.model.queries, ["What are my Python skills?", "what are my python skills?"])
+
+    def test_disk_tier_survives_restarts(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "queries.sqlite")
+            vector = CachedQueryEmbeddings(self.model, model_name="model", disk_path=path).embed_query("skills")
+
+            restarted = CachedQueryEmbeddings(self.model, model_name="model", disk_path=path)
+
+            self.assertEqual(restarted.embed_query("Skills"), vector)
+            self.assertEqual(self.model.queries, ["skills"])
+            self.assertEqual(restarted.stats()["disk_hits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
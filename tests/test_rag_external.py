@@ -0,0 +1,81 @@
+import asyncio
+import types
+import unittest
+from unittest import mock
+
+from langchain_core.documents import Document
+
+from benchmarks.fake_embeddings import HashingEmbeddings
+from lib.augmented_generation.answer_cache import SemanticAnswerCache
+from lib.augmented_generation.rag_external import RAGExternal
+from lib.utils.executor_utils import RetrievalExecutor
+import lib.utils.constants as constants
+
+RESULTS = [Document(page_content="Python engineer", metadata={"id": 1, "rrf_score": 0.03})]
+HISTORY = [{"role": "user", "parts": [{"text": "hi"}]}, {"role": "model", "parts": [{"text": "hello"}]}]
+
+
+class FakeRRFSearch:
+    def __init__(self):
+        self.semantic_search = types.SimpleNamespace(embeddings=HashingEmbeddings())
+
+    def rrf_search(self, uid: str, query: str, limit: int, k: float) -> list[Document]:
+        return RESULTS
+
+
+class RAGExternalAnswerCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.enterContext(mock.patch.object(constants, "ANSWER_CACHE_ENABLED", True))
+        executor = RetrievalExecutor(max_workers=1, max_pending=4)
+        self.addCleanup(executor.shutdown)
+        self.rag = RAGExternal(rrf_search=FakeRRFSearch(), retrieval_executor=executor,
+                               answer_cache=SemanticAnswerCache())
+        self.llm = self.enterContext(mock.patch(
+            "lib.augmented_generation.rag_external.generate_llm_response", return_value="answer"))
+
+        async def generate_async(prompt):
+            return "answer"
+        self.async_llm = self.enterContext(mock.patch(
+            "lib.augmented_generation.rag_external.generate_llm_response_async", side_effect=generate_async))
+
+    def test_repeated_question_is_answered_from_the_cache(self):
+        self.assertEqual(self.rag.discuss("user1", "What are my skills?"), "answer")
+        self.assertEqual(self.rag.discuss("user1", "what are my skills"), "answer")
+
+        self.assertEqual(self.llm.call_count, 1)
+        self.assertEqual(self.rag.answer_cache.stats()["hits"], 1)
+
+    def test_question_with_turn_history_skips_the_cache(self):
+        with mock.patch.object(self.rag, "_embed_query", wraps=self.rag._embed_query) as embed_query:
+            self.rag.discuss("user1", "What are my skills?", turn_history=HISTORY)
+            self.rag.discuss("user1", "What are my skills?", turn_history=HISTORY)
+
+        self.assertEqual(self.llm.call_count, 2)
+        embed_query.assert_not_called()
+        self.assertEqual(self.rag.answer_cache.stats()["entries"], 0)
+
+    def test_async_generation_uses_the_cache(self):
+        async def ask(turn_history):
+            generation = self.rag.answer_cache.generation("user1")
+            results = await self.rag.aretrieve("user1", "What are my skills?")
+            return await self.rag.agenerate("user1", "What are my skills?", results, generation, turn_history)
+
+        for turn_history in ["", "", HISTORY]:
+            self.assertEqual(asyncio.run(ask(turn_history)), "answer")
+
+        self.assertEqual(self.async_llm.call_count, 2)
+
+    def test_answer_from_before_a_rebuild_is_not_cached(self):
+        async def ask_across_rebuild():
+            generation = self.rag.answer_cache.generation("user1")
+            results = await self.rag.aretrieve("user1", "What are my skills?")
+            self.rag.answer_cache.invalidate("user1")
+            return await self.rag.agenerate("user1", "What are my skills?", results, generation)
+
+        asyncio.run(ask_across_rebuild())
+
+        self.assertEqual(self.rag.answer_cache.stats()["entries"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
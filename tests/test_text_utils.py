@@ -0,0 +1,44 @@
+import unittest
+
+import nltk
+
+from benchmarks.tokenizer_benchmark import EDGE_CASE_WORDS, random_texts
+import lib.utils.text_utils as text_utils
+
+
+class FastTokenizerParityTest(unittest.TestCase):
+    """
+        tokenize_text_fast must give the same tokens as tokenize_text_nltk, or BM25 indices built in one mode
+        would not match queries tokenized in the other.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            nltk.data.find("tokenizers/punkt_tab/english/")
+        except LookupError:
+            raise unittest.SkipTest("nltk punkt_tab is not downloaded. Run nltk.download('punkt_tab').")
+
+    def assert_same_tokens(self, texts: list[str]):
+        for text in texts:
+            with self.subTest(text=text):
+                self.assertEqual(text_utils.tokenize_text_fast(text), text_utils.tokenize_text_nltk(text))
+
+    def test_edge_case_words(self):
+        self.assert_same_tokens(EDGE_CASE_WORDS)
+
+    def test_random_texts(self):
+        self.assert_same_tokens(random_texts(count=2000, words_per_text=60, seed=0))
+
+    def test_memoized_stems(self):
+        texts = random_texts(count=200, words_per_text=60, seed=1)
+        text_utils.STEM_CACHE.clear()
+        cold = [text_utils.tokenize_text_fast(text) for text in texts]
+        warm = [text_utils.tokenize_text_fast(text) for text in texts]
+
+        self.assertEqual(cold, warm)
+        self.assert_same_tokens(texts)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import time
+import unittest
+
+from firebase_admin import auth
+
+from backend.firebase.token_verifier import ID_TOKEN_ISSUER_PREFIX, CertStore, FirebaseTokenVerifier
+from benchmarks.local_token_signer import LocalTokenSigner
+
+
+class FakeClock:
+    """
+        Time that only moves when the test moves it.
+        Starts at the real time, since the token expiry is also checked against it.
+    """
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TokenVerifierTest(unittest.TestCase):
+    # One RSA key for every test. Generating them is the slow part.
+    signer = LocalTokenSigner()
+
+    def setUp(self):
+        self.signer.fetch_count = 0
+        self.clock = FakeClock()
+        self.cert_store = CertStore(fetch_certs=self.signer.fetch_certs, min_refresh_seconds=60, clock=self.clock)
+        self.verifier = FirebaseTokenVerifier(
+            project_id=self.signer.project_id, cert_store=self.cert_store, max_ttl_seconds=3600, clock=self.clock)
+
+    def test_valid_token(self):
+        claims = self.verifier.verify(self.signer.sign("user-1"))
+
+        self.assertEqual(claims["uid"], "user-1")
+        self.assertEqual(claims["aud"], self.signer.project_id)
+
+    def test_wrong_audience(self):
+        token = self.signer.sign("user-1", aud="another-project")
+
+        with self.assertRaises(auth.InvalidIdTokenError) as context:
+            self.verifier.verify(token)
+        self.assertIn('"aud"', str(context.exception))
+
+    def test_wrong_issuer(self):
+        token = self.signer.sign("user-1", iss=ID_TOKEN_ISSUER_PREFIX + "another-project")
+
+        with self.assertRaises(auth.InvalidIdTokenError) as context:
+            self.verifier.verify(token)
+        self.assertIn('"iss"', str(context.exception))
+
+    def test_expired_token(self):
+        token = self.signer.sign("user-1", expires_in=-120)
+
+        with self.assertRaises(auth.ExpiredIdTokenError):
+            self.verifier.verify(token)
+        # Failures are never cached
+        self.assertIsNone(self.verifier.get_cached(token))
+
+    def test_unknown_kid_refreshes_certs(self):
+        self.verifier.verify(self.signer.sign("user-1"))
+        self.assertEqual(self.signer.fetch_count, 1)
+
+        # Google rotated the keys after the last refresh
+        self.signer.rotate()
+        self.clock.now += 61
+        claims = self.verifier.verify(self.signer.sign("user-2"))
+
+        self.assertEqual(claims["uid"], "user-2")
+        self.assertEqual(self.signer.fetch_count, 2)
+
+    def test_unknown_kid_refreshes_are_rate_limited(self):
+        self.verifier.verify(self.signer.sign("user-1"))
+
+        forged = LocalTokenSigner(project_id=self.signer.project_id).sign("user-1")
+        for _ in range(3):
+            with self.assertRaises(auth.InvalidIdTokenError):
+                self.verifier.verify(forged)
+
+        self.assertEqual(self.signer.fetch_count, 1)
+
+    def test_cached_token_expires_at_exp(self):
+        token = self.signer.sign("user-1", expires_in=60)
+        claims = self.verifier.verify(token)
+
+        self.clock.now = claims["exp"] - 1
+        self.assertEqual(self.verifier.get_cached(token)["uid"], "user-1")
+
+        self.clock.now = claims["exp"]
+        self.assertIsNone(self.verifier.get_cached(token))
+
+    def test_cache_ttl_is_capped(self):
+        verifier = FirebaseTokenVerifier(
+            project_id=self.signer.project_id, cert_store=self.cert_store, max_ttl_seconds=10, clock=self.clock)
+        token = self.signer.sign("user-1", expires_in=3600)
+        verifier.verify(token)
+
+        self.clock.now += 9
+        self.assertIsNotNone(verifier.get_cached(token))
+        self.clock.now += 1
+        self.assertIsNone(verifier.get_cached(token))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.semantic_search.user_vector_store_cache import BM25_RETRIEVER, UserVectorStoreCache
+
+
+class UserVectorStoreCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = UserVectorStoreCache(max_entries=10, max_bytes=1000, ttl_seconds=3600)
+
+    def test_load_is_cached(self):
+        value = self.cache.get_or_load("user1", BM25_RETRIEVER, lambda: "index")
+
+        self.assertEqual(value, "index")
+        self.assertEqual(self.cache.get("user1", BM25_RETRIEVER), "index")
+
+    def test_load_started_before_invalidate_is_not_cached(self):
+        def loader():
+            # A rebuild finishes while the old index is being loaded
+            self.cache.invalidate("user1")
+            return "old index"
+
+        value = self.cache.get_or_load("user1", BM25_RETRIEVER, loader)
+
+        self.assertEqual(value, "old index")
+        self.assertIsNone(self.cache.get("user1", BM25_RETRIEVER))
+        self.assertEqual(self.cache.get_or_load("user1", BM25_RETRIEVER, lambda: "new index"), "new index")
+
+    def test_concurrent_misses_share_one_load(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "index"
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            first = executor.submit(self.cache.get_or_load, "user1", BM25_RETRIEVER, loader)
+            started.wait(5)
+            others = [executor.submit(self.cache.get_or_load, "user1", BM25_RETRIEVER, loader)
+                      for _ in range(3)]
+            release.set()
+            values = [first.result(5)] + [future.result(5) for future in others]
+
+        self.assertEqual(values, ["index"] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_failed_load_is_raised_to_every_waiter(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def loader():
+            started.set()
+            release.wait(5)
+            raise OSError("broken index")
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(self.cache.get_or_load, "user1", BM25_RETRIEVER, loader)
+            started.wait(5)
+            second = executor.submit(self.cache.get_or_load, "user1", BM25_RETRIEVER, loader)
+            release.set()
+            for future in (first, second):
+                with self.assertRaises(OSError):
+                    future.result(5)
+
+        # The next miss loads again
+        self.assertEqual(self.cache.get_or_load("user1", BM25_RETRIEVER, lambda: "index"), "index")
+
+
+if __name__ == "__main__":
+    unittest.main()